@@ -0,0 +1,182 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
+# vi: set ft=python sts=4 sw=4 et:
+
+import numpy as np
+from scipy import stats
+
+class MassUnivariateGLM(object):
+    """
+    General linear model fitted to many response columns at once.
+    The design matrix is decomposed once (pseudo inverse), then every
+    column of the response matrix (each roi or each vertex) shares it.
+    -------------------------------------------------------------
+    Parameters:
+        X: design matrix, nsubj x nregressor.
+           Note that intercept will not be added automatically
+    Example:
+        >>> glm = MassUnivariateGLM(X)
+        >>> glm.fit(Y)
+        >>> t, p = glm.tcontrast(np.eye(X.shape[1]))
+    """
+    def __init__(self, X):
+        if isinstance(X, list):
+            X = np.array(X)
+        if X.ndim == 1:
+            X = np.expand_dims(X, axis = 1)
+        X = X.astype(float)
+        self._X = X
+        self._n, self._p = X.shape
+        self._pinv = np.linalg.pinv(X)
+        self._xtx_inv = np.dot(self._pinv, self._pinv.T)
+        self._rank = np.linalg.matrix_rank(X)
+        self._df = self._n - self._rank
+        # R2 is computed around the mean when the model contains a constant
+        self._has_const = np.any(np.all(X == X[0,:], axis = 0) & (X[0,:] != 0))
+
+    def fit(self, Y, chunk_size = None):
+        """
+        Fit model to all response columns
+        -------------------------------------
+        Parameters:
+            Y: response matrix, nsubj x ncolumn.
+               Could be an array-like object supporting column slicing (np.memmap, hdf5 dataset etc.)
+            chunk_size: columns loaded in each chunk, by default is None (all columns at once)
+        Return:
+            self
+        """
+        if isinstance(Y, list):
+            Y = np.array(Y)
+        if Y.ndim == 1:
+            Y = np.expand_dims(Y, axis = 1)
+        if Y.shape[0] != self._n:
+            raise Exception('Y should have the same rows as X')
+        ncol = Y.shape[1]
+        if chunk_size is None:
+            chunk_size = ncol
+        self.beta = np.empty((self._p, ncol))
+        self.sse = np.empty(ncol)
+        self.sst = np.empty(ncol)
+        for start in range(0, ncol, chunk_size):
+            stop = min(start + chunk_size, ncol)
+            Yc = np.asarray(Y[:, start:stop], dtype = float)
+            beta = np.dot(self._pinv, Yc)
+            residue = Yc - np.dot(self._X, beta)
+            self.beta[:, start:stop] = beta
+            self.sse[start:stop] = np.sum(residue**2, axis = 0)
+            if self._has_const:
+                self.sst[start:stop] = np.sum((Yc - Yc.mean(axis = 0))**2, axis = 0)
+            else:
+                self.sst[start:stop] = np.sum(Yc**2, axis = 0)
+        self.sigma2 = self.sse/self._df
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            self.r2 = 1.0 - self.sse/self.sst
+        return self
+
+    def tcontrast(self, c, tail = 'both'):
+        """
+        t test of contrasts
+        -------------------------------------
+        Parameters:
+            c: contrasts, ncontrast x nregressor (or a single contrast vector)
+            tail: 'both' or 'single'
+        Return:
+            t: t values, ncontrast x ncolumn
+            tpval: p values of t
+        """
+        c = np.atleast_2d(np.asarray(c, dtype = float))
+        effect = np.dot(c, self.beta)
+        var_c = np.einsum('ij,jk,ik->i', c, self._xtx_inv, c)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            t = effect/np.sqrt(np.outer(var_c, self.sigma2))
+        tpval = _tail_pval(stats.t.sf(np.abs(t), self._df), tail)
+        return t, tpval
+
+    def fcontrast(self, C = None, tail = 'single'):
+        """
+        F test of a contrast matrix
+        -------------------------------------
+        Parameters:
+            C: contrast matrix, nrow x nregressor.
+               By default is None, test all regressors except the constant one (overall model test)
+            tail: 'single' or 'both', keep 'both' for compatible with tools.lin_betafit
+        Return:
+            f: f values, ncolumn
+            fpval: p values of f
+        """
+        if C is None:
+            C = np.eye(self._p)
+            if self._has_const:
+                const = np.all(self._X == self._X[0,:], axis = 0)
+                C = C[~const]
+        C = np.atleast_2d(np.asarray(C, dtype = float))
+        q = np.linalg.matrix_rank(C)
+        effect = np.dot(C, self.beta)
+        middle = np.linalg.pinv(np.dot(np.dot(C, self._xtx_inv), C.T))
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            f = np.sum(effect*np.dot(middle, effect), axis = 0)/(q*self.sigma2)
+        fpval = _tail_pval(stats.f.sf(np.abs(f), q, self._df), tail)
+        return f, fpval
+
+def _tail_pval(pval, tail):
+    if tail == 'both':
+        return pval*2
+    elif tail == 'single':
+        return pval
+    else:
+        raise Exception('wrong pointed tail.')
+
+def mass_betafit(X, Y, c = None, tail = 'both', scale = True, chunk_size = None):
+    """
+    Vectorized counterpart of tools.lin_betafit, fitting all columns of Y together
+    ---------------------------------------------------------------
+    Parameters:
+        X: Independent matrix, nsubj x nregressor
+        Y: Dependent matrix, nsubj x ncolumn.
+           Could be an array-like object supporting column slicing (e.g. np.memmap), loaded chunk by chunk
+        c: contrasts, ncontrast x nregressor. By default is None, test each regressor
+        tail: significance tails of t tests.
+              F test of the model is always one-sided (fpval of lin_betafit is doubled with 'both' and could exceed 1)
+        scale: standardize X and Y before fitting (scaled beta), by default is True.
+               An intercept is always added into the model
+        chunk_size: columns fitted in each chunk
+    Return:
+        r2: determined values, ncolumn
+        beta: slopes (scaled beta), nregressor x ncolumn
+        t: tvals, ncontrast x ncolumn
+        tpval: significance of beta
+        f: f values of model test, ncolumn
+        fpval: p values of f test
+    Example:
+        >>> r2, beta, t, tpval, f, fpval = mass_betafit(X, Y)
+    """
+    if isinstance(X, list):
+        X = np.array(X)
+    if X.ndim == 1:
+        X = np.expand_dims(X, axis = 1)
+    if isinstance(Y, list):
+        Y = np.array(Y)
+    if Y.ndim == 1:
+        Y = np.expand_dims(Y, axis = 1)
+    if scale:
+        X = stats.zscore(X, axis = 0)
+    nreg = X.shape[1]
+    design = np.hstack((X, np.ones((X.shape[0], 1))))
+    if c is None:
+        c = np.eye(nreg)
+    c = np.atleast_2d(np.asarray(c, dtype = float))
+    c = np.hstack((c, np.zeros((c.shape[0], 1))))
+    glm = MassUnivariateGLM(design).fit(Y, chunk_size)
+    t, tpval = glm.tcontrast(c, tail)
+    f, fpval = glm.fcontrast(tail = 'single')
+    r2 = glm.r2
+    beta = glm.beta[:nreg]
+    if scale:
+        # with intercept in the model, standardizing Y only scales beta by its standard deviation (sst/n),
+        # so Y is not standardized as a whole copy and chunks are still loaded one by one
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            beta = beta/np.sqrt(glm.sst/Y.shape[0])
+        # constant columns can not be standardized
+        const = glm.sst == 0
+        r2, t, tpval, f, fpval = (np.where(const, np.nan, value) for value in (r2, t, tpval, f, fpval))
+        beta[:, const] = np.nan
+    return r2, beta, t, tpval, f, fpval
@@ -3,6 +3,8 @@
 
 import numpy as np
 
+from ATT.util import instrument
+
 
 class FeatureScale(object):
     """
@@ -177,6 +179,6 @@ class GradientImg(object):
             for j in range(1,imgdata.shape[1]-1):
                 for k in range(1,imgdata.shape[2]-1):
                     gradientimg[i,j,k], vectorg = calgradient3D(imgdata, [i,j,k], self._oprx, self._opry, self._oprz)
-            print('{}'.format(i))
+            instrument.progress('{}'.format(i))
         return gradientimg
 
@@ -0,0 +1,225 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
+# vi: set ft=python sts=4 sw=4 et:
+
+import numpy as np
+
+def compact_dtype(maxlabel, minlabel = 0):
+    """
+    The smallest integer dtype holding labels in [minlabel, maxlabel]
+    ------------------------------------------
+    Parameters:
+        maxlabel: maximum label
+        minlabel: minimum label, by default is 0
+    Return:
+        dtype: numpy dtype
+    """
+    if minlabel >= 0:
+        candidates = [np.uint8, np.uint16, np.uint32, np.uint64]
+    else:
+        candidates = [np.int8, np.int16, np.int32, np.int64]
+    for dtype in candidates:
+        info = np.iinfo(dtype)
+        if info.min <= minlabel and maxlabel <= info.max:
+            return np.dtype(dtype)
+    raise Exception('Labels out of range of integer types.')
+
+def relabel(labelimg, background = 0):
+    """
+    Relabel a label image into continuous labels 1...n in one pass
+    ------------------------------------------
+    Parameters:
+        labelimg: label image, any shape
+        background: background value, keeps as 0. By default is 0
+    Return:
+        relabelimg: relabeled image with compact integer dtype
+        rawlabel: original labels, rawlabel[i] is relabeled as i+1
+    Example:
+        >>> relabelimg, rawlabel = relabel(labelimg)
+    """
+    labelimg = np.asarray(labelimg)
+    rawlabel, inverse = np.unique(labelimg, return_inverse = True)
+    isbg = rawlabel == background
+    newlabel = np.cumsum(~isbg)
+    newlabel[isbg] = 0
+    newlabel = newlabel.astype(compact_dtype(newlabel.max() if newlabel.size else 0))
+    relabelimg = newlabel[inverse.ravel()].reshape(labelimg.shape)
+    return relabelimg, rawlabel[~isbg]
+
+def _pair_codes(image1, image2):
+    """
+    Pack labels of two images into pair codes.
+    Return label list (0 included as the first one) and label index of both images
+    """
+    image1 = np.asarray(image1)
+    image2 = np.asarray(image2)
+    if image1.shape != image2.shape:
+        raise Exception('image1 and image2 should have the same shape')
+    labels = np.unique(np.concatenate((np.unique(image1), np.unique(image2))))
+    labels = labels[labels != 0]
+    index1 = np.where(image1 != 0, np.searchsorted(labels, image1)+1, 0).ravel()
+    index2 = np.where(image2 != 0, np.searchsorted(labels, image2)+1, 0).ravel()
+    return np.concatenate(([0], labels)), index1, index2
+
+_LABEL_OPERATORS = {'and': np.logical_and,
+                    'or': np.logical_or,
+                    'xor': np.logical_xor,
+                    'diff': lambda a, b: a & ~b}
+
+def combine_labels(image1, image2, method = 'and'):
+    """
+    Label-wise logical combination of two label images, all labels are computed in one pass.
+    For each label l, output channel is l where op(image1 == l, image2 == l) holds.
+    Label pairs (image1, image2) of each voxel are packed into codes,
+    a lookup table of the codes gives the result, so each voxel touches at most two channels.
+    ------------------------------------------
+    Parameters:
+        image1: label image 1
+        image2: label image 2, same shape with image1
+        method: 'and', 'or', 'xor', or 'diff' (in image1 but not in image2)
+    Return:
+        outdata: combined image, shape of image1.shape + (nlabel,), compact integer dtype
+        labels: labels of each channel
+    Example:
+        >>> outdata, labels = combine_labels(image1, image2, 'and')
+    """
+    if method not in _LABEL_OPERATORS:
+        raise Exception("method should be 'and', 'or', 'xor' or 'diff'")
+    operator = _LABEL_OPERATORS[method]
+    alllabel, index1, index2 = _pair_codes(image1, image2)
+    nlabel = alllabel.size
+    labels = alllabel[1:]
+    dtype = compact_dtype(labels.max() if labels.size else 0, min(labels.min() if labels.size else 0, 0))
+    outdata = np.zeros((index1.size, labels.size), dtype = dtype)
+
+    if nlabel**2 <= index1.size:
+        # dense lookup table over all pair codes
+        codes = index1.astype(np.int64)*nlabel + index2
+        pair1, pair2 = np.divmod(np.arange(nlabel**2), nlabel)
+        inverse = codes
+    else:
+        # lookup table over pair codes existed only
+        codes, inverse = np.unique(index1.astype(np.int64)*nlabel + index2, return_inverse = True)
+        pair1, pair2 = np.divmod(codes, nlabel)
+    same = pair1 == pair2
+    # channel of label in image1 (pair1) and channel of label in image2 (pair2)
+    lut1 = (pair1 > 0) & operator(np.ones_like(same), same)
+    lut2 = (pair2 > 0) & ~same & operator(same, np.ones_like(same))
+    inverse = inverse.ravel()
+    for lut, pair in ((lut1, pair1), (lut2, pair2)):
+        voxel = np.flatnonzero(lut[inverse])
+        channel = pair[inverse[voxel]] - 1
+        outdata[voxel, channel] = labels[channel]
+    return outdata.reshape(np.shape(image1) + (labels.size,)), labels
+
+def _label_index(image, labels):
+    """
+    Index of each voxel in labels (1...n), 0 for background or labels not listed
+    """
+    image = np.asarray(image)
+    labels = np.asarray(labels)
+    index = np.searchsorted(labels, image)
+    found = labels[np.minimum(index, labels.size-1)] == image if labels.size else np.zeros(image.shape, dtype = bool)
+    return np.where(found, index+1, 0)
+
+class LabelContingency(object):
+    """
+    Contingency table (voxel counts) between labels of two label images, built from one bincount over joint codes.
+    Background (0) and labels not listed are counted in an extra row/column, so label sizes are kept.
+    -----------------------------------------------
+    Parameters:
+        image1: label image 1 (e.g. roi mask)
+        image2: label image 2 (e.g. template), same shape with image1
+        labels1: labels of image1, by default is None (all non-zero labels)
+        labels2: labels of image2, by default is None (all non-zero labels)
+        batch: if True, the last dimension is subjects, a table is built for each subject.
+               One of the images could be shared by subjects (without the last dimension).
+    Example:
+        >>> ct = LabelContingency(roimask, template)
+        >>> dice = ct.dice()
+    """
+    def __init__(self, image1, image2, labels1 = None, labels2 = None, batch = False):
+        image1 = np.asarray(image1)
+        image2 = np.asarray(image2)
+        if labels1 is None:
+            labels1 = np.unique(image1)
+            labels1 = labels1[labels1 != 0]
+        if labels2 is None:
+            labels2 = np.unique(image2)
+            labels2 = labels2[labels2 != 0]
+        self.labels1 = np.sort(np.asarray(labels1))
+        self.labels2 = np.sort(np.asarray(labels2))
+        if batch:
+            if image2.ndim == image1.ndim - 1:
+                image2 = np.broadcast_to(image2[...,None], image1.shape)
+            elif image1.ndim == image2.ndim - 1:
+                image1 = np.broadcast_to(image1[...,None], image2.shape)
+            nsubj = image1.shape[-1]
+        else:
+            image1 = image1[...,None]
+            image2 = image2[...,None]
+            nsubj = 1
+        if image1.shape != image2.shape:
+            raise Exception('image1 and image2 should have the same shape')
+        n1 = self.labels1.size + 1
+        n2 = self.labels2.size + 1
+        index1 = np.moveaxis(_label_index(image1, self.labels1), -1, 0).reshape(nsubj, -1)
+        index2 = np.moveaxis(_label_index(image2, self.labels2), -1, 0).reshape(nsubj, -1)
+        codes = (np.arange(nsubj, dtype = np.int64)[:,None]*n1 + index1)*n2 + index2
+        table = np.bincount(codes.ravel(), minlength = nsubj*n1*n2).reshape(nsubj, n1, n2)
+        if not batch:
+            table = table[0]
+        self._table = table
+
+    @property
+    def table(self):
+        """
+        Overlap voxel counts, nlabel1 x nlabel2 (nsubj x nlabel1 x nlabel2 in batch mode)
+        """
+        return self._table[...,1:,1:]
+
+    @property
+    def size1(self):
+        """
+        Voxel counts of each label of image1
+        """
+        return self._table.sum(axis = -1)[...,1:]
+
+    @property
+    def size2(self):
+        """
+        Voxel counts of each label of image2
+        """
+        return self._table.sum(axis = -2)[...,1:]
+
+    def amount(self):
+        return self.table
+
+    def percent(self, base = 1):
+        """
+        Overlap voxels divided by voxels of labels of image1 (base = 1) or image2 (base = 2). nan for empty labels
+        """
+        if base == 1:
+            denominator = self.size1[...,:,None]
+        elif base == 2:
+            denominator = self.size2[...,None,:]
+        else:
+            raise Exception('base should be 1 or 2')
+        return _safe_divide(self.table, denominator)
+
+    def dice(self):
+        """
+        2*intersection/(size1+size2). nan if both labels are empty
+        """
+        return _safe_divide(2.0*self.table, self.size1[...,:,None] + self.size2[...,None,:])
+
+    def jaccard(self):
+        """
+        intersection/union. nan if both labels are empty
+        """
+        return _safe_divide(self.table, self.size1[...,:,None] + self.size2[...,None,:] - self.table)
+
+def _safe_divide(numerator, denominator):
+    numerator, denominator = np.broadcast_arrays(np.asarray(numerator, dtype = float), denominator)
+    outdata = np.full(numerator.shape, np.nan)
+    np.divide(numerator, denominator, out = outdata, where = denominator != 0)
+    return outdata
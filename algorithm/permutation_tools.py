@@ -0,0 +1,316 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
+# vi: set ft=python sts=4 sw=4 et:
+
+import multiprocessing
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+def grid_adjacency(mask, connectivity = 26):
+    """
+    Generate adjacency matrix of voxels in a volume mask
+
+    Parameters:
+    -----------
+    mask: 3D mask, voxels with non-zero values are taken as nodes
+    connectivity: 6, 18 or 26, neighbourhood definition of voxels
+
+    Return:
+    -------
+    adjmatrix: sparse adjacency matrix (nvoxel x nvoxel)
+               nodes follow the order of mask[mask!=0]
+
+    Example:
+    --------
+    >>> adjmatrix = grid_adjacency(mask, 26)
+    """
+    if connectivity not in (6, 18, 26):
+        raise Exception('connectivity should be 6, 18 or 26')
+    mask = np.asarray(mask) != 0
+    if mask.ndim != 3:
+        raise Exception('mask should be a 3D image')
+    nvox = int(mask.sum())
+    index = np.full(mask.shape, -1, dtype=np.int64)
+    index[mask] = np.arange(nvox)
+    # half of the neighbourhood, the other half comes from symmetry
+    offsets = [(i,j,k) for i in (-1,0,1) for j in (-1,0,1) for k in (-1,0,1)
+               if (i,j,k) > (0,0,0) and abs(i)+abs(j)+abs(k) <= {6:1, 18:2, 26:3}[connectivity]]
+    row = []
+    col = []
+    for off in offsets:
+        src = tuple(slice(max(0,-o), mask.shape[d]-max(0,o)) for d,o in enumerate(off))
+        dst = tuple(slice(max(0,o), mask.shape[d]-max(0,-o)) for d,o in enumerate(off))
+        a = index[src]
+        b = index[dst]
+        pair = (a >= 0) & (b >= 0)
+        row.append(a[pair])
+        col.append(b[pair])
+    row = np.concatenate(row)
+    col = np.concatenate(col)
+    adjmatrix = sparse.coo_matrix((np.ones(row.size, dtype=np.int8), (row, col)), shape=(nvox, nvox))
+    adjmatrix = (adjmatrix + adjmatrix.T).tocsr()
+    return adjmatrix
+
+def _edge_list(adjacency):
+    """
+    Unique undirected edges (i<j) of an adjacency matrix
+    """
+    upper = sparse.triu(sparse.coo_matrix(adjacency), k=1).tocsr()
+    upper.sum_duplicates()
+    upper = upper.tocoo()
+    return upper.row.astype(np.int64), upper.col.astype(np.int64)
+
+def onesample_tstat(data, signs = None):
+    """
+    One sample t statistic of each node, computed for a batch of sign flips at once
+
+    Parameters:
+    -----------
+    data: data array, nsubj x nnode
+    signs: sign flip matrix, nperm x nsubj, each element is 1 or -1
+           by default is None, compute the unflipped statistic
+
+    Return:
+    -------
+    t: t values, nperm x nnode (nnode if signs is None)
+
+    Example:
+    --------
+    >>> t = onesample_tstat(data, signs)
+    """
+    n = data.shape[0]
+    sumsq = np.sum(data**2, axis=0)
+    if signs is None:
+        mean = np.sum(data, axis=0)/n
+    else:
+        mean = np.dot(signs, data)/n
+    var = (sumsq - n*mean**2)/(n-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = mean/np.sqrt(var/n)
+    t[~np.isfinite(t)] = 0.0
+    return t
+
+def twosample_tstat(data, groups):
+    """
+    Two sample t statistic (pooled variance) of each node, computed for a batch of group labels at once
+
+    Parameters:
+    -----------
+    data: data array, nsubj x nnode
+    groups: group membership, nperm x nsubj (or nsubj) bool array
+            True means group 1, False means group 2
+
+    Return:
+    -------
+    t: t values of group1 - group2, nperm x nnode (nnode if groups is 1D)
+
+    Example:
+    --------
+    >>> t = twosample_tstat(data, groups)
+    """
+    groups = np.asarray(groups).astype(float)
+    n = data.shape[0]
+    n1 = groups.sum(axis=-1)[...,None]
+    n2 = n - n1
+    s1 = np.dot(groups, data)
+    q1 = np.dot(groups, data**2)
+    s2 = np.sum(data, axis=0) - s1
+    q2 = np.sum(data**2, axis=0) - q1
+    m1 = s1/n1
+    m2 = s2/n2
+    pooled = (q1 - n1*m1**2 + q2 - n2*m2**2)/(n-2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (m1-m2)/np.sqrt(pooled*(1.0/n1+1.0/n2))
+    t[~np.isfinite(t)] = 0.0
+    return t
+
+def _tfce_positive(statmap, edges, weights, E, H, dh):
+    """
+    TFCE of the positive part of a single statistic map
+    """
+    n = statmap.shape[0]
+    tfcemap = np.zeros(n)
+    maxval = np.max(statmap)
+    if maxval < dh:
+        return tfcemap
+    ei, ej = edges
+    for h in np.arange(dh, maxval+dh/2.0, dh):
+        supra = statmap >= h
+        nodes = np.flatnonzero(supra)
+        if nodes.size == 0:
+            break
+        remap = np.full(n, -1, dtype=np.int64)
+        remap[nodes] = np.arange(nodes.size)
+        keep = supra[ei] & supra[ej]
+        graph = sparse.coo_matrix((np.ones(int(keep.sum()), dtype=np.int8), (remap[ei[keep]], remap[ej[keep]])), shape=(nodes.size, nodes.size))
+        _, complabel = connected_components(graph, directed=False)
+        extent = np.bincount(complabel, weights=weights[nodes])
+        tfcemap[nodes] += extent[complabel]**E * h**H * dh
+    return tfcemap
+
+def tfce(statmap, adjacency, E = 0.5, H = 2.0, dh = 0.1, weights = None, two_sided = True):
+    """
+    Threshold-free cluster enhancement of statistic maps
+
+    Parameters:
+    -----------
+    statmap: statistic map, nnode or nmap x nnode
+    adjacency: sparse adjacency matrix of nodes,
+               from surf_tools.mesh_edges for surface or grid_adjacency for volume
+    E: extent exponent, by default is 0.5 (use 1.0 for surface with vertex area as weights)
+    H: height exponent, by default is 2.0
+    dh: step of thresholds
+    weights: extent of each node (e.g. vertex area), by default each node counts 1
+    two_sided: enhance negative values separately and keep their sign
+
+    Return:
+    -------
+    tfcemap: tfce values, same shape as statmap
+
+    Example:
+    --------
+    >>> tfcemap = tfce(tmap, surf_tools.mesh_edges(faces))
+    """
+    if isinstance(adjacency, tuple):
+        edges = adjacency
+    else:
+        edges = _edge_list(adjacency)
+    statmap = np.asarray(statmap, dtype=float)
+    is1d = statmap.ndim == 1
+    statmap = np.atleast_2d(statmap)
+    if weights is None:
+        weights = np.ones(statmap.shape[1])
+    tfcemap = np.zeros_like(statmap)
+    for i in range(statmap.shape[0]):
+        tfcemap[i] = _tfce_positive(statmap[i], edges, weights, E, H, dh)
+        if two_sided:
+            tfcemap[i] -= _tfce_positive(-statmap[i], edges, weights, E, H, dh)
+    if is1d:
+        tfcemap = tfcemap[0]
+    return tfcemap
+
+def _calc_stat(data, test, design):
+    if test == 'onesample':
+        return onesample_tstat(data, design)
+    else:
+        return twosample_tstat(data, design)
+
+def _permute_batch(state, seed, nbatch):
+    """
+    Maximum statistic of a batch of permutations
+    """
+    rng = np.random.default_rng(seed)
+    data = state['data']
+    if state['test'] == 'onesample':
+        design = 2.0*rng.integers(0, 2, size=(nbatch, data.shape[0])) - 1.0
+    else:
+        design = rng.permuted(np.tile(state['groups'], (nbatch, 1)), axis=1)
+    statmap = _calc_stat(data, state['test'], design)
+    if state['method'] == 'tfce':
+        statmap = tfce(statmap, state['edges'], two_sided=state['two_sided'], weights=state['weights'], **state['tfce_para'])
+    if state['two_sided']:
+        statmap = np.abs(statmap)
+    return np.max(statmap, axis=1)
+
+_pool_state = {}
+
+def _pool_init(state):
+    _pool_state.update(state)
+
+def _pool_batch(args):
+    return _permute_batch(_pool_state, *args)
+
+def permutation_fwe(data, adjacency = None, method = 'tfce', test = 'onesample', groups = None, mask = None, n_perm = 5000, batch_size = 100, n_jobs = 1, seed = None, two_sided = True, weights = None, tfce_para = None):
+    """
+    Nonparametric family-wise error control by permutation,
+    using the maximum statistic or the maximum TFCE over nodes as the null distribution.
+    Sign flips (one sample test) or group labels (two sample test) are permuted in batches of matrix operations.
+
+    Parameters:
+    -----------
+    data: data array with subjects in the last axis
+          nnode x nsubj for surface (nvertex x 1 x 1 x nsubj also works)
+          nx x ny x nz x nsubj for volume, in which case mask should be given
+    adjacency: sparse adjacency matrix of nodes, needed when method is 'tfce'
+               surface: surf_tools.mesh_edges(faces)
+               volume: by default is grid_adjacency(mask)
+    method: 'tfce' or 'maxstat'
+    test: 'onesample' (sign flip) or 'twosample' (label permutation)
+    groups: group membership of each subject (nsubj bool array), used in twosample test
+    mask: volume mask, by default is None
+    n_perm: permutation numbers
+    batch_size: permutations computed in one batch
+    n_jobs: process numbers
+    seed: random seed. Results are reproducible and independent of n_jobs
+    two_sided: test both tails or only the positive tail
+    weights: node extent weights in tfce, such as vertex areas
+    tfce_para: dictionary of E, H and dh of tfce
+
+    Return:
+    -------
+    statmap: t map (or tfce map)
+    pfwe: FWE corrected p values of each node
+    null_max: null distribution of the maximum statistic
+
+    Example:
+    --------
+    >>> statmap, pfwe, null_max = permutation_fwe(data, surf_tools.mesh_edges(faces), 'tfce', n_perm = 5000, n_jobs = 8, seed = 0)
+    """
+    if method not in ('tfce', 'maxstat'):
+        raise Exception("method should be 'tfce' or 'maxstat'")
+    if test not in ('onesample', 'twosample'):
+        raise Exception("test should be 'onesample' or 'twosample'")
+    data = np.asarray(data)
+    outshape = data.shape[:-1]
+    if mask is not None:
+        mask = np.asarray(mask) != 0
+        nodedata = data[mask]
+    else:
+        nodedata = data.reshape(-1, data.shape[-1])
+    nodedata = nodedata.T.astype(float)
+    if test == 'twosample':
+        if groups is None:
+            raise Exception('Please give groups in twosample test')
+        groups = np.asarray(groups).astype(bool)
+    if tfce_para is None:
+        tfce_para = {}
+    state = {'data': nodedata, 'test': test, 'groups': groups, 'method': method,
+             'two_sided': two_sided, 'weights': weights, 'tfce_para': tfce_para, 'edges': None}
+    if method == 'tfce':
+        if adjacency is None:
+            if mask is None:
+                raise Exception('Please give adjacency or mask to compute tfce')
+            adjacency = grid_adjacency(mask)
+        state['edges'] = _edge_list(adjacency)
+
+    statmap = _calc_stat(nodedata, test, groups)
+    if method == 'tfce':
+        statmap = tfce(statmap, state['edges'], two_sided=two_sided, weights=weights, **tfce_para)
+
+    nbatch = int(np.ceil(1.0*n_perm/batch_size))
+    seeds = np.random.SeedSequence(seed).spawn(nbatch)
+    tasks = [(seeds[i], min(batch_size, n_perm-i*batch_size)) for i in range(nbatch)]
+    if n_jobs == 1:
+        null_max = [_permute_batch(state, *task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(n_jobs, initializer=_pool_init, initargs=(state,))
+        try:
+            null_max = pool.map(_pool_batch, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    null_max = np.sort(np.concatenate(null_max))
+
+    obs = np.abs(statmap) if two_sided else statmap
+    n_exceed = n_perm - np.searchsorted(null_max, obs, side='left')
+    pfwe = (n_exceed + 1.0)/(n_perm + 1.0)
+
+    if mask is not None:
+        outstat = np.zeros(outshape)
+        outp = np.ones(outshape)
+        outstat[mask] = statmap
+        outp[mask] = pfwe
+    else:
+        outstat = statmap.reshape(outshape)
+        outp = pfwe.reshape(outshape)
+    return outstat, outp, null_max
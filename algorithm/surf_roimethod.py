@@ -2,8 +2,8 @@
 # vi: set ft=python sts=4 sw=4 et:
 
 import numpy as np
-from surf_tools import caloverlap
-import tools
+from ATT.algorithm import tools
+from ATT.util import instrument
 
 def make_pm(mask, meth = 'all', labelnum = None):
     """
@@ -126,8 +126,8 @@ def nfold_maximum_threshold(imgdata, labels, labelnum = None, index = 'dice', pr
     assert (np.max(labels)<labelnum+1), "the maximum of labels should smaller than labelnum"
     output_overlap = []
     for n in range(n_permutation):
-        print("permutation {} starts".format(n+1))
-        test_subj = np.sort(np.random.choice(range(n_subj), n_subj-n_subj/n_fold, replace = False)).tolist()
+        instrument.progress("permutation {} starts".format(n+1))
+        test_subj = np.sort(np.random.choice(range(n_subj), n_subj-n_subj//n_fold, replace = False)).tolist()
         verify_subj = [val for val in range(n_subj) if val not in test_subj]
         test_data = imgdata[:,test_subj]
         verify_data = imgdata[:,verify_subj]
@@ -220,12 +220,12 @@ def pm_overlap(pm1, pm2, thr_range, option = 'number', index = 'dice'):
 
     output_overlap = []
     for i in np.arange(thr_range[0], thr_range[1], thr_range[2]):
-        print('Computing overlap of vertices {}'.format(i))
+        instrument.progress('Computing overlap of vertices {}'.format(i))
         pm1_thr = thre_func(pm1, i)
         pm2_thr = thre_func(pm2, i)
         pm1_thr[pm1_thr!=0] = 1
         pm2_thr[pm2_thr!=0] = 1
-        output_overlap.append(caloverlap(pm1_thr, pm2_thr, 1, 1))
+        output_overlap.append(tools.calc_overlap(pm1_thr, pm2_thr, 1, 1))
     output_overlap = np.array(output_overlap)
     output_overlap[np.isnan(output_overlap)] = 0
     return output_overlap
@@ -277,12 +277,12 @@ def cv_pm_overlap(pm, test_data, labels_template, labels_testdata, index = 'dice
         else:
             verify_actdata = None
         for j,e in enumerate(np.arange(thr_range[0], thr_range[1], thr_range[2])):
-            print("threshold {} is verifing".format(e))
+            instrument.progress("threshold {} is verifing".format(e))
             mpm = make_mpm(pm, e)
             if cmpalllbl is True:
-                mpm_temp.append([caloverlap(mpm, test_data[:,i], lbltmp, lbltst, index, controlsize = controlsize, actdata = verify_actdata) for lbltmp in labels_template for lbltst in labels_testdata])
+                mpm_temp.append([tools.calc_overlap(mpm, test_data[:,i], lbltmp, lbltst, index, controlsize = controlsize, actdata = verify_actdata) for lbltmp in labels_template for lbltst in labels_testdata])
             else:
-                mpm_temp.append([caloverlap(mpm, test_data[:,i], labels_template[idx], lbld, index, controlsize = controlsize, actdata = verify_actdata) for idx, lbld in enumerate(labels_testdata)])
+                mpm_temp.append([tools.calc_overlap(mpm, test_data[:,i], labels_template[idx], lbld, index, controlsize = controlsize, actdata = verify_actdata) for idx, lbld in enumerate(labels_testdata)])
         output_overlap.append(mpm_temp)
     return np.array(output_overlap)
 
@@ -321,7 +321,7 @@ def overlap_bysubject(imgdata, labels, subj_range, labelnum = None, prob_meth =
             pm_sub_lbl = pm_sub[...,lbl-1]
             pm_lbl[pm_lbl!=0] = 1
             pm_sub_lbl[pm_sub_lbl!=0] = 1
-            overlap_lbl.append(caloverlap(pm_lbl, pm_sub_lbl, 1, 1, index = index))
+            overlap_lbl.append(tools.calc_overlap(pm_lbl, pm_sub_lbl, 1, 1, index = index))
         overlap_subj.append(overlap_lbl)
     return np.array(overlap_subj)
 
@@ -6,6 +6,8 @@ from scipy import sparse
 from . import tools
 import copy
 
+from ATT.util import instrument
+
 def extract_edge_from_faces(faces):
     """
     Transfer faces relationship into edge relationship
@@ -29,7 +31,7 @@ def extract_edge_from_faces(faces):
         for j in c_gen:
             if j not in edge:
                 edge.append(j)
-        print('{} finished'.format(i))
+        instrument.progress('{} finished'.format(i))
     return edge
 
 class GenAdjacentMatrix(object):
@@ -129,7 +131,7 @@ def get_signals(atlas, mask, method = 'mean', labelnum = None):
     Parameters:
     -----------
     atlas: atlas
-    mask: mask, a label image
+    mask: mask, a label image. Could be a parsed atlas from surface.atlasregistry.load_atlas, whose label indexes are precomputed
     method: 'mean', 'std', 'ste', 'max', 'vertex', etc.
     labelnum: mask's label numbers, add this parameters for group analysis
 
@@ -143,17 +145,20 @@ def get_signals(atlas, mask, method = 'mean', labelnum = None):
     """
     if atlas.ndim == 3:
         atlas = atlas[:,0,0]
-    if mask.ndim == 3:
-        mask = mask[:,0,0]
-    
-    
-    labels = np.unique(mask)[1:]
-    if labelnum is None:
-        try:
-            labelnum = int(np.max(labels))
-        except ValueError as e:
-            print('value in mask are all zeros')
-            labelnum = 0
+    if hasattr(mask, 'label_indexes'):
+        # parsed atlas from surface.atlasregistry, label indexes are precomputed
+        indexes = mask.label_indexes(labelnum)
+    else:
+        if mask.ndim == 3:
+            mask = mask[:,0,0]
+        labels = np.unique(mask)[1:]
+        if labelnum is None:
+            try:
+                labelnum = int(np.max(labels))
+            except ValueError as e:
+                instrument.progress('value in mask are all zeros')
+                labelnum = 0
+        indexes = [np.flatnonzero(mask == i+1) for i in range(labelnum)]
     if method == 'mean':
         calfunc = np.nanmean
     elif method == 'std':
@@ -167,9 +172,9 @@ def get_signals(atlas, mask, method = 'mean', labelnum = None):
     else:
         raise Exception('Miss paramter of method')
     signals = []
-    for i in range(labelnum):
-        if np.any(mask==i+1):
-            signals.append(atlas[mask==i+1])
+    for index in indexes:
+        if index.size:
+            signals.append(atlas[index])
         else:
             signals.append(np.array([np.nan]))
     return [calfunc(sg) for sg in signals]
@@ -2,9 +2,9 @@
 # vi: set ft=python sts=4 sw=4 et:
 
 import numpy as np
-from scipy import stats
+from scipy import stats, special
 from scipy.spatial import distance
-import copy
+import warnings
 import pandas as pd
 
 
@@ -123,6 +123,43 @@ def calcdist(u, v, metric = 'euclidean', p = 1):
         dist = distance.pdist(vec, metric)
     return dist
 
+def batch_cdist(XA, XB, metric = 'euclidean', p = 1):
+    """
+    Distance matrices between two collections of points, batched over leading dimensions
+    ----------------------------------
+    Parameters:
+        XA: points, (..., n, ndim)
+        XB: points, (..., m, ndim). Leading dimensions are broadcasted with XA
+        metric: distance metric. 'euclidean', 'sqeuclidean', 'cityblock', 'chebyshev' and 'minkowski' are computed in one
+                broadcasting pass, other metrics call scipy.spatial.distance.cdist for each batch
+        p: p for 'minkowski' distance only.
+    Return:
+        dist: distance matrices, (..., n, m). Points with nan coordinates give nan distances
+    Example:
+        >>> dist = batch_cdist(coordinate, coordinate)
+    """
+    XA = np.asarray(XA, dtype = float)
+    XB = np.asarray(XB, dtype = float)
+    if metric in ['euclidean', 'sqeuclidean', 'cityblock', 'chebyshev', 'minkowski']:
+        diff = np.abs(XA[...,:,None,:] - XB[...,None,:,:])
+        if metric == 'euclidean':
+            return np.sqrt(np.sum(diff**2, axis = -1))
+        elif metric == 'sqeuclidean':
+            return np.sum(diff**2, axis = -1)
+        elif metric == 'cityblock':
+            return np.sum(diff, axis = -1)
+        elif metric == 'chebyshev':
+            return np.max(diff, axis = -1)
+        else:
+            return np.sum(diff**p, axis = -1)**(1.0/p)
+    batch = np.broadcast_shapes(XA.shape[:-2], XB.shape[:-2])
+    XA = np.broadcast_to(XA, batch + XA.shape[-2:])
+    XB = np.broadcast_to(XB, batch + XB.shape[-2:])
+    dist = np.empty(batch + (XA.shape[-2], XB.shape[-2]))
+    for index in np.ndindex(*batch):
+        dist[index] = distance.cdist(XA[index], XB[index], metric)
+    return dist
+
 def eta2(a, b):
     """
     Compute eta2 between list a and list b
@@ -237,7 +274,7 @@ def pearsonr(A, B):
     r_forp = rcorr*1.0
     r_forp[r_forp==1.0] = 0.0
     t_squared = rcorr.T**2*(df/((1.0-rcorr.T)*(1.0+rcorr.T)))
-    pcorr = stats.betai(0.5*df, 0.5, df/(df+t_squared))
+    pcorr = special.betainc(0.5*df, 0.5, df/(df+t_squared))
     return rcorr.T, pcorr
 
 def r2z(r):
@@ -289,6 +326,8 @@ def z2r(z):
 def hemi_merge(left_region, right_region, meth = 'single', weight = None):
     """
     Merge hemisphere data
+    Data are merged elementwise, so left_region and right_region could be arrays of any shape
+    (e.g. timeseries x regions x nsubj)
     -------------------------------------
     Parameters:
         left_region: feature data extracted from left hemisphere
@@ -297,35 +336,36 @@ def hemi_merge(left_region, right_region, meth = 'single', weight = None):
           'single' means if no paired feature data in subjects, keep exist data
           'both' means if no paired feature data in subjects, delete these                subjects
         weight: weights for feature data.
-            Note that it's a (nsubj x 2) matrix
-            weight[:,0] means left_region
-            weight[:,1] means right_region
+            Note that it's a (nsubj x 2) matrix, or left_region.shape + (2,) for multi-dimensional data
+            weight[...,0] means left_region
+            weight[...,1] means right_region
     Return:
         merge_region 
     """
-    if left_region.shape[0] != right_region.shape[0]:
+    left_region = np.asarray(left_region, dtype = float)
+    right_region = np.asarray(right_region, dtype = float)
+    if left_region.shape != right_region.shape:
         raise Exception('Subject numbers of left and right feature data should be equal')
-    nsubj = left_region.shape[0]
-    leftregion_used = np.copy(left_region)
-    rightregion_used = np.copy(right_region)
     if weight is None:
-        weight = np.ones((nsubj,2))
-        weight[np.isnan(leftregion_used),0] = 0.0
-        weight[np.isnan(rightregion_used),1] = 0.0 
-    if meth == 'single': 
-        leftregion_used[np.isnan(leftregion_used)] = 0.0
-        rightregion_used[np.isnan(rightregion_used)] = 0.0
-        merge_region = (leftregion_used*weight[:,0] + rightregion_used*weight[:,1])/(weight[:,0] + weight[:,1])
-    elif meth == 'both':
-        total_weight = weight[:,0] + weight[:,1]
-        total_weight[total_weight<2] = 0.0
-        merge_region = (left_region*weight[:,0] + right_region*weight[:,1])/total_weight
+        weight_left = (~np.isnan(left_region)).astype(float)
+        weight_right = (~np.isnan(right_region)).astype(float)
     else:
-        raise Exception('meth will be ''both'' or ''single''')
+        weight = np.asarray(weight, dtype = float)
+        weight_left = weight[...,0]
+        weight_right = weight[...,1]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        if meth == 'single': 
+            merge_region = (np.nan_to_num(left_region)*weight_left + np.nan_to_num(right_region)*weight_right)/(weight_left + weight_right)
+        elif meth == 'both':
+            total_weight = weight_left + weight_right
+            total_weight = np.where(total_weight<2, 0.0, total_weight)
+            merge_region = (left_region*weight_left + right_region*weight_right)/total_weight
+        else:
+            raise Exception('meth will be ''both'' or ''single''')
     merge_region[merge_region == 0] = np.nan
     return merge_region
 
-def removeoutlier(data, meth = None, thr = [-2,2]):
+def removeoutlier(data, meth = None, thr = [-2,2], axis = None, copy = True):
     """
     Remove data as outliers by indices you set
     -----------------------------
@@ -335,30 +375,44 @@ def removeoutlier(data, meth = None, thr = [-2,2]):
         thr: outlier standard threshold.
              For example, when meth == 'iqr' and thr == [-2,2],
              so data should in [-2*iqr, 2*iqr] to be left
+        axis: axis along which the outlier criterion is computed.
+              By default is None, computing on the whole data
+        copy: if False, outliers are set as nan in place and the input data is returned.
+              In-place update needs a float array, otherwise an exception is raised
     Return:
+        n_removed: outlier numbers (along axis)
         residue_data: outlier values will be set as nan
-        n_removed: outlier numbers
+    Note:
+        nan values are ignored when computing thresholds of 'iqr' (as nanstd/nanmean of 'std'),
+        so existed nan values do not disable outlier removal of the whole data
     """
-    residue_data = copy.copy(data)   
+    if not copy and not (isinstance(data, np.ndarray) and np.issubdtype(data.dtype, np.floating)):
+        raise Exception('Outliers could be set as nan in place only in a float array, please use copy = True')
     if meth is None:
-        residue_data = data
-        outlier_bool = np.zeros_like(residue_data, dtype=bool) 
-    elif meth == 'abs':
-        outlier_bool = ((data<thr[0])|(data>thr[1]))
-        residue_data[((residue_data<thr[0])|(residue_data>thr[1]))] = np.nan
-    elif meth == 'iqr':
-        perc_thr = np.percentile(data, [25,75])
-        f_iqr = perc_thr[1] - perc_thr[0]
-        outlier_bool = ((data < perc_thr[0] + thr[0]*f_iqr)|(data >= perc_thr[1] + thr[1]*f_iqr))
-        residue_data[outlier_bool] = np.nan
-    elif meth == 'std':
-        f_std = np.nanstd(data)
-        f_mean = np.nanmean(data)
-        outlier_bool = ((data<(f_mean+thr[0]*f_std))|(data>(f_mean+thr[1]*f_std)))
-        residue_data[(residue_data<(f_mean+thr[0]*f_std))|(residue_data>(f_mean+thr[1]*f_std))] = np.nan
+        residue_data = np.array(data, dtype = float) if copy else data
+        return np.zeros_like(np.sum(data, axis = axis), dtype = int), residue_data
+    if copy:
+        residue_data = np.array(data, dtype = float)
     else:
-        raise Exception('method should be ''iqr'' or ''abs'' or ''std''')
-    n_removed = sum(i for i in outlier_bool if i) 
+        residue_data = data
+    with warnings.catch_warnings():
+        # all-nan slices give nan thresholds and no outliers
+        warnings.simplefilter('ignore', RuntimeWarning)
+        with np.errstate(invalid = 'ignore'):
+            if meth == 'abs':
+                outlier_bool = ((residue_data<thr[0])|(residue_data>thr[1]))
+            elif meth == 'iqr':
+                perc_thr = np.nanpercentile(residue_data, [25,75], axis = axis, keepdims = axis is not None)
+                f_iqr = perc_thr[1] - perc_thr[0]
+                outlier_bool = ((residue_data < perc_thr[0] + thr[0]*f_iqr)|(residue_data >= perc_thr[1] + thr[1]*f_iqr))
+            elif meth == 'std':
+                f_std = np.nanstd(residue_data, axis = axis, keepdims = axis is not None)
+                f_mean = np.nanmean(residue_data, axis = axis, keepdims = axis is not None)
+                outlier_bool = ((residue_data<(f_mean+thr[0]*f_std))|(residue_data>(f_mean+thr[1]*f_std)))
+            else:
+                raise Exception('method should be ''iqr'' or ''abs'' or ''std''')
+    residue_data[outlier_bool] = np.nan
+    n_removed = np.count_nonzero(outlier_bool, axis = axis)
     return n_removed, residue_data
 
 def listwise_clean(data):
@@ -374,6 +428,59 @@ def listwise_clean(data):
     clean_data = pd.DataFrame(data).dropna().values
     return clean_data    
 
+def batch_patternmap(data, meth = 'correlation', chunk_size = 64, dtype = np.float32):
+    """
+    Correlation and distance matrices between regions of many subjects at once
+    Time points containing nan are removed listwise within each subject
+    ------------------------------------------------------------
+    Parameters:
+        data: data array, nsubj x ntime x nregion
+        meth: distance metric, 'correlation', 'euclidean', 'sqeuclidean' and 'cosine' are computed in batches,
+              the other metrics of scipy.spatial.distance.pdist are computed subject by subject
+        chunk_size: number of subjects computed in one batch
+        dtype: output data type, by default is float32 (values are computed in float64)
+    Return:
+        corr: condensed pearson correlation of each subject, nsubj x (nregion*(nregion-1)/2)
+        dist: condensed distance of each subject, nsubj x (nregion*(nregion-1)/2)
+    Example:
+        >>> corr, dist = batch_patternmap(data, 'correlation')
+    """
+    nsubj, ntime, nregion = data.shape
+    iu = np.triu_indices(nregion, 1)
+    corr = np.empty((nsubj, iu[0].size), dtype = dtype)
+    dist = np.empty((nsubj, iu[0].size), dtype = dtype)
+    for start in range(0, nsubj, chunk_size):
+        stop = min(start + chunk_size, nsubj)
+        chunk = np.asarray(data[start:stop], dtype = float)
+        valid = np.all(np.isfinite(chunk), axis = 2)
+        chunk = np.where(valid[...,None], chunk, 0.0)
+        n = valid.sum(axis = 1)
+        centered = (chunk - (chunk.sum(axis = 1)/n[:,None])[:,None,:])*valid[...,None]
+        cov = np.matmul(centered.transpose(0,2,1), centered)
+        var = np.diagonal(cov, axis1 = 1, axis2 = 2)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            r = cov/np.sqrt(var[:,:,None]*var[:,None,:])
+            corr[start:stop] = r[:, iu[0], iu[1]]
+            if meth == 'correlation':
+                d = 1.0 - r
+            elif meth in ('euclidean', 'sqeuclidean', 'cosine'):
+                gram = np.matmul(chunk.transpose(0,2,1), chunk)
+                sq = np.diagonal(gram, axis1 = 1, axis2 = 2)
+                if meth == 'cosine':
+                    d = 1.0 - gram/np.sqrt(sq[:,:,None]*sq[:,None,:])
+                else:
+                    d = np.maximum(sq[:,:,None] + sq[:,None,:] - 2*gram, 0.0)
+                    if meth == 'euclidean':
+                        d = np.sqrt(d)
+            else:
+                d = None
+        if d is not None:
+            dist[start:stop] = d[:, iu[0], iu[1]]
+        else:
+            for i in range(stop - start):
+                dist[start+i] = distance.pdist(chunk[i][valid[i]].T, meth)
+    return corr, dist
+
 def ste(data, axis=None):
     """
     Calculate standard error
@@ -489,7 +596,7 @@ def lin_betafit(estimator, X, y, c, tail = 'both'):
         raise Exception('wrong pointed tail.')
     return r2, beta[:,0], t, tpval, f, fpval
 
-def permutation_cross_validation(estimator, X, y, n_fold=3, isshuffle = True, cvmeth = 'shufflesplit', score_type = 'r2', n_perm = 1000):
+def permutation_cross_validation(estimator, X, y, n_fold=3, isshuffle = True, cvmeth = 'shufflesplit', score_type = 'r2', n_perm = 1000, n_jobs = None, random_state = None):
     """
     An easy way to evaluate the significance of a cross-validated score by permutations
     -------------------------------------------------
@@ -502,29 +609,79 @@ def permutation_cross_validation(estimator, X, y, n_fold=3, isshuffle = True, cv
                 shufflesplit is the random permutation cross-validation iterator
         score_type: scoring type, 'r2' as default
         n_perm: permutation numbers
+        n_jobs: number of jobs to run permutations in parallel, by default is None (one job, or the number of jobs of the joblib context)
+        random_state: random state of label permutations (and kfold shuffling)
     Return:
         score: model scores
         permutation_scores: model scores when permutation labels
         pvalues: p value of permutation scores
+    Note:
+        LinearRegression and Ridge estimators scored by 'r2' or 'neg_mean_squared_error' are computed in closed form:
+        each training fold of X is decomposed once and applied to all permuted labels together.
     """
     try:
-        from sklearn import cross_validation
+        from sklearn import preprocessing, model_selection, linear_model
     except ImportError:
         raise Exception('To call this function, please install sklearn')
     if X.ndim == 1:
         X = np.expand_dims(X, axis = 1)
-    if y.ndim == 1:
-        y = np.expand_dims(y, axis = 1)
+    if y.ndim == 2:
+        y = y[:,0]
     X = preprocessing.scale(X)
     y = preprocessing.scale(y)
     if cvmeth == 'kfold':
-        cvmethod = cross_validation.KFold(y.shape[0], n_fold, shuffle = isshuffle)
+        if isshuffle:
+            cvmethod = model_selection.KFold(n_fold, shuffle = True, random_state = random_state)
+        else:
+            cvmethod = model_selection.KFold(n_fold)
     elif cvmeth == 'shufflesplit':
         testsize = 1.0/n_fold
-        cvmethod = cross_validation.ShuffleSplit(y.shape[0], n_iter = 100, test_size = testsize, random_state = 0)
-    score, permutation_scores, pvalues = cross_validation.permutation_test_score(estimator, X, y, scoring = score_type, cv = cvmethod, n_permutations = n_perm)
+        cvmethod = model_selection.ShuffleSplit(n_splits = 100, test_size = testsize, random_state = 0)
+    else:
+        raise Exception("cvmeth should be 'kfold' or 'shufflesplit'")
+    islinear = isinstance(estimator, (linear_model.LinearRegression, linear_model.Ridge)) and \
+               estimator.fit_intercept and (not getattr(estimator, 'positive', False)) and \
+               np.isscalar(getattr(estimator, 'alpha', 0.0)) and \
+               score_type in ('r2', 'neg_mean_squared_error')
+    if islinear:
+        rng = np.random.RandomState(random_state)
+        y_perm = np.empty((y.shape[0], n_perm+1))
+        y_perm[:,0] = y
+        for i in range(n_perm):
+            y_perm[:,i+1] = y[rng.permutation(y.shape[0])]
+        alpha = getattr(estimator, 'alpha', 0.0)
+        scores = np.zeros(n_perm+1)
+        folds = list(cvmethod.split(X))
+        for train, test in folds:
+            scores += _linear_cvscore(X[train], y_perm[train], X[test], y_perm[test], alpha, score_type)
+        scores /= len(folds)
+        score = scores[0]
+        permutation_scores = scores[1:]
+        pvalues = (np.sum(permutation_scores >= score) + 1.0)/(n_perm + 1)
+    else:
+        score, permutation_scores, pvalues = model_selection.permutation_test_score(estimator, X, y, scoring = score_type, cv = cvmethod, n_permutations = n_perm, n_jobs = n_jobs, random_state = random_state)
     return score, permutation_scores, pvalues
 
+def _linear_cvscore(X_train, Y_train, X_test, Y_test, alpha, score_type):
+    """
+    Test scores of (ridge) least squares for all columns of Y at once, with intercept
+    """
+    xmean = X_train.mean(axis = 0)
+    ymean = Y_train.mean(axis = 0)
+    Xc = X_train - xmean
+    if alpha == 0:
+        solver = np.linalg.pinv(Xc)
+    else:
+        solver = np.linalg.solve(np.dot(Xc.T, Xc) + alpha*np.eye(Xc.shape[1]), Xc.T)
+    beta = np.dot(solver, Y_train - ymean)
+    Y_pred = np.dot(X_test - xmean, beta) + ymean
+    sse = np.sum((Y_test - Y_pred)**2, axis = 0)
+    if score_type == 'r2':
+        sst = np.sum((Y_test - Y_test.mean(axis = 0))**2, axis = 0)
+        return 1 - sse/sst
+    else:
+        return -1.0*sse/Y_test.shape[0]
+
 class PCorrection(object):
     """
     Multiple comparison correction
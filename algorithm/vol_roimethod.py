@@ -14,21 +14,39 @@ def make_pm(mask, meth = 'all'):
               part, part subjects are taken into account
     Return:
         pm = probabilistic map
+    Note:
+        mask could be a chunked store (iofunc.chunkstore.ChunkStore), subject blocks are read one by one
     """
     if mask.ndim != 4:
         raise Exception('Masks should be a 4D nifti file contains subjects')
-    labels = np.unique(mask)[1:]
-    pm = np.empty((mask.shape[0], mask.shape[1], mask.shape[2], labels.shape[0]))
-    if meth == 'all':
-        for i in range(labels.shape[0]):
-            pm[..., i] = np.mean(mask == labels[i], axis = 3)
-    elif meth == 'part':
-        for i in range(labels.shape[0]):
-            mask_i = mask == labels[i]
-            subj = np.any(mask_i, axis = (0,1,2))
-            pm[..., i] = np.mean(mask_i[..., subj], axis = 3)
-    else:
+    if meth not in ['all', 'part']:
         raise Exception('method not supported')
+    if hasattr(mask, 'iter_chunks'):
+        blocks = (block for _, block in mask.iter_chunks('subject'))
+    else:
+        blocks = [mask]
+    counts = {}
+    nsubj = {}
+    for block in blocks:
+        # a block may contain no background, so drop label 0 by value rather than by position
+        lbl_block = np.unique(block)
+        for lbl in lbl_block[lbl_block != 0]:
+            mask_i = block == lbl
+            if lbl not in counts:
+                counts[lbl] = np.zeros(mask.shape[:3])
+                nsubj[lbl] = 0
+            counts[lbl] += np.sum(mask_i, axis = 3)
+            if meth == 'all':
+                nsubj[lbl] += block.shape[3]
+            else:
+                nsubj[lbl] += np.count_nonzero(np.any(mask_i, axis = (0,1,2)))
+    labels = np.sort(list(counts.keys()))
+    pm = np.empty((mask.shape[0], mask.shape[1], mask.shape[2], labels.shape[0]))
+    for i in range(labels.shape[0]):
+        if meth == 'all':
+            pm[..., i] = counts[labels[i]]/mask.shape[3]
+        else:
+            pm[..., i] = counts[labels[i]]/nsubj[labels[i]]
     return pm
         
 def make_mpm(pm, threshold):
@@ -1,58 +1,167 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
 # vi: set ft=python sts=4 sw=4 et:
 
+import functools
 import numpy as np
 
+def _affine_transform(coords, affine):
+    coords = np.asarray(coords, dtype = float)
+    return np.dot(coords, affine[:3,:3].T) + affine[:3,3]
+
+@functools.lru_cache(maxsize = 32)
+def _cached_inverse(affine_bytes):
+    inv_affine = np.linalg.inv(np.frombuffer(affine_bytes, dtype = float).reshape(4, 4))
+    inv_affine.setflags(write = False)
+    return inv_affine
+
+def inverse_affine(affine):
+    """
+    Inverse of affine matrix, cached for repeated calls with the same affine
+    """
+    return _cached_inverse(np.ascontiguousarray(affine, dtype = float).tobytes())
+
 def vox2MNI(vox, affine):
     """
     Voxel coordinates transformed to MNI coordinates
     ------------------------------------------------
     Parameters:
-        vox: voxel coordinates
+        vox: voxel coordinates, 3 elements or N x 3 (any leading dimensions)
         affine: affine matrix
     Return:
-        mni
+        mni, with the same shape as vox
     """
-    vox = np.append(vox, 1)
-    mni = np.dot(affine, vox)
-    return mni[:3]
+    return _affine_transform(vox, np.asarray(affine, dtype = float))
 
 def MNI2vox(mni, affine):
     """
     MNI coordintes transformed to voxel coordinates
     ----------------------------------------------
     Parameters:
-        mni: mni coordinates
+        mni: mni coordinates, 3 elements or N x 3 (any leading dimensions)
         affine: affine matrix
     Return:
-        vox
+        vox, with the same shape as mni
     """
-    mni = np.append(mni,1)
-    vox = np.dot(mni, np.linalg.inv(affine.T))
-    return vox[:3]
+    return _affine_transform(mni, inverse_affine(affine))
 
+def _label_codes(mask, labelnum):
+    """
+    Codes of (subject, label) of each voxel in a 3D/4D mask, subject x (labelnum+1) + label.
+    Voxels with label out of 1...labelnum (or non-integer) are coded as -1
+    """
+    if mask.ndim == 3:
+        mask = np.expand_dims(mask, axis = 3)
+    nsubj = mask.shape[3]
+    labels = np.moveaxis(mask, 3, 0).reshape(nsubj, -1)
+    valid = (labels >= 1) & (labels <= labelnum) & (labels == np.round(labels))
+    codes = np.where(valid, np.arange(nsubj)[:,None]*(labelnum+1) + labels.astype(np.int64, copy = False), -1)
+    return codes.ravel(), nsubj
+
+def _default_labelnum(mask, labelnum):
+    if labelnum is None:
+        labelnum = int(np.max(mask)) if np.size(mask) else 0
+    return int(labelnum)
 
-def get_masksize(mask):
+def get_masksize(mask, labelnum = None):
     """
-    Compute mask size
+    Compute mask size, all labels and subjects are counted in one pass
     -------------------------------------
     Parameters:
-        mask: mask.
+        mask: mask, 3D or 4D (subjects stacked in the 4th dimension)
+        labelnum: label numbers in total, by default is None (the maximum label)
     Return:
-        masksize: mask size of each roi
+        masksize: mask size of each roi, nsubj x nlabel. nan if a label is not in a subject.
     """
-    labels = np.unique(mask)[1:]
-    if mask.ndim == 3:
-        mask = np.expand_dims(mask, axis = 3)
-    masksize = np.empty((mask.shape[3], int(np.max(labels))))
-    for i in range(mask.shape[3]):
-        for j in range(int(np.max(labels))):
-            if np.any(mask[...,i] == j+1):
-                masksize[i, j] = np.sum(mask[...,i] == j+1)
-            else:
-                masksize[i, j] = np.nan
+    labelnum = _default_labelnum(mask, labelnum)
+    codes, nsubj = _label_codes(mask, labelnum)
+    masksize = np.bincount(codes[codes >= 0], minlength = nsubj*(labelnum+1)).reshape(nsubj, labelnum+1)[:,1:].astype(float)
+    masksize[masksize == 0] = np.nan
     return masksize
 
+def get_centroids(mask, labelnum = None, weights = None):
+    """
+    Centroid (voxel coordinate) of each roi of each subject
+    -------------------------------------
+    Parameters:
+        mask: mask, 3D or 4D (subjects stacked in the 4th dimension)
+        labelnum: label numbers in total, by default is None (the maximum label)
+        weights: weight of each voxel (e.g. activation image), same shape as mask, by default is None (unweighted)
+    Return:
+        centroids: voxel coordinates, nsubj x nlabel x 3. nan if a label is not in a subject.
+    """
+    labelnum = _default_labelnum(mask, labelnum)
+    codes, nsubj = _label_codes(mask, labelnum)
+    # coordinates are derived from flat indices of labeled voxels only
+    valid = np.flatnonzero(codes >= 0)
+    nvox = int(np.prod(mask.shape[:3]))
+    voxloc = np.unravel_index(valid % nvox, mask.shape[:3])
+    codes = codes[valid]
+    if weights is None:
+        weights = np.ones(codes.size)
+    else:
+        weights = np.asarray(weights, dtype = float)
+        if weights.ndim == 3:
+            weights = weights[voxloc]
+        else:
+            weights = weights[voxloc + (valid // nvox,)]
+    nbin = nsubj*(labelnum+1)
+    total = np.bincount(codes, weights = weights, minlength = nbin)
+    centroids = np.empty((nbin, 3))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        for axis in range(3):
+            centroids[:, axis] = np.bincount(codes, weights = weights*voxloc[axis], minlength = nbin)/total
+    centroids[np.bincount(codes, minlength = nbin) == 0] = np.nan
+    return centroids.reshape(nsubj, labelnum+1, 3)[:,1:]
+
+def get_peaks(atlas, mask, labelnum = None):
+    """
+    Peak (voxel with maximum value of atlas) of each roi of each subject.
+    Voxels are sorted by (subject, label) codes, maximum of each segment is got by reduceat.
+    -------------------------------------
+    Parameters:
+        atlas: value image, 3D or 4D. 3D atlas is shared by subjects of a 4D mask
+        mask: mask, 3D or 4D. 3D mask is shared by subjects of a 4D atlas
+        labelnum: label numbers in total, by default is None (the maximum label)
+    Return:
+        peaks: voxel coordinates of peaks, nsubj x nlabel x 3. nan if a label is not in a subject.
+        peakvalues: values of peaks, nsubj x nlabel
+    """
+    labelnum = _default_labelnum(mask, labelnum)
+    if atlas.ndim == 4 and mask.ndim == 3:
+        mask = np.broadcast_to(mask[...,None], atlas.shape)
+    if atlas.ndim == 3 and mask.ndim == 4:
+        atlas = np.broadcast_to(atlas[...,None], mask.shape)
+    if atlas.shape[:3] != mask.shape[:3] or np.ndim(atlas) != np.ndim(mask):
+        raise Exception('atlas and mask should have the same shape')
+    codes, nsubj = _label_codes(mask, labelnum)
+    if atlas.ndim == 3:
+        values = atlas.ravel()
+    else:
+        values = np.moveaxis(atlas, 3, 0).ravel()
+    voxel = np.flatnonzero(codes >= 0)
+    codes = codes[voxel]
+    values = values[voxel]
+    order = np.argsort(codes, kind = 'stable')
+    codes = codes[order]
+    values = values[order]
+    voxel = voxel[order]
+    nbin = nsubj*(labelnum+1)
+    peaks = np.full((nbin, 3), np.nan)
+    peakvalues = np.full(nbin, np.nan)
+    if codes.size:
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(codes)) + 1))
+        segmax = np.fmax.reduceat(values, starts)
+        # the first voxel reaching segment maximum, voxels keep their original order inside segments
+        seglength = np.diff(np.append(starts, codes.size))
+        ismax = np.flatnonzero(values == np.repeat(segmax, seglength))
+        segment = np.searchsorted(starts, ismax, side = 'right') - 1
+        _, first = np.unique(segment, return_index = True)
+        found = segment[first]
+        nvox = int(np.prod(mask.shape[:3]))
+        peaks[codes[starts[found]]] = np.transpose(np.unravel_index(voxel[ismax[first]] % nvox, mask.shape[:3]))
+        peakvalues[codes[starts]] = segmax
+    return peaks.reshape(nsubj, labelnum+1, 3)[:,1:], peakvalues.reshape(nsubj, labelnum+1)[:,1:]
+
 def get_signals(atlas, mask, method = 'mean', labelnum = None):
     """
     Extract roi signals of atlas
@@ -84,7 +193,7 @@ def get_signals(atlas, mask, method = 'mean', labelnum = None):
         raise Exception('Method contains mean or std or peak')
     for i in range(labelnum):
         loc_raw = np.where(mask == (i+1))
-        roiloc = zip(loc_raw[0], loc_raw[1], loc_raw[2])
+        roiloc = list(zip(loc_raw[0], loc_raw[1], loc_raw[2]))
         roisignal = [atlas[roiloc[i]] for i in range(len(roiloc))]
         if np.any(roisignal):
             signals.append(roisignal)
@@ -98,39 +207,30 @@ def get_coordinate(atlas, mask, size = [2,2,2], method = 'peak', labelnum = None
     Extract peak/center coordinate of rois
     --------------------------------------------
     Parameters:
-        atlas: atlas
-        mask: roi mask.
-        size: voxel size
+        atlas: atlas, 3D or 4D (subjects stacked in the 4th dimension)
+        mask: roi mask, 3D or 4D
+        size: voxel size (3 elements, coordinates are scaled by it) or a 4x4 affine matrix (transformed into MNI coordinates)
         method: 'peak' or 'center'
         labelnum: mask label numbers in total, by default is None, set parameters if you want to do group analysis
     Return:
-        coordinates: nroi x 3 for activation data
+        coordinates: nroi x 3 for activation data (nsubj x nroi x 3 if atlas or mask is 4D)
                      Note that do not extract coordinate of resting data
     """
-    labels = np.unique(mask)[1:]
-    if labelnum is None:
-        labelnum = np.max(labels)
-    coordinate = np.empty((labelnum, 3))
-
-    extractpeak = lambda x: np.unravel_index(x.argmax(), x.shape)
-    extractcenter = lambda x: np.mean(np.transpose(np.nonzero(x)))
-
+    labelnum = _default_labelnum(mask, labelnum)
     if method == 'peak':
-        calfunc = extractpeak
+        coordinate = get_peaks(atlas, mask, labelnum)[0]
     elif method == 'center':
-        calfunc = extractcenter
+        coordinate = get_centroids(mask, labelnum)
+        if atlas.ndim == 4 and mask.ndim == 3:
+            coordinate = np.repeat(coordinate, atlas.shape[3], axis = 0)
     else:
         raise Exception('Method contains peak or center')
-    for i in range(labelnum):
-        roisignal = atlas*(mask == (i+1))
-        if np.any(roisignal):
-            coordinate[i,:] = calfunc(roisignal)
-            coordinate[i,:] = vox2MNI(coordinate[i,:], size)
-        else:
-            coordinate[i,:] = np.array([np.nan, np.nan, np.nan])
+    size = np.asarray(size, dtype = float)
+    if size.shape == (4, 4):
+        coordinate = vox2MNI(coordinate, size)
+    else:
+        coordinate = coordinate*size
+    if atlas.ndim == 3 and mask.ndim == 3:
+        coordinate = coordinate[0]
     return coordinate
 
-
-
-
-
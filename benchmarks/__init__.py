@@ -0,0 +1,19 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+Benchmarks of toolbox hot paths on synthetic data, run offline
+
+Modules
+------------
+generators: synthetic label volumes, label stacks, icosphere meshes and time series
+suite: benchmark cases
+run: command line runner, records time and memory into a json history and compares with a baseline
+
+Usage:
+    $ python -m ATT.benchmarks.run --quick
+    $ python -m ATT.benchmarks.run --save-baseline
+    $ python -m ATT.benchmarks.run --compare
+"""
+
+__all__ = []
@@ -0,0 +1,107 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+
+MNI_2MM = (91, 109, 91)
+
+def brain_mask(shape = MNI_2MM):
+    """
+    An ellipsoid roughly covering the brain in a volume
+    """
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    dist = sum(((g - (s-1)/2.0)/(0.45*s))**2 for g, s in zip(grid, shape))
+    return dist <= 1
+
+def label_volume(nlabel, shape = MNI_2MM, radius = 4, seed = 0):
+    """
+    Random label volume, nlabel spheres centered in brain mask
+    --------------------------------------
+    Parameters:
+        nlabel: label number
+        shape: volume shape, by default is 2mm MNI shape
+        radius: sphere radius (voxel)
+        seed: random seed
+    Return:
+        labelvol: int32 volume with labels 1...nlabel, later labels overwrite earlier ones
+    """
+    rng = np.random.RandomState(seed)
+    inside = np.argwhere(brain_mask(shape))
+    centers = inside[rng.choice(inside.shape[0], nlabel, replace = False)]
+    labelvol = np.zeros(shape, dtype = np.int32)
+    for label, center in enumerate(centers):
+        box = tuple(slice(max(c-radius, 0), min(c+radius+1, s)) for c, s in zip(center, shape))
+        dist = sum((g - c)**2 for g, c in zip(np.ogrid[box], center))
+        labelvol[box][dist <= radius**2] = label+1
+    return labelvol
+
+def label_stack(nsubj, nlabel, shape = MNI_2MM, radius = 4, jitter = 2, seed = 0):
+    """
+    Multi-subject label stack, labels of the same number are jittered around common positions
+    --------------------------------------
+    Parameters:
+        nsubj: subject number
+        nlabel: label number
+        shape: volume shape
+        radius: sphere radius (voxel)
+        jitter: maximum shift of each subject (voxel)
+        seed: random seed
+    Return:
+        stack: int32 array, shape + (nsubj,)
+    """
+    rng = np.random.RandomState(seed)
+    template = label_volume(nlabel, shape, radius, seed)
+    stack = np.zeros(tuple(shape) + (nsubj,), dtype = np.int32)
+    for i in range(nsubj):
+        shift = rng.randint(-jitter, jitter+1, 3)
+        stack[..., i] = np.roll(template, shift, axis = (0, 1, 2))
+    return stack
+
+def value_volume(shape = MNI_2MM, nvol = None, seed = 0):
+    """
+    Random float32 volume (activation map), or 4D data if nvol is given
+    """
+    rng = np.random.RandomState(seed)
+    if nvol is not None:
+        shape = tuple(shape) + (nvol,)
+    return rng.standard_normal(shape).astype(np.float32)
+
+def timeseries(nseries, ntime, seed = 0):
+    """
+    Random time series, nseries x ntime
+    """
+    return np.random.RandomState(seed).standard_normal((nseries, ntime))
+
+def icosphere(subdivision = 5, radius = 100.0):
+    """
+    Icosphere mesh, subdivision 5 gives 10242 vertices, 6 gives 40962 vertices (similar to a 32k surface)
+    --------------------------------------
+    Parameters:
+        subdivision: times of subdivision
+        radius: sphere radius
+    Return:
+        coords: vertex coordinates, nvertex x 3 (float32)
+        faces: triangles, nface x 3 (int32)
+    """
+    t = (1.0 + np.sqrt(5.0))/2.0
+    coords = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                       [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                       [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype = np.float64)
+    faces = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+                      [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+                      [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+                      [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]], dtype = np.int64)
+    for _ in range(subdivision):
+        # midpoint of each unique edge becomes a new vertex
+        edges = np.concatenate((faces[:,[0,1]], faces[:,[1,2]], faces[:,[2,0]]))
+        edges.sort(axis = 1)
+        uniq, inverse = np.unique(edges[:,0]*coords.shape[0] + edges[:,1], return_inverse = True)
+        a, b = np.divmod(uniq, coords.shape[0])
+        midpoint = coords.shape[0] + inverse.reshape(3, -1).T
+        coords = np.concatenate((coords, (coords[a] + coords[b])/2.0))
+        v0, v1, v2 = faces.T
+        m01, m12, m20 = midpoint.T
+        faces = np.concatenate((np.stack((v0, m01, m20), axis = 1), np.stack((v1, m12, m01), axis = 1),
+                                np.stack((v2, m20, m12), axis = 1), np.stack((m01, m12, m20), axis = 1)))
+    coords = radius*coords/np.linalg.norm(coords, axis = 1)[:,None]
+    return coords.astype(np.float32), faces.astype(np.int32)
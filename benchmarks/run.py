@@ -0,0 +1,189 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+
+from ATT.benchmarks import suite
+from ATT.util import instrument
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+# records are kept out of the source tree, in a user cache directory
+RECORD_PATH = os.environ.get('ATT_BENCHMARK_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ATT', 'benchmarks'))
+HISTORY_FILE = os.path.join(RECORD_PATH, 'history.json')
+BASELINE_FILE = os.path.join(RECORD_PATH, 'baseline.json')
+
+def _git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = BENCH_PATH, stderr = subprocess.DEVNULL)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    """
+    Machine and library information of a run
+    """
+    import scipy
+    return {'machine': platform.machine(),
+            'processor': platform.processor(),
+            'system': platform.platform(),
+            'node': platform.node(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'commit': _git_commit()}
+
+def measure(case, size, repeat = 3):
+    """
+    Time a case of one size.
+    The first run is traced by tracemalloc for peak memory (and not timed), then it is timed repeat times.
+    --------------------------------------
+    Return:
+        result: {'time_min', 'time_median', 'times', 'peak_memory'}
+    """
+    args = case.setup(size)
+    sink = instrument.MemorySink(level = 3)
+    instrument.add_sink(sink)
+    tracing = tracemalloc.is_tracing()
+    instrument.track_memory(True)
+    try:
+        with instrument.stage(case.key(size), level = 3):
+            case.run(*args)
+    finally:
+        instrument.track_memory(tracing)
+        instrument.remove_sink(sink)
+    peak = sink.records[-1]['peak_memory'] if sink.records else None
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case.run(*args)
+        times.append(time.perf_counter() - start)
+    return {'time_min': min(times), 'time_median': float(np.median(times)), 'times': times, 'peak_memory': peak}
+
+def run(pattern = None, quick = False, repeat = 3):
+    """
+    Run benchmark cases
+    --------------------------------------
+    Parameters:
+        pattern: only run cases whose name contains pattern, by default all cases
+        quick: run the smallest sizes only (quick sizes of cases), once for each
+        repeat: timed runs of each case
+    Return:
+        record: {'timestamp', 'environment', 'quick', 'results': {case[size]: result}}
+    """
+    if quick:
+        repeat = 1
+    results = {}
+    for case in suite.select(pattern):
+        for size in (case.quick if quick else case.sizes):
+            instrument.progress('running {}'.format(case.key(size)))
+            results[case.key(size)] = measure(case, size, repeat)
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(), 'quick': quick, 'results': results}
+
+def load_json(filename, default = None):
+    if not os.path.exists(filename):
+        return default
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def save_json(data, filename):
+    dirname = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(data, f, indent = 1)
+    os.replace(tmpfile, filename)
+
+def append_history(record, filename = HISTORY_FILE):
+    """
+    Append a run into json history (a list of runs)
+    """
+    history = load_json(filename, [])
+    history.append(record)
+    save_json(history, filename)
+
+def compare(record, baseline, threshold = 1.2):
+    """
+    Compare minimum time of a run with a baseline run
+    --------------------------------------
+    Parameters:
+        record: current run
+        baseline: baseline run
+        threshold: ratio (current/baseline) above which a case is a regression, below 1/threshold an improvement
+    Return:
+        rows: list of (case, baseline time, current time, ratio, status)
+    """
+    rows = []
+    for key, result in record['results'].items():
+        if key not in baseline['results']:
+            rows.append((key, None, result['time_min'], None, 'new'))
+            continue
+        base = baseline['results'][key]['time_min']
+        ratio = result['time_min']/base if base > 0 else np.inf
+        if ratio > threshold:
+            status = 'regression'
+        elif ratio < 1.0/threshold:
+            status = 'improvement'
+        else:
+            status = 'same'
+        rows.append((key, base, result['time_min'], ratio, status))
+    return rows
+
+def _format_memory(nbytes):
+    return '-' if nbytes is None else '{0:.1f}MB'.format(nbytes/1048576.0)
+
+def report(record, rows = None):
+    lines = ['{0:<40} {1:>10} {2:>10} {3:>10}'.format('case', 'min(s)', 'median(s)', 'peak mem')]
+    for key, result in record['results'].items():
+        lines.append('{0:<40} {1:>10.4f} {2:>10.4f} {3:>10}'.format(key, result['time_min'], result['time_median'], _format_memory(result['peak_memory'])))
+    if rows is not None:
+        lines.append('')
+        lines.append('{0:<40} {1:>10} {2:>10} {3:>8} {4}'.format('case', 'base(s)', 'now(s)', 'ratio', 'status'))
+        for key, base, now, ratio, status in rows:
+            lines.append('{0:<40} {1:>10} {2:>10.4f} {3:>8} {4}'.format(key, '-' if base is None else '{:.4f}'.format(base), now, '-' if ratio is None else '{:.2f}'.format(ratio), status))
+    return '\n'.join(lines)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmarks of ATT hot paths on synthetic data')
+    parser.add_argument('-k', '--filter', default = None, help = 'only run cases whose name contains this string')
+    parser.add_argument('--quick', action = 'store_true', help = 'smallest sizes, one run each')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'timed runs of each case')
+    parser.add_argument('--history', default = HISTORY_FILE, help = 'json history file')
+    parser.add_argument('--no-history', action = 'store_true', help = 'do not record this run')
+    parser.add_argument('--baseline', default = BASELINE_FILE, help = 'baseline json file')
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'save this run as baseline')
+    parser.add_argument('--compare', action = 'store_true', help = 'compare this run with baseline')
+    parser.add_argument('--threshold', type = float, default = 1.2, help = 'time ratio regarded as regression')
+    parser.add_argument('--fail-on-regression', action = 'store_true', help = 'exit with 1 if any case regresses')
+    args = parser.parse_args(argv)
+
+    record = run(args.filter, args.quick, args.repeat)
+    if not args.no_history:
+        append_history(record, args.history)
+    rows = None
+    if args.compare:
+        baseline = load_json(args.baseline)
+        if baseline is None:
+            raise Exception('Baseline {} not found, run with --save-baseline first.'.format(args.baseline))
+        if baseline['environment'].get('node') != record['environment']['node']:
+            instrument.progress('Warning: baseline was recorded on another machine ({}).'.format(baseline['environment'].get('node')))
+        rows = compare(record, baseline, args.threshold)
+    if args.save_baseline:
+        save_json(record, args.baseline)
+    print(report(record, rows))
+    if args.fail_on_regression and rows is not None and any(row[4] == 'regression' for row in rows):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+
+from ATT.algorithm import vol_tools, vol_roimethod, surf_tools, tools
+from ATT.benchmarks import generators
+
+class Case(object):
+    """
+    A benchmark case, a function timed on synthetic data of several sizes
+    --------------------------------------
+    Parameters:
+        name: case name
+        setup: setup(size) returns arguments of run, not timed
+        run: run(*args) is timed
+        sizes: sizes of data
+        quick: sizes used in quick mode, by default the first one
+    """
+    def __init__(self, name, setup, run, sizes, quick = None):
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.sizes = list(sizes)
+        self.quick = list(quick) if quick is not None else self.sizes[:1]
+
+    def key(self, size):
+        return '{0}[{1}]'.format(self.name, size)
+
+def _setup_get_signals(nlabel):
+    return generators.value_volume(), generators.label_volume(nlabel)
+
+def _run_get_signals(atlas, mask):
+    return vol_tools.get_signals(atlas, mask, 'mean')
+
+def _setup_make_pm(nsubj):
+    return (generators.label_stack(nsubj, 20),)
+
+def _run_make_pm(stack):
+    return vol_roimethod.make_pm(stack, 'all')
+
+def _setup_surf_dist(subdivision):
+    coords, faces = generators.icosphere(subdivision)
+    ring = surf_tools.get_n_ring_neighbor(faces, 1)
+    # antipodal vertices, the longest distance on sphere
+    src = 0
+    dst = int(np.argmin(coords.dot(coords[src])))
+    return src, dst, ring
+
+def _run_surf_dist(src, dst, ring):
+    return surf_tools.surf_dist(src, dst, ring)
+
+def _setup_threshold_by_number(nvox):
+    return generators.value_volume(), nvox
+
+def _run_threshold_by_number(imgdata, nvox):
+    return tools.threshold_by_number(imgdata, nvox, 'number', 'descend')
+
+def _setup_pearsonr(nseries):
+    return generators.timeseries(100, 1200, seed = 0), generators.timeseries(nseries, 1200, seed = 1)
+
+def _run_pearsonr(A, B):
+    return tools.pearsonr(A, B)
+
+CASES = [Case('vol_tools.get_signals', _setup_get_signals, _run_get_signals, [10, 100]),
+         Case('vol_roimethod.make_pm', _setup_make_pm, _run_make_pm, [10, 50]),
+         Case('surf_tools.surf_dist', _setup_surf_dist, _run_surf_dist, [4, 5, 6], quick = [4]),
+         Case('tools.threshold_by_number', _setup_threshold_by_number, _run_threshold_by_number, [100, 1000]),
+         Case('tools.pearsonr', _setup_pearsonr, _run_pearsonr, [1000, 20000])]
+
+def select(pattern = None):
+    """
+    Cases whose name contains pattern, by default all cases
+    """
+    return [case for case in CASES if pattern is None or pattern in case.name]
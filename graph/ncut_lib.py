@@ -1,9 +1,12 @@
 #! /usr/bin/env python
 # coding=utf-8
 
+import multiprocessing
 import numpy as np
-from scipy import sparse, rand, linalg
-from scipy.sparse.linalg import eigsh
+from scipy import sparse, linalg
+from scipy.sparse.linalg import eigsh, lobpcg, spilu, LinearOperator
+
+from ATT.algorithm import tools, surf_tools
 
 def generate_weight_matrix(N):
     """
@@ -14,7 +17,7 @@ def generate_weight_matrix(N):
     m = np.random.rand(N,N)
     m = np.triu(m)
     m += m.T - 2*np.diag(m.diagonal())
-    return m    
+    return m
 
 
 class SVDError(Exception):
@@ -23,7 +26,26 @@ class SVDError(Exception):
     def __str__(self):
         return repr(self.value)
 
-def ncut(w, neig_values):
+def _normalized_affinity(w):
+    """
+    Normalized affinity D^(-1/2)*(W+Dr)*D^(-1/2) used by ncut, with its scaling D^(-1/2)
+    """
+    offset = 0.5
+    eps = 2.2204e-16
+    m = w.shape[1]
+    w = sparse.csr_matrix(w, dtype=float)
+    d = np.asarray(abs(w).sum(0)).ravel()
+    dr = 0.5*(d-np.asarray(w.sum(0)).ravel())
+    d = d+offset*2
+    dr = dr+offset
+
+    # the normalized laplacian
+    w = w+sparse.spdiags(dr, [0], m, m, "csr")
+    d_invsqrt = 1.0/np.sqrt(d+eps)
+    p = sparse.csr_matrix(w.multiply(d_invsqrt[:,None]).multiply(d_invsqrt[None,:]))
+    return p, d_invsqrt
+
+def ncut(w, neig_values, maxiters = None, tol = 1e-6, method = 'eigsh', v0 = None, seed = None):
     """
     Normalized cut spectral clustering
     w is simiarity matrix
@@ -31,134 +53,381 @@ def ncut(w, neig_values):
 
     Parameters:
     ----------
-    w: symmetric similarity matrix
+    w: symmetric similarity matrix, dense array or scipy sparse matrix
     neig_values: number of eigenvector that should be calculated
+    maxiters: maximum iterations of the eigen solver, by default is None (solver default)
+    tol: tolerance of the eigen solver
+    method: 'eigsh' or 'lobpcg'
+            'eigsh', shift-invert Lanczos on the normalized laplacian, suited to sparse mesh graphs
+            'lobpcg', block solver preconditioned by incomplete LU, could be warm started by a block of vectors
+    v0: warm start, eigenvectors from a previous decomposition (n x k), by default is None
+    seed: random seed of the initial vectors
 
     Return:
     -------
-    eigen_val: eigenvalues from the eigen decomposition of the LaPlacian of W 
+    eigen_val: eigenvalues from the eigen decomposition of the LaPlacian of W
     eigen_vec: eigenvectors from the eign decomposition of the LaPlacian of W
     """
-    offset = 0.5
-    maxiters = 100
-    eigsErrorTolerence = 1e-6
-    eps = 2.2204e-16
-
-    m = w.shape[1]
-
-    d = np.abs(w).sum(0)
-    dr = 0.5*(d-w.sum(0))
-    d = d+offset*2
-    dr = dr+offset
-
-    # the normalized laplacian
-    w = w+sparse.spdiags(dr, [0], m, m, "csc")
-    d_invsqrt = sparse.spdiags((1.0/np.sqrt(d+eps)), [0], m, m, "csc")
-    p = d_invsqrt*(w*d_invsqrt)
+    p, d_invsqrt = _normalized_affinity(w)
+    m = p.shape[0]
+    rng = np.random.default_rng(seed)
+    # eigenvectors of p with the largest eigenvalues are
+    # eigenvectors of the laplacian I-p with the smallest eigenvalues
+    lap = (sparse.identity(m, format='csc') - p).tocsc()
 
     # the eigen decomposition
-    eigen_val, eigen_vec = eigsh(p, neig_values, maxiter = maxiters, tol = 1e-6, which='LA')
-    
+    if method == 'eigsh':
+        if v0 is not None:
+            start = np.asarray(v0).sum(axis=1) if np.ndim(v0) == 2 else np.asarray(v0)
+        else:
+            start = rng.uniform(-1, 1, m)
+        lap_val, eigen_vec = eigsh(lap, neig_values, sigma=-1e-3, which='LM', maxiter=maxiters, tol=tol, v0=start)
+    elif method == 'lobpcg':
+        x = rng.standard_normal((m, neig_values))
+        if v0 is not None:
+            v0 = np.asarray(v0)[:, :neig_values]
+            x[:, :v0.shape[1]] = v0
+        ilu = spilu((lap + 1e-3*sparse.identity(m)).tocsc(), drop_tol=1e-4, fill_factor=10)
+        precond = LinearOperator((m, m), matvec=ilu.solve, matmat=ilu.solve)
+        lap_val, eigen_vec = lobpcg(lap, x, M=precond, tol=tol, maxiter=maxiters if maxiters is not None else 200, largest=False)
+    else:
+        raise Exception("method should be 'eigsh' or 'lobpcg'")
+    eigen_val = 1.0 - lap_val
+
     i = np.argsort(-eigen_val)
     eigen_val = eigen_val[i]
     eigen_vec = eigen_vec[:,i]
 
     # normalize the returned eigenvectors
-    eigen_vec = d_invsqrt*np.matrix(eigen_vec)
-    norm_ones = linalg.norm(np.ones((m,1)))
+    eigen_vec = d_invsqrt[:,None]*eigen_vec
+    eigen_vec = eigen_vec/linalg.norm(eigen_vec, axis=0)*np.sqrt(m)
+    sign = np.sign(eigen_vec[0,:])
+    sign[sign == 0] = -1
+    eigen_vec = -1*eigen_vec*sign
 
-    for i in range(0, eigen_vec.shape[1]):
-        eigen_vec[:,i] = (eigen_vec[:,i]/linalg.norm(eigen_vec[:,i]))*norm_ones
-        if eigen_vec[0,i] != 0:
-            eigen_vec[:,i] = -1*eigen_vec[:,i]*np.sign(eigen_vec[0,i])
-    
     return eigen_val, eigen_vec
 
-def discretisation(eigen_vec):
+def _discretise_once(eigen_vec, rng, maxiter):
+    """
+    One random start of discretisation, rows of eigen_vec should be normalized
+    """
+    eps = 2.2204e-16
+    n, k = eigen_vec.shape
+    R = np.zeros((k,k))
+    R[:,0] = eigen_vec[rng.integers(n),:]
+    c = np.zeros(n)
+    for j in range(1,k):
+        c += np.abs(np.dot(eigen_vec, R[:,j-1]))
+        R[:,j] = eigen_vec[c.argmin(),:]
+
+    last_objvalue = 0
+    rows = np.arange(n)
+    for n_iter_discrete in range(maxiter+1):
+        j = np.argmax(np.dot(eigen_vec, R), axis=1)
+        # cluster sums of eigenvectors, i.e. discrete.T * eigen_vec
+        tSVD = sparse.csr_matrix((np.ones(n), (j, rows)), shape=(k,n)).dot(eigen_vec)
+        U, S, Vh = linalg.svd(tSVD)
+        NcutValue = 2*(n-S.sum())
+        # test for convergence
+        if np.abs(NcutValue - last_objvalue) < eps:
+            break
+        last_objvalue = NcutValue
+        R = np.dot(Vh.T, U.T)
+    eigenvec_discrete = sparse.csc_matrix((np.ones(n), (rows, j)), shape=(n,k))
+    return eigenvec_discrete, NcutValue
+
+def _discretise_seed(eigen_vec, seed, maxiter):
+    """
+    Discretisation from a seed, retry with new random starts when svd does not converge
+    """
+    rng = np.random.default_rng(seed)
+    for svd_restarts in range(30):
+        try:
+            return _discretise_once(eigen_vec, rng, maxiter)
+        except linalg.LinAlgError:
+            continue
+    raise SVDError("SVD didn't converge after 30 retries")
+
+_pool_state = {}
+
+def _pool_init(eigen_vec, maxiter):
+    _pool_state['eigen_vec'] = eigen_vec
+    _pool_state['maxiter'] = maxiter
+
+def _pool_discretise(seed):
+    return _discretise_seed(_pool_state['eigen_vec'], seed, _pool_state['maxiter'])
+
+def _seed_sequence(seed):
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+def _normalize_rows(eigen_vec):
+    eps = 2.2204e-16
+    eigen_vec = np.asarray(eigen_vec, dtype=float)
+    return eigen_vec/(np.sqrt(np.sum(eigen_vec**2, axis=1))[:,None]+eps)
+
+def discretisation(eigen_vec, n_init = 1, seed = None, n_jobs = 1, maxiter = 20):
     """
     Perform the second step of normalized cut clustering which assigns feature to clusters based on the eigen vectors from the LaPlacian of a similarity matrix.
-    
+
     Parameters:
     ---------
     eigen_vec: Eigenvectors of the normalized LaPlacian calculated from the similarity matrix for the corresponding clustering problem
-    
+    n_init: number of random starts, the one with the lowest ncut value is kept
+    seed: random seed, results are reproducible and independent of n_jobs
+    n_jobs: number of processes running random starts in parallel
+    maxiter: maximum iterations of each start
+
     Return:
     ---------
     eigen_vec_discrete: discretised eigenvectors
                         vectors of 0 and 1 which indicate whether or not a feature belongs to the cluster defined by the eigen vector
                         i.e. a one in the 10th row of the 4th eigenvector(column) means that feature 10 belongs to cluster #4
     """
-    eps = 2.2204e-16
-    n, k = eigen_vec.shape
-    vm = np.kron(np.ones((1,k)), np.sqrt(np.multiply(eigen_vec, eigen_vec).sum(1)))
-    eigen_vec = eigen_vec/vm
-    
-    svd_restarts = 0
-    exitLoop = 0
-
-    while (svd_restarts < 30) and (exitLoop == 0):
-        c = np.zeros((n,1))
-        R = np.matrix(np.zeros((k,k)))
-        R[:,0] = eigen_vec[int(rand(1)*(n-1)),:].T
-    
-        for j in range(1,k):
-            c = c + np.abs(eigen_vec*R[:,j-1])
-            R[:,j] = eigen_vec[c.argmin(),:].T
-    
-        last_objvalue = 0
-        n_iter_discrete = 0
-        n_iter_discrete_max = 20
-
-        while exitLoop == 0:
-            print('iteration {}'.format(n_iter_discrete))
-            n_iter_discrete += 1
-            t_discrete = eigen_vec*R
-        
-            j = np.reshape(np.asarray(t_discrete.argmax(1)), n)
-            eigenvec_discrete = sparse.csc_matrix((np.ones(len(j)),(range(0,n),\
-            np.array(j))), shape=(n,k))
-            tSVD = eigenvec_discrete.T*eigen_vec
-            try:
-                U, S, Vh = linalg.svd(tSVD)            
-            except LinAlgError:
-                print('SVD didn''t converged, randomizing and trying again')
-                break
-
-            # test for convergence
-            NcutValue = 2*(n-S.sum())
-            if((np.abs(NcutValue - last_objvalue)<eps) or (n_iter_discrete > n_iter_discrete_max)):
-                exitLoop = 1
-            else:
-                last_objvalue = NcutValue
-                R = np.matrix(Vh).T*np.matrix(U).T
-    
-    if exitLoop == 0:
-        raise SVDError("SVD didn't converge after 30 retries")
+    eigen_vec = _normalize_rows(eigen_vec)
+    seeds = _seed_sequence(seed).spawn(n_init)
+    if n_jobs == 1 or n_init == 1:
+        results = [_discretise_seed(eigen_vec, sd, maxiter) for sd in seeds]
     else:
-        return eigenvec_discrete
+        pool = multiprocessing.Pool(min(n_jobs, n_init), initializer=_pool_init, initargs=(eigen_vec, maxiter))
+        try:
+            results = pool.map(_pool_discretise, seeds)
+        finally:
+            pool.close()
+            pool.join()
+    eigenvec_discrete, _ = min(results, key=lambda x: x[1])
+    return eigenvec_discrete
 
 def gen_labelimg(eigenvec_discrete):
     """
     Generate label image from discretisated eigenvector
-    
+
     Parameters:
     -----------
-    eigenvec_discrete: discretisated eigenvector
-    
+    eigenvec_discrete: discretisated eigenvector, sparse or dense array
+
     Return:
     -------
     labelimg: label image (surface only)
     """
-    eigenvec_discrete = eigenvec_discrete.todense()
-    eigenvec_discrete = np.array(eigenvec_discrete)
+    if sparse.issparse(eigenvec_discrete):
+        eigenvec_discrete = eigenvec_discrete.toarray()
+    eigenvec_discrete = np.asarray(eigenvec_discrete)
     labelimg = np.argmax(eigenvec_discrete, axis=1)
     labelimg += 1
-    return labelimg 
+    return labelimg
 
+def ncut_parcellation(w, n_clusters, method = 'eigsh', n_init = 10, seed = None, n_jobs = 1, v0 = None):
+    """
+    Spectral parcellation by normalized cut, from similarity matrix to label image
 
+    Parameters:
+    -----------
+    w: symmetric similarity matrix, a sparse matrix is recommended for large graphs (e.g. mesh constrained correlations)
+    n_clusters: number of parcels
+    method: eigen solver, 'eigsh' or 'lobpcg', see ncut
+    n_init: number of random starts of discretisation
+    seed: random seed
+    n_jobs: number of processes running random starts in parallel
+    v0: warm start eigenvectors, e.g. eigen_vec returned by a previous call
 
+    Return:
+    -------
+    labelimg: label image, labels start from 1
+    eigen_vec: eigenvectors, could be reused as warm start
 
+    Example:
+    --------
+    >>> labelimg, eigen_vec = ncut_parcellation(w, 200, n_init = 10, n_jobs = 4)
+    """
+    seeds = _seed_sequence(seed).spawn(2)
+    eigen_val, eigen_vec = ncut(w, n_clusters, method=method, v0=v0, seed=seeds[0])
+    eigenvec_discrete = discretisation(eigen_vec, n_init=n_init, seed=seeds[1], n_jobs=n_jobs)
+    labelimg = gen_labelimg(eigenvec_discrete)
+    return labelimg, eigen_vec
 
+def ncut_value(w, labelimg):
+    """
+    Normalized cut value of a parcellation on similarity matrix w
+    ncut = sum_k cut(A_k, V-A_k)/assoc(A_k, V)
 
+    Parameters:
+    -----------
+    w: symmetric similarity matrix, dense or sparse
+    labelimg: label image, labels of each node
+
+    Return:
+    -------
+    value: normalized cut value
+    """
+    w = sparse.csr_matrix(w, dtype=float)
+    _, inverse = np.unique(labelimg, return_inverse=True)
+    n = inverse.size
+    onehot = sparse.csr_matrix((np.ones(n), (np.arange(n), inverse)), shape=(n, inverse.max()+1))
+    assoc = onehot.T.dot(np.asarray(w.sum(1)).ravel())
+    within = np.asarray(onehot.multiply(w.dot(onehot)).sum(0)).ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        value = np.nansum((assoc - within)/assoc)
+    return value
+
+def _matched_dice(labelimg1, labelimg2):
+    """
+    Mean dice between each parcel of labelimg1 and its best overlapped parcel of labelimg2
+    """
+    labels1, inv1 = np.unique(labelimg1, return_inverse=True)
+    labels2, inv2 = np.unique(labelimg2, return_inverse=True)
+    contingency = np.bincount(inv1*labels2.size+inv2, minlength=labels1.size*labels2.size).reshape(labels1.size, labels2.size)
+    match = labels2[np.argmax(contingency, axis=1)]
+    return np.mean([tools.calc_overlap(labelimg1, labelimg2, lbl, match[i], 'dice') for i, lbl in enumerate(labels1)])
+
+def _pool_init_multik(eigen_vec, maxiter):
+    _pool_state['eigen_vec_all'] = eigen_vec
+    _pool_state['maxiter'] = maxiter
 
+def _pool_discretise_k(args):
+    k, seed = args
+    return _discretise_seed(_normalize_rows(_pool_state['eigen_vec_all'][:,:k]), seed, _pool_state['maxiter'])
 
+def ncut_multik(w, k_list, method = 'eigsh', n_init = 2, seed = None, n_jobs = 1, maxiter = 20):
+    """
+    Normalized cut parcellations of several cluster numbers sharing one eigen decomposition.
+    The leading max(k_list) eigenvectors are computed once, each k is discretised from the first k of them.
+
+    Parameters:
+    -----------
+    w: symmetric similarity matrix, dense or sparse
+    k_list: list of cluster numbers
+    method: eigen solver, 'eigsh' or 'lobpcg', see ncut
+    n_init: number of random starts of discretisation for each k
+    seed: random seed
+    n_jobs: number of processes, all discretisations (each k and each start) run in one pool
+    maxiter: maximum iterations of each discretisation
+
+    Return:
+    -------
+    labelimgs: label images, nnode x len(k_list). The start with the lowest ncut objective is kept for each k
+    ncut_values: normalized cut values of labelimgs on w
+    dice: stability of each k, mean dice between the kept parcellation and the parcellations of the other random starts
+          (each parcel is matched to its most overlapped parcel). nan if n_init is 1
+
+    Example:
+    --------
+    >>> labelimgs, ncut_values, dice = ncut_multik(w, [50, 100, 200], n_init = 4, n_jobs = 8)
+    """
+    k_list = [int(k) for k in k_list]
+    seeds = _seed_sequence(seed).spawn(2)
+    eigen_val, eigen_vec = ncut(w, max(k_list), method=method, seed=seeds[0])
+    start_seeds = seeds[1].spawn(len(k_list)*n_init)
+    tasks = [(k, start_seeds[i*n_init+j]) for i, k in enumerate(k_list) for j in range(n_init)]
+    if n_jobs == 1:
+        _pool_init_multik(eigen_vec, maxiter)
+        try:
+            results = [_pool_discretise_k(task) for task in tasks]
+        finally:
+            _pool_state.clear()
+    else:
+        pool = multiprocessing.Pool(n_jobs, initializer=_pool_init_multik, initargs=(eigen_vec, maxiter))
+        try:
+            results = pool.map(_pool_discretise_k, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    labelimgs = np.zeros((eigen_vec.shape[0], len(k_list)), dtype=int)
+    ncut_values = np.zeros(len(k_list))
+    dice = np.full(len(k_list), np.nan)
+    for i in range(len(k_list)):
+        k_results = results[i*n_init:(i+1)*n_init]
+        best = int(np.argmin([objvalue for _, objvalue in k_results]))
+        k_labelimgs = [gen_labelimg(discrete) for discrete, _ in k_results]
+        labelimgs[:,i] = k_labelimgs[best]
+        ncut_values[i] = ncut_value(w, labelimgs[:,i])
+        if n_init > 1:
+            dice[i] = np.mean([_matched_dice(labelimgs[:,i], lbl) for j, lbl in enumerate(k_labelimgs) if j != best])
+    return labelimgs, ncut_values, dice
+
+def _mesh_edge_index(adjacency):
+    """
+    Upper triangle edges (i<j) from faces, a sparse adjacency matrix, a ring neighbour list
+    or a surface geometry (iofunc.surfgeometry.SurfaceGeometry)
+    """
+    if hasattr(adjacency, 'edges'):
+        edges = adjacency.edges
+        return adjacency.nvertex, edges[:,0].astype(int), edges[:,1].astype(int)
+    if isinstance(adjacency, list):
+        rows = np.repeat(np.arange(len(adjacency)), [len(ring) for ring in adjacency])
+        cols = np.array([v for ring in adjacency for v in ring], dtype=int)
+        adjacency = sparse.coo_matrix((np.ones(rows.size), (rows, cols)), shape=(len(adjacency), len(adjacency)))
+    elif not sparse.issparse(adjacency):
+        adjacency = surf_tools.mesh_edges(np.asarray(adjacency))
+    adjacency = sparse.triu(sparse.csr_matrix(adjacency), k=1).tocoo()
+    adjacency.sum_duplicates()
+    return adjacency.shape[0], adjacency.row, adjacency.col
+
+def _standardize_series(data):
+    """
+    Center each row and scale it into unit norm, so that the dot product of two rows is their correlation.
+    Constant rows are left as zeros.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    data = data - data.mean(axis=1, keepdims=True)
+    norm = np.sqrt(np.sum(data**2, axis=1, keepdims=True))
+    norm[norm == 0] = np.inf
+    return data/norm
+
+def mesh_affinity(subjects, adjacency, fisherz = False, thr = None, edge_chunk = None, chunk_bytes = 2**27):
+    """
+    Group-level sparse affinity for spatially constrained ncut.
+    Correlations are computed only on mesh edges, subjects are streamed one at a time,
+    so the memory is linear in the number of edges rather than quadratic in the number of vertices.
+
+    Parameters:
+    -----------
+    subjects: iterable of time series, each is an array of nvertex x ntime.
+              Pass a generator (e.g. loading each subject inside it) to keep only one subject in memory
+    adjacency: mesh connectivity, could be faces (ntriangle x 3), sparse adjacency matrix from surf_tools.mesh_edges,
+               ring neighbour list from surf_tools.get_n_ring_neighbor, or iofunc.surfgeometry.SurfaceGeometry
+    fisherz: average correlations in fisher z space, by default is False
+    thr: edges whose group weight is not larger than thr are removed, by default is None (keep all edges)
+    edge_chunk: number of edges processed in each chunk, by default is None (sized from chunk_bytes)
+    chunk_bytes: memory budget of time series gathered for a chunk of edges (both ends), by default is 128MB
+
+    Return:
+    -------
+    w: symmetric sparse affinity matrix (csr), nvertex x nvertex, could be passed into ncut or ncut_parcellation directly
+    
+    Example:
+    --------
+    >>> w = mesh_affinity((nib.load(f).get_fdata().T for f in filelist), faces, thr = 0)
+    >>> labelimg, eigen_vec = ncut_parcellation(w, 100)
+    """
+    nvertex, rows, cols = _mesh_edge_index(adjacency)
+    weights = np.zeros(rows.size)
+    nsubj = 0
+    for data in subjects:
+        if data.shape[0] != nvertex:
+            raise Exception('Number of vertices in time series mismatched with the mesh.')
+        data = _standardize_series(data)
+        if edge_chunk is None:
+            # series of both ends of each edge are gathered
+            nedge = max(1, int(chunk_bytes // (2*data.shape[1]*data.itemsize)))
+        else:
+            nedge = edge_chunk
+        for start in range(0, rows.size, nedge):
+            stop = min(start+nedge, rows.size)
+            r = np.einsum('ij,ij->i', data[rows[start:stop]], data[cols[start:stop]])
+            if fisherz:
+                r = np.arctanh(np.clip(r, -1+1e-7, 1-1e-7))
+            weights[start:stop] += r
+        nsubj += 1
+    if nsubj == 0:
+        raise Exception('No subject data.')
+    weights /= nsubj
+    if fisherz:
+        weights = np.tanh(weights)
+    if thr is not None:
+        keep = weights > thr
+        rows, cols, weights = rows[keep], cols[keep], weights[keep]
+    w = sparse.coo_matrix((np.concatenate((weights, weights)), (np.concatenate((rows, cols)), np.concatenate((cols, rows)))), shape=(nvertex, nvertex))
+    return w.tocsr()
@@ -0,0 +1,294 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import json
+import zlib
+import shutil
+import itertools
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+_META = 'meta.json'
+
+def _chunk_name(index):
+    return '.'.join(str(i) for i in index)
+
+class ChunkStore(object):
+    """
+    On-disk chunked 4D array store (.c4d directory).
+    The array (nx, ny, nz, nsubj) is split into voxel blocks x subject blocks,
+    each chunk is saved as a zlib compressed file, missing chunks are read as zeros.
+    Compression runs in threads (zlib releases the GIL), so writing is parallel.
+    -----------------------------------------------------
+    Parameters:
+        path: store directory (.c4d)
+    Example:
+        >>> store = ChunkStore.create('group.c4d', (91,109,91,1000), 'float32', affine = affine)
+        >>> with store.appender(n_jobs = 4) as app:
+        >>>     for f in filelist:
+        >>>         app.append(nib.load(f).get_fdata())
+        >>> for tslice, data in store.iter_chunks('subject'):
+        >>>     ...
+    """
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, _META), 'r') as f:
+            meta = json.load(f)
+        self._shape = tuple(meta['shape'])
+        self._dtype = np.dtype(meta['dtype'])
+        self._chunks = tuple(meta['chunks'])
+        self._compresslevel = meta['compresslevel']
+        self._affine = None if meta['affine'] is None else np.array(meta['affine'])
+
+    @classmethod
+    def create(cls, path, shape, dtype = 'float32', chunks = None, compresslevel = 1, affine = None, overwrite = True):
+        """
+        Create an empty store
+        ---------------------------------------
+        Parameters:
+            path: store directory, by convention ends with .c4d
+            shape: 4D array shape
+            dtype: data type, by default is float32
+            chunks: chunk shape, by default is (32,32,32,16) clipped into shape
+            compresslevel: zlib compress level, 0 means no compression. By default is 1
+            affine: affine matrix of images, saved as metadata
+            overwrite: remove existed store, by default is True
+        Return:
+            store: ChunkStore instance
+        """
+        if len(shape) != 4:
+            raise Exception('ChunkStore only supports 4D array.')
+        if chunks is None:
+            chunks = (32, 32, 32, 16)
+        chunks = tuple(int(min(c, s)) for c, s in zip(chunks, shape))
+        if os.path.exists(path):
+            if not overwrite:
+                raise Exception('{} has already existed.'.format(path))
+            shutil.rmtree(path)
+        os.makedirs(path)
+        meta = {'shape': [int(s) for s in shape],
+                'dtype': np.dtype(dtype).str,
+                'chunks': list(chunks),
+                'compresslevel': compresslevel,
+                'affine': None if affine is None else np.asarray(affine).tolist()}
+        with open(os.path.join(path, _META), 'w') as f:
+            json.dump(meta, f)
+        return cls(path)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def ndim(self):
+        return 4
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def chunks(self):
+        return self._chunks
+
+    @property
+    def affine(self):
+        return self._affine
+
+    @property
+    def grid(self):
+        """
+        Number of chunks along each dimension
+        """
+        return tuple(-(-s//c) for s, c in zip(self._shape, self._chunks))
+
+    def _chunk_slices(self, index):
+        return tuple(slice(i*c, min((i+1)*c, s)) for i, c, s in zip(index, self._chunks, self._shape))
+
+    def _read_chunk(self, index):
+        slices = self._chunk_slices(index)
+        shape = tuple(slc.stop-slc.start for slc in slices)
+        filename = os.path.join(self._path, _chunk_name(index))
+        if not os.path.exists(filename):
+            return np.zeros(shape, dtype = self._dtype)
+        with open(filename, 'rb') as f:
+            buf = f.read()
+        if self._compresslevel:
+            buf = zlib.decompress(buf)
+        return np.frombuffer(buf, dtype = self._dtype).reshape(shape)
+
+    def _write_chunk(self, args):
+        index, data = args
+        buf = np.ascontiguousarray(data, dtype = self._dtype).tobytes()
+        if self._compresslevel:
+            buf = zlib.compress(buf, self._compresslevel)
+        filename = os.path.join(self._path, _chunk_name(index))
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(buf)
+        os.replace(filename + '.tmp', filename)
+
+    def write_block(self, data, start = 0, n_jobs = 1):
+        """
+        Write a subject block, all voxel chunks of it are compressed and written in parallel
+        ----------------------------------------
+        Parameters:
+            data: array with shape of (nx, ny, nz, n)
+            start: index of the first subject of data, should be aligned with subject chunks
+            n_jobs: number of threads
+        Note:
+            chunks are rewritten as a whole, so the block should also end at a subject chunk boundary
+            (or at the end of the store), otherwise subjects saved in the tail chunk would be lost.
+        """
+        if start % self._chunks[3] != 0:
+            raise Exception('start should be a multiple of subject chunk size {}.'.format(self._chunks[3]))
+        if data.shape[:3] != self._shape[:3] or start + data.shape[3] > self._shape[3]:
+            raise Exception('data shape mismatched with store shape.')
+        stop = start + data.shape[3]
+        if stop % self._chunks[3] != 0 and stop != self._shape[3]:
+            raise Exception('start + number of subjects should be a multiple of subject chunk size {0} or equal to {1}.'.format(self._chunks[3], self._shape[3]))
+        tasks = []
+        for t in range(start//self._chunks[3], -(-(start+data.shape[3])//self._chunks[3])):
+            for i, j, k in itertools.product(*[range(g) for g in self.grid[:3]]):
+                slices = self._chunk_slices((i, j, k, t))
+                tslice = slice(slices[3].start-start, slices[3].stop-start)
+                tasks.append(((i, j, k, t), data[slices[0], slices[1], slices[2], tslice]))
+        if n_jobs == 1:
+            for task in tasks:
+                self._write_chunk(task)
+        else:
+            pool = ThreadPool(n_jobs)
+            try:
+                pool.map(self._write_chunk, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+    def appender(self, n_jobs = 1):
+        """
+        Streaming writer, append 3D volumes one by one.
+        Volumes are buffered until a subject chunk is filled, then written by write_block.
+        """
+        return _ChunkAppender(self, n_jobs)
+
+    def __getitem__(self, key):
+        """
+        Read a region of the store, support ints and slices (step 1)
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            pos = key.index(Ellipsis)
+            key = key[:pos] + (slice(None),)*(4-len(key)+1) + key[pos+1:]
+        key = key + (slice(None),)*(4-len(key))
+        slices = []
+        squeeze = []
+        for axis, (k, s) in enumerate(zip(key, self._shape)):
+            if isinstance(k, slice):
+                begin, end, step = k.indices(s)
+                if step != 1:
+                    raise Exception('Only slices with step 1 are supported.')
+                slices.append(slice(begin, max(begin, end)))
+            else:
+                k = int(k)
+                if k < 0:
+                    k += s
+                if k < 0 or k >= s:
+                    raise IndexError('index {} is out of bounds for axis {} with size {}'.format(k, axis, s))
+                slices.append(slice(k, k+1))
+                squeeze.append(axis)
+        outdata = np.zeros(tuple(slc.stop-slc.start for slc in slices), dtype = self._dtype)
+        ranges = [range(slc.start//c, -(-slc.stop//c)) for slc, c in zip(slices, self._chunks)]
+        for index in itertools.product(*ranges):
+            cslices = self._chunk_slices(index)
+            src = []
+            dst = []
+            for slc, cslc in zip(slices, cslices):
+                begin = max(slc.start, cslc.start)
+                end = min(slc.stop, cslc.stop)
+                src.append(slice(begin-cslc.start, end-cslc.start))
+                dst.append(slice(begin-slc.start, end-slc.start))
+            outdata[tuple(dst)] = self._read_chunk(index)[tuple(src)]
+        if squeeze:
+            outdata = np.squeeze(outdata, axis = tuple(squeeze))
+        return outdata
+
+    def __array__(self, dtype = None, copy = None):
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype, copy = False)
+        return data
+
+    def iter_chunks(self, axis = 'subject', n_jobs = 1):
+        """
+        Iterate over the store chunk by chunk
+        ------------------------------------------
+        Parameters:
+            axis: 'subject', yield whole volumes of a subject block, (tslice, data of (nx, ny, nz, n))
+                  'space', yield a voxel block with all subjects, ((xslice, yslice, zslice), data of (bx, by, bz, nsubj))
+            n_jobs: number of threads decompressing chunks
+        """
+        if axis == 'subject':
+            blocks = [(slice(None),)*3 + (self._chunk_slices((0, 0, 0, t))[3],) for t in range(self.grid[3])]
+        elif axis == 'space':
+            blocks = [self._chunk_slices((i, j, k, 0))[:3] + (slice(None),) for i, j, k in itertools.product(*[range(g) for g in self.grid[:3]])]
+        else:
+            raise Exception("axis should be 'subject' or 'space'")
+        if n_jobs == 1:
+            for block in blocks:
+                yield (block[3] if axis == 'subject' else block[:3]), self[block]
+        else:
+            pool = ThreadPool(n_jobs)
+            try:
+                # prefetch next block while the current one is processed
+                pending = pool.apply_async(self.__getitem__, (blocks[0],))
+                for n, block in enumerate(blocks):
+                    data = pending.get()
+                    if n+1 < len(blocks):
+                        pending = pool.apply_async(self.__getitem__, (blocks[n+1],))
+                    yield (block[3] if axis == 'subject' else block[:3]), data
+            finally:
+                pool.close()
+                pool.join()
+
+class _ChunkAppender(object):
+    def __init__(self, store, n_jobs):
+        self._store = store
+        self._n_jobs = n_jobs
+        self._buffer = np.zeros(store.shape[:3] + (store.chunks[3],), dtype = store.dtype)
+        self._nbuf = 0
+        self._start = 0
+
+    def append(self, volume):
+        if self._start + self._nbuf >= self._store.shape[3]:
+            raise Exception('Store is full.')
+        if volume.shape != self._store.shape[:3]:
+            raise Exception('volume shape mismatched with store shape.')
+        self._buffer[..., self._nbuf] = volume
+        self._nbuf += 1
+        if self._nbuf == self._buffer.shape[3]:
+            self._flush()
+
+    def _flush(self):
+        if self._nbuf:
+            # a partial chunk is written as a whole, subjects not appended are left as zeros
+            self._buffer[..., self._nbuf:] = 0
+            nwrite = min(self._buffer.shape[3], self._store.shape[3] - self._start)
+            self._store.write_block(self._buffer[..., :nwrite], self._start, self._n_jobs)
+            self._start += self._nbuf
+            self._nbuf = 0
+
+    def close(self):
+        self._flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # do not write a half-filled buffer when appending failed
+        if exc_type is None:
+            self.close()
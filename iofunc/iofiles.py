@@ -3,11 +3,20 @@
 
 import numpy as np
 import nibabel as nib
+import io
 import os
 import pickle
+import colorsys
+import collections
+import json
+import zipfile
 from scipy.io import savemat, loadmat
+from multiprocessing.pool import ThreadPool
 import pandas as pd
 
+from ATT.iofunc import chunkstore
+from ATT.iofunc import surfgeometry
+
 pjoin = os.path.join
 
 def make_ioinstance(filename, filepath = '.'):
@@ -31,6 +40,391 @@ def make_ioinstance(filename, filepath = '.'):
     factory = _IOFactory()
     return factory.createfactory(filename, filepath)
 
+def load_lazy(filename, filepath = '.', mmap = True):
+    """
+    Load a nifti/cifti image as a lazy array proxy, data will not be read until sliced
+
+    Parameters:
+    -----------
+    filename: filename
+    filepath: filepath, by default is '.'
+    mmap: memory-map uncompressed files, by default is True.
+          Compressed files (.nii.gz) are always read by decompressing stream
+
+    Return:
+    -------
+    lazyimg: LazyImage instance
+
+    Example:
+    --------
+    >>> lazyimg = load_lazy('tfMRI_WM.dtseries.nii')
+    >>> data = lazyimg.rows(slice(0, 100))
+    >>> lh_data = lazyimg.structure('CIFTI_STRUCTURE_CORTEX_LEFT')
+    """
+    return LazyImage(pjoin(filepath, filename), mmap = mmap)
+
+def save_maps(data, filenames, template = None, n_jobs = 1, **kwargs):
+    """
+    Save a batch of maps (e.g. maps of thousands of subjects) into cifti/gifti files in parallel.
+    The template is parsed only once and shared by all files.
+
+    Parameters:
+    -----------
+    data: maps, array with the first dimension of files, or a list of arrays
+    filenames: output filenames, one for each map (.dscalar.nii, .dlabel.nii, .dtseries.nii, .func.gii, .label.gii, etc.)
+    template: template of axes/header, see _CIFTI.save and _GIFTI.save
+    n_jobs: number of threads, by default is 1
+    kwargs: other parameters passed to save
+
+    Return:
+    -------
+    filenames: output filenames
+
+    Example:
+    --------
+    >>> save_maps(pms, ['sub{}.dscalar.nii'.format(s) for s in subjects], 'template.dscalar.nii', n_jobs = 8)
+    """
+    if len(data) != len(filenames):
+        raise Exception('data and filenames should have the same length.')
+    template = _resolve_template(template)
+    instances = [make_ioinstance(f) for f in filenames]
+    for f, ins in zip(filenames, instances):
+        if not isinstance(ins, (_CIFTI, _GIFTI)):
+            raise Exception('{} is not a cifti or gifti file.'.format(f))
+    def _save(i):
+        instances[i].save(data[i], template, **kwargs)
+    if n_jobs == 1:
+        for i in range(len(filenames)):
+            _save(i)
+    elif len(filenames):
+        # the first file fills header cache of template, the others only write data
+        _save(0)
+        pool = ThreadPool(n_jobs)
+        try:
+            pool.map(_save, range(1, len(filenames)))
+        finally:
+            pool.close()
+            pool.join()
+    return list(filenames)
+
+class LazyImage(object):
+    """
+    Lazy array proxy of a nifti/cifti image based on image dataobj.
+    Only the bytes of requested slices are read from uncompressed files.
+    -----------------------------------------------
+    Parameters:
+        filename: image filename
+        mmap: memory-map uncompressed files, by default is True
+    Example:
+        >>> lazyimg = LazyImage('data.nii.gz')
+        >>> lazyimg.shape
+        >>> data = lazyimg[..., 0]
+    """
+    def __init__(self, filename, mmap = True):
+        self._filename = filename
+        self._img = nib.load(filename, mmap = mmap)
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def img(self):
+        return self._img
+
+    @property
+    def shape(self):
+        return self._img.dataobj.shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        """
+        dtype of sliced data (scaled if the image has slope or intercept)
+        """
+        dataobj = self._img.dataobj
+        if getattr(dataobj, 'is_proxy', False):
+            if dataobj.slope != 1.0 or dataobj.inter != 0.0:
+                return np.result_type(self._img.get_data_dtype(), np.asarray(dataobj.slope).dtype, np.asarray(dataobj.inter).dtype)
+        return self._img.get_data_dtype()
+
+    @property
+    def affine(self):
+        return self._img.affine
+
+    @property
+    def header(self):
+        return self._img.header
+
+    def __getitem__(self, key):
+        return np.asanyarray(self._img.dataobj[key])
+
+    def __array__(self, dtype = None, copy = None):
+        data = np.asanyarray(self._img.dataobj)
+        if dtype is not None:
+            data = data.astype(dtype, copy = False)
+        return data
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _leading(self):
+        # old version of cifti files may have 5 or 6 dimensions, only the last two are meaningful
+        return (0,)*(self.ndim-2) if isinstance(self._img, nib.Cifti2Image) else ()
+
+    def rows(self, index):
+        """
+        Read rows (the first meaningful dimension, e.g. timepoints/maps of cifti)
+
+        Parameters:
+        -----------
+        index: int, slice or index array
+        """
+        return self[self._leading() + (index,)]
+
+    def columns(self, index):
+        """
+        Read columns (the last dimension, e.g. grayordinates of cifti)
+
+        Parameters:
+        -----------
+        index: int, slice or index array
+        """
+        return self[self._leading() + (slice(None),)*(self.ndim-len(self._leading())-1) + (index,)]
+
+    def brain_model_axis(self):
+        """
+        Brain model axis accessor of cifti image, see CiftiBrainModels
+        """
+        return _brain_models(self._img)
+
+    def brain_models(self):
+        """
+        Brain model structures of cifti image
+
+        Return:
+        -------
+        models: dict, key is structure name, value is a slice of columns
+        """
+        return self.brain_model_axis().structures
+
+    def structure(self, name, rows = slice(None), vertexmap = False, fill = np.nan):
+        """
+        Read columns belonging to one brain model structure, only these columns are read
+
+        Parameters:
+        -----------
+        name: structure name, e.g. 'CIFTI_STRUCTURE_CORTEX_LEFT', or any name accepted by nibabel such as 'cortex_left', 'L' or 'R'
+        rows: rows to read, by default read all rows
+        vertexmap: map surface structure into all surface vertices (e.g. 32492 vertices of fs_LR 32k), by default is False
+        fill: value of vertices without data (medial wall) if vertexmap is True, by default is nan
+        """
+        models = self.brain_model_axis()
+        data = self[self._leading() + (rows, models.slice(name))]
+        if vertexmap:
+            data = models.to_vertices(data, name, fill)
+        return data
+
+class CiftiBrainModels(object):
+    """
+    Accessor of cifti BrainModelAxis
+    ---------------------------------------------
+    Parameters:
+        axis: nibabel BrainModelAxis
+    Example:
+        >>> models = iofiles.load_lazy('data.dscalar.nii').brain_model_axis()
+        >>> models.structures
+        >>> lh_vertices = models.vertices('L')
+        >>> lh_32k = models.to_vertices(data[..., models.slice('L')], 'L')
+    """
+    def __init__(self, axis):
+        self.axis = axis
+        self.structures = {}
+        self._models = {}
+        for name, slc, bm in axis.iter_structures():
+            start, stop, _ = slc.indices(len(axis))
+            self.structures[str(name)] = slice(start, stop)
+            self._models[str(name)] = bm
+
+    def __len__(self):
+        return len(self.axis)
+
+    def _name(self, name):
+        name = _cifti_structure_name(name)
+        if name not in self.structures:
+            raise Exception('Structure {} not in cifti image.'.format(name))
+        return name
+
+    def slice(self, name):
+        """
+        Slice of grayordinates (columns) of a structure
+        """
+        return self.structures[self._name(name)]
+
+    def is_surface(self, name):
+        """
+        Whether a structure is a surface structure
+        """
+        return bool(self._models[self._name(name)].surface_mask.all())
+
+    def nvertices(self, name):
+        """
+        Number of surface vertices of a surface structure (including medial wall)
+        """
+        name = self._name(name)
+        if not self.is_surface(name):
+            raise Exception('{} is not a surface structure.'.format(name))
+        return int(self._models[name].nvertices[name])
+
+    def vertices(self, name):
+        """
+        Surface vertex number of each grayordinate of a surface structure
+        """
+        name = self._name(name)
+        if not self.is_surface(name):
+            raise Exception('{} is not a surface structure.'.format(name))
+        return np.asarray(self._models[name].vertex)
+
+    def voxels(self, name):
+        """
+        Voxel indices (ijk) of each grayordinate of a volume structure
+        """
+        name = self._name(name)
+        if self.is_surface(name):
+            raise Exception('{} is not a volume structure.'.format(name))
+        return np.asarray(self._models[name].voxel)
+
+    def to_vertices(self, data, name, fill = np.nan):
+        """
+        Map data of a surface structure (..., ngrayordinate of structure) into all surface vertices (..., nvertices).
+        Vertices without grayordinates (medial wall) are filled by fill
+        """
+        vertices = self.vertices(name)
+        data = np.asarray(data)
+        if data.shape[-1] != vertices.size:
+            raise Exception('data should have {} columns of structure {}'.format(vertices.size, self._name(name)))
+        outdata = np.full(data.shape[:-1] + (self.nvertices(name),), fill, dtype = np.result_type(data.dtype, np.min_scalar_type(fill)))
+        outdata[..., vertices] = data
+        return outdata
+
+def _cifti_structure_name(name):
+    if name in ['L', 'l', 'lh', 'left']:
+        return 'CIFTI_STRUCTURE_CORTEX_LEFT'
+    elif name in ['R', 'r', 'rh', 'right']:
+        return 'CIFTI_STRUCTURE_CORTEX_RIGHT'
+    return nib.cifti2.BrainModelAxis.to_cifti_brain_structure_name(name)
+
+def _brain_models(img):
+    if not isinstance(img, nib.Cifti2Image):
+        raise Exception('Brain models only exist in cifti image.')
+    axis = img.header.get_axis(img.ndim-1)
+    if not isinstance(axis, nib.cifti2.BrainModelAxis):
+        raise Exception('The last axis of cifti image is not a brain model axis.')
+    return CiftiBrainModels(axis)
+
+# headers caches serialized cifti headers, so a batch of files with the same layout builds header only once
+_Template = collections.namedtuple('_Template', ['models', 'rowaxis', 'gifti', 'headers'])
+
+def _resolve_template(template):
+    """
+    Parse template (filename, LazyImage, nibabel image, CiftiBrainModels or BrainModelAxis) into
+    brain models and the first axis of a cifti template, or a gifti template
+    """
+    if isinstance(template, _Template):
+        return template
+    if template is None:
+        return _Template(None, None, None, {})
+    if isinstance(template, CiftiBrainModels):
+        return _Template(template, None, None, {})
+    if isinstance(template, nib.cifti2.BrainModelAxis):
+        return _Template(CiftiBrainModels(template), None, None, {})
+    if isinstance(template, LazyImage):
+        template = template.img
+    elif isinstance(template, str):
+        template = nib.load(template)
+    if isinstance(template, nib.Cifti2Image):
+        return _Template(_brain_models(template), template.header.get_axis(0), None, {})
+    if isinstance(template, nib.GiftiImage):
+        return _Template(None, None, template, {})
+    raise Exception('Unsupported template.')
+
+def _map_names(names, nmap):
+    if names is None:
+        return ['#{}'.format(i+1) for i in range(nmap)]
+    if isinstance(names, str):
+        names = [names]
+    if len(names) != nmap:
+        raise Exception('names should have {} elements.'.format(nmap))
+    return list(names)
+
+def _label_color(key):
+    # golden ratio spaced hues, so the color of a label is the same in all files
+    r, g, b = colorsys.hsv_to_rgb((key*0.618033988749895) % 1.0, 0.75, 0.95)
+    return (r, g, b, 1.0)
+
+def _label_table(data, label_table = None):
+    """
+    Label table {key: (name, (r, g, b, a))} covering all labels of data.
+    Labels missing in label_table are named by their keys and colored automatically
+    """
+    table = {0: ('???', (1.0, 1.0, 1.0, 0.0))}
+    if label_table is not None:
+        table.update(dict((int(k), (str(v[0]), tuple(float(c) for c in v[1]))) for k, v in label_table.items()))
+    for key in np.unique(data):
+        if key != np.round(key):
+            raise Exception('Labels should be integers.')
+        key = int(key)
+        if key not in table:
+            table[key] = (str(key), _label_color(key))
+    return table
+
+def _atomic_write(filename, write):
+    """
+    Write into a temporary file by write(tmpfile), then rename it as filename
+    """
+    tmpfile = os.path.join(os.path.dirname(filename), '.tmp-' + os.path.basename(filename))
+    try:
+        write(tmpfile)
+        os.replace(tmpfile, filename)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+def _lossless_cast(data, dtype):
+    """
+    Cast data into dtype of a file, raise if integer data type can not keep values
+    """
+    data = np.asarray(data)
+    dtype = np.dtype(dtype)
+    outdata = data.astype(dtype, copy=False)
+    # casting into integer is checked by values, e.g. float labels could be saved as int
+    if dtype.kind in 'iub' and not np.can_cast(data.dtype, dtype, 'safe') and not np.array_equal(outdata, data):
+        raise Exception('{0} data can not be saved as {1} without loss, please use a float data type.'.format(data.dtype, dtype))
+    return outdata
+
+def _atomic_save(img, filename):
+    _atomic_write(filename, lambda tmpfile: nib.save(img, tmpfile))
+
+def _cifti_header_bytes(img):
+    """
+    Serialized nifti2 header and cifti extension of img, data follows them in fortran order
+    """
+    bio = io.BytesIO()
+    img.to_file_map({'image': nib.FileHolder(fileobj = bio)})
+    buf = bio.getvalue()
+    bio.seek(0)
+    hdr = nib.Nifti2Header.from_fileobj(bio)
+    return buf[:int(hdr.get_data_offset())], hdr.get_data_dtype()
+
+def _gifti_structure_name(name):
+    # CIFTI_STRUCTURE_CORTEX_LEFT -> CortexLeft
+    name = _cifti_structure_name(name)
+    return ''.join(part.capitalize() for part in name[len('CIFTI_STRUCTURE_'):].split('_'))
+
 class _IOFactory(object):
     """
     Make a factory for congruent read/write data
@@ -49,16 +443,20 @@ class _IOFactory(object):
             A class
    
         Note:
-            What support now is .csv, .pkl, .mat and .nifti
+            What support now is .csv, .ftab, .pkl, .npz, .mat, .nifti, .c4d (chunked 4D store) and .surf.gii (surface geometry)
         """
         _comp_file = pjoin(filepath, filename)
         _lbl_cifti = False
         if _comp_file.endswith('csv'):
             return _CSV(_comp_file)
+        elif _comp_file.endswith('ftab'):
+            return _FTAB(_comp_file)
         elif _comp_file.endswith('txt'):
             return _TXT(_comp_file)
         elif _comp_file.endswith('pkl'):
             return _PKL(_comp_file)
+        elif _comp_file.endswith('npz'):
+            return _NPZ(_comp_file)
         elif _comp_file.endswith('mat'):
             return _MAT(_comp_file)
         elif _comp_file.endswith('dscalar.nii') | _comp_file.endswith('dtseries.nii') | _comp_file.endswith('ptseries.nii') | _comp_file.endswith('dlabel.nii'):
@@ -66,8 +464,12 @@ class _IOFactory(object):
             return _CIFTI(_comp_file)
         elif _comp_file.endswith('nii.gz') | (_comp_file.endswith('nii') & (_lbl_cifti is False)):
             return _NIFTI(_comp_file)
+        elif _comp_file.endswith('surf.gii'):
+            return _SURFGII(_comp_file)
         elif _comp_file.endswith('gii'):
             return _GIFTI(_comp_file)
+        elif _comp_file.endswith('c4d'):
+            return _C4D(_comp_file)
         else:
             return None
 
@@ -116,6 +518,172 @@ class _CSV(object):
             outdata[key] = pddata[key].get_values()
         return outdata
 
+class _FTAB(object):
+    """
+    Columnar binary feature table (.ftab).
+    A zip container where each column of each appended chunk is stored as a .npy member,
+    together with a json member recording column names, dtypes and user metadata
+    (e.g. subject/region labels). Appending only adds new members, loading reads only selected columns.
+    """
+    _META = 'meta.json'
+    _ROWLABEL = '__rowlabels__'
+    _NROWS = '__nrows__'
+
+    def __init__(self, _comp_file):
+        self._comp_file = _comp_file
+
+    def _to_columns(self, data, labels):
+        if isinstance(data, dict):
+            columns = dict((str(key), np.asarray(value)) for key, value in data.items())
+        elif isinstance(data, np.ndarray):
+            if data.ndim == 1:
+                data = np.expand_dims(data, axis=1)
+            if labels is None:
+                labels = [str(i) for i in range(data.shape[1])]
+            if len(labels) != data.shape[1]:
+                raise Exception('labels should have the same length as columns of data')
+            columns = dict((str(lbl), data[:,i]) for i, lbl in enumerate(labels))
+        else:
+            raise Exception('Input must be a numpy array or a dictionary.')
+        nrows = set(value.shape[0] for value in columns.values())
+        if len(nrows) > 1:
+            raise Exception('All columns should have the same length.')
+        for key, value in columns.items():
+            if value.dtype == object:
+                columns[key] = value.astype(str)
+        if not nrows:
+            # a table without columns, rows are given by the array or by rowlabels
+            return columns, data.shape[0] if isinstance(data, np.ndarray) else None
+        return columns, nrows.pop()
+
+    def _write_chunk(self, zf, chunk, columns, rowlabels, nrows):
+        if rowlabels is not None:
+            rowlabels = np.asarray(rowlabels).astype(str)
+            if nrows is None:
+                nrows = rowlabels.shape[0]
+            if rowlabels.shape[0] != nrows:
+                raise Exception('rowlabels should have the same length as rows of data')
+            columns = dict(columns)
+            columns[self._ROWLABEL] = rowlabels
+        if not columns:
+            # keep the row number of a chunk without any column as an empty (nrows x 0) member
+            columns = {self._NROWS: np.zeros((nrows if nrows is not None else 0, 0), dtype=np.uint8)}
+        for key, value in columns.items():
+            with zf.open('{0:06d}/{1}.npy'.format(chunk, key), 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.ascontiguousarray(value), allow_pickle=False)
+
+    def save(self, data, labels = None, rowlabels = None, metadata = None, compresslevel = 1):
+        """
+        Save data into .ftab, overwrite existed file
+        ---------------------------------------------
+        Parameters:
+            data: 2D array (rows x columns), or a dictionary with column names as keys (as returned by _CSV.load)
+            labels: column names of array data, by default is None (named as '0', '1', ...)
+            rowlabels: labels of each row, e.g. subject ID
+            metadata: a json serializable dictionary, e.g. {'region': regionlabels, 'metric': metriclabels}
+            compresslevel: zlib compress level, 0 means no compression. By default is 1
+        """
+        columns, nrows = self._to_columns(data, labels)
+        meta = {'columns': list(columns.keys()),
+                'dtypes': [columns[key].dtype.str for key in columns],
+                'rowlabels': rowlabels is not None,
+                'compresslevel': compresslevel,
+                'metadata': metadata if metadata is not None else {}}
+        with zipfile.ZipFile(self._comp_file, 'w', **_zip_compression(compresslevel)) as zf:
+            zf.writestr(self._META, json.dumps(meta))
+            self._write_chunk(zf, 0, columns, rowlabels, nrows)
+
+    def append(self, data, labels = None, rowlabels = None):
+        """
+        Append rows into an existed .ftab as a new chunk. Create it if not exist.
+        ---------------------------------------------
+        Parameters:
+            data: 2D array or dictionary, should have the same columns as the saved table
+            labels: column names of array data
+            rowlabels: labels of each row, needed if the table was saved with rowlabels
+        """
+        if not os.path.exists(self._comp_file):
+            return self.save(data, labels, rowlabels)
+        meta = self.load_meta()
+        columns, nrows = self._to_columns(data, labels if labels is not None or isinstance(data, dict) else meta['columns'])
+        if set(columns.keys()) != set(meta['columns']):
+            raise Exception('Columns of appended data mismatched with the saved table.')
+        if meta['rowlabels'] != (rowlabels is not None):
+            raise Exception('rowlabels should be given if and only if the saved table has rowlabels.')
+        columns = dict((key, columns[key].astype(np.dtype(dt), copy=False)) for key, dt in zip(meta['columns'], meta['dtypes']))
+        with zipfile.ZipFile(self._comp_file, 'a', **_zip_compression(meta['compresslevel'])) as zf:
+            self._write_chunk(zf, meta['nchunks'], columns, rowlabels, nrows)
+
+    def load_meta(self):
+        """
+        Load table information without reading data
+        ---------------------------------------------
+        Return:
+            meta: dictionary with keys 'columns', 'dtypes', 'nrows', 'nchunks', 'rowlabels' (whether rowlabels saved) and 'metadata'
+        """
+        with zipfile.ZipFile(self._comp_file, 'r') as zf:
+            meta = json.loads(zf.read(self._META).decode('utf-8'))
+            chunks = sorted(set(name.split('/')[0] for name in zf.namelist() if name != self._META))
+            nrows = 0
+            if meta['columns']:
+                key = meta['columns'][0]
+            elif meta['rowlabels']:
+                key = self._ROWLABEL
+            else:
+                key = self._NROWS
+            for chunk in chunks:
+                with zf.open('{0}/{1}.npy'.format(chunk, key)) as f:
+                    if np.lib.format.read_magic(f) == (1, 0):
+                        shape = np.lib.format.read_array_header_1_0(f)[0]
+                    else:
+                        shape = np.lib.format.read_array_header_2_0(f)[0]
+                    nrows += shape[0]
+        meta['nchunks'] = len(chunks)
+        meta['nrows'] = nrows
+        return meta
+
+    def load(self, columns = None, rowlabels = False):
+        """
+        Load data from .ftab
+        ---------------------------------------------
+        Parameters:
+            columns: column names to load, by default is None (all columns)
+            rowlabels: return rowlabels or not, by default is False
+        Return:
+            outdata: a dictionary, with column name and its data
+            rowlabels: labels of rows, only returned if rowlabels is True
+        """
+        with zipfile.ZipFile(self._comp_file, 'r') as zf:
+            meta = json.loads(zf.read(self._META).decode('utf-8'))
+            if columns is None:
+                columns = meta['columns']
+            if isinstance(columns, str):
+                columns = [columns]
+            for key in columns:
+                if key not in meta['columns']:
+                    raise Exception('Column {} not in table.'.format(key))
+            keys = list(columns)
+            if rowlabels:
+                if not meta['rowlabels']:
+                    raise Exception('No rowlabels saved in table.')
+                keys.append(self._ROWLABEL)
+            chunks = sorted(set(name.split('/')[0] for name in zf.namelist() if name != self._META))
+            outdata = {}
+            for key in keys:
+                parts = []
+                for chunk in chunks:
+                    with zf.open('{0}/{1}.npy'.format(chunk, key)) as f:
+                        parts.append(np.lib.format.read_array(f, allow_pickle=False))
+                outdata[key] = np.concatenate(parts)
+        if rowlabels:
+            return outdata, outdata.pop(self._ROWLABEL)
+        return outdata
+
+def _zip_compression(compresslevel):
+    if compresslevel == 0:
+        return {'compression': zipfile.ZIP_STORED}
+    return {'compression': zipfile.ZIP_DEFLATED, 'compresslevel': compresslevel}
+
 class _TXT(object):
     def __init__(self, _comp_file):
         self._comp_file = _comp_file
@@ -167,6 +735,108 @@ class _PKL(object):
         pkl_file.close()
         return data
 
+class _NPZ(object):
+    """
+    Dictionary of arrays with metadata (.npz), without pickle.
+    Each array is a raw .npy member of a zip container (readable by np.load),
+    metadata is json text kept as a uint8 .npy member (key '__metadata__'), so every member is readable by np.load.
+    Uncompressed members are memory-mapped on load, so arrays are not copied.
+    """
+    _META = '__metadata__'
+    _CODECS = {None: zipfile.ZIP_STORED,
+               'deflate': zipfile.ZIP_DEFLATED,
+               'bzip2': zipfile.ZIP_BZIP2,
+               'lzma': zipfile.ZIP_LZMA}
+
+    def __init__(self, _comp_file):
+        self._comp_file = _comp_file
+
+    def save(self, data, metadata = None, compression = None, compresslevel = None):
+        """
+        Save arrays into .npz
+        ---------------------------------------------
+        Parameters:
+            data: an array, or a dictionary of arrays with string keys
+            metadata: a json serializable dictionary
+            compression: None (stored, memory-mapped on load), 'deflate', 'bzip2' or 'lzma'. By default is None
+            compresslevel: compress level of deflate/bzip2, by default is None (zipfile default)
+        Example:
+            >>> iofiles.make_ioinstance('dice.npz').save({'dice': dice, 'label': label}, {'subjects': subjects})
+        """
+        if compression not in self._CODECS:
+            raise Exception("compression should be None, 'deflate', 'bzip2' or 'lzma'")
+        if not isinstance(data, dict):
+            data = {'arr_0': data}
+        arrays = {}
+        for key, value in data.items():
+            value = np.asarray(value)
+            if str(key) == self._META:
+                raise Exception('{} is reserved for metadata.'.format(key))
+            if value.dtype == object:
+                raise Exception('Object array {} could not be saved without pickle.'.format(key))
+            arrays[str(key)] = value
+        def _write(tmpfile):
+            with zipfile.ZipFile(tmpfile, 'w', self._CODECS[compression], allowZip64 = True, compresslevel = compresslevel) as zf:
+                for key, value in arrays.items():
+                    with zf.open(key + '.npy', 'w', force_zip64 = True) as f:
+                        np.lib.format.write_array(f, value, allow_pickle = False)
+                meta = json.dumps(metadata if metadata is not None else {}).encode('utf-8')
+                with zf.open(self._META + '.npy', 'w') as f:
+                    np.lib.format.write_array(f, np.frombuffer(meta, dtype = np.uint8), allow_pickle = False)
+        _atomic_write(self._comp_file, _write)
+
+    def load_meta(self):
+        """
+        Load metadata only
+        """
+        with zipfile.ZipFile(self._comp_file, 'r') as zf:
+            if self._META + '.npy' not in zf.namelist():
+                return {}
+            with zf.open(self._META + '.npy') as f:
+                return json.loads(np.lib.format.read_array(f, allow_pickle = False).tobytes().decode('utf-8'))
+
+    def load(self, keys = None, mmap = True):
+        """
+        Load arrays from .npz
+        ---------------------------------------------
+        Parameters:
+            keys: keys of arrays to load, by default is None (all arrays)
+            mmap: memory-map uncompressed arrays (read-only), by default is True
+        Return:
+            data: a dictionary of arrays
+        """
+        data = {}
+        with zipfile.ZipFile(self._comp_file, 'r') as zf:
+            infos = dict((info.filename[:-4], info) for info in zf.infolist() if info.filename.endswith('.npy') and info.filename[:-4] != self._META)
+            if keys is None:
+                keys = list(infos.keys())
+            for key in keys:
+                if key not in infos:
+                    raise Exception('{0} not in {1}.'.format(key, self._comp_file))
+                info = infos[key]
+                if mmap and info.compress_type == zipfile.ZIP_STORED:
+                    data[key] = self._memmap(info)
+                else:
+                    with zf.open(info) as f:
+                        data[key] = np.lib.format.read_array(f, allow_pickle = False)
+        return data
+
+    def _memmap(self, info):
+        with open(self._comp_file, 'rb') as f:
+            # local file header: 30 bytes, then filename and extra field
+            f.seek(info.header_offset)
+            local = f.read(30)
+            start = info.header_offset + 30 + int.from_bytes(local[26:28], 'little') + int.from_bytes(local[28:30], 'little')
+            f.seek(start)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype = dtype)
+        return np.memmap(self._comp_file, dtype = dtype, mode = 'r', offset = offset, shape = shape, order = 'F' if fortran_order else 'C')
 
 class _MAT(object):
     def __init__(self, _comp_file):
@@ -203,6 +873,24 @@ class _NIFTI(object):
         img = nib.Nifti1Image(data, None, header)
         nib.save(img, self._comp_file)
 
+    def open_writer(self, header, shape, dtype, compresslevel = None):
+        """
+        Open a progressive writer, volumes along the last dimension are written one by one,
+        so the whole image never needs to be held in memory.
+        The file is written into a temporary file and renamed when closed.
+        Parameters:
+            header: template header (affine and other fields are kept)
+            shape: output data shape
+            dtype: output data type, no scaling is applied.
+                   Writing data which can not be represented by an integer dtype raises an exception
+            compresslevel: gzip compress level of .nii.gz, by default is None (nibabel default)
+        Example:
+            >>> with iofiles._NIFTI('merged.nii.gz').open_writer(header, (91,109,91,100), np.float32) as writer:
+            >>>     for vol in volumes:
+            >>>         writer.write(vol)
+        """
+        return _NiftiVolumeWriter(self._comp_file, header, shape, dtype, compresslevel)
+
     def load(self, datatype = 'data'):
         """
         Load nifti data.
@@ -210,55 +898,203 @@ class _NIFTI(object):
         -----------------------------------
         datatype: data type to load.
                   By default, 'data', nifti image values
+                  'lazy', LazyImage proxy, data will be read when sliced
                   'affine', affine matrix
                   'header', header
                   'shape', matrix shapes
+        Note that only 'data' reads the image values
         """
+        if datatype == 'lazy':
+            return LazyImage(self._comp_file)
         img = nib.load(self._comp_file)
         if datatype == 'data':
-            outdata = img.get_data()
+            outdata = np.asanyarray(img.dataobj)
         elif datatype == 'affine':
-            outdata = img.get_affine()
+            outdata = img.affine
         elif datatype == 'header':
-            outdata = img.get_header()
+            outdata = img.header
         elif datatype == 'shape':
-            outdata = img.get_shape()
+            outdata = img.shape
         else:
             raise Exception('Wrong datatype input')
         return outdata
 
+class _NiftiVolumeWriter(object):
+    """
+    Write nifti image volume by volume. Data are stored in fortran order,
+    so each volume of the last dimension is a contiguous block after the header.
+    """
+    def __init__(self, filename, header, shape, dtype, compresslevel = None):
+        self._filename = filename
+        self._tmpfile = os.path.join(os.path.dirname(filename), '.tmp-' + os.path.basename(filename))
+        hdr = nib.Nifti1Header.from_header(header)
+        hdr.set_data_shape(shape)
+        hdr.set_data_dtype(dtype)
+        hdr.set_slope_inter(1.0, 0.0)
+        self._shape = tuple(shape)
+        self._dtype = hdr.get_data_dtype()
+        self._nvol = int(np.prod(shape[3:]))
+        self._count = 0
+        kwargs = {'compresslevel': compresslevel} if compresslevel is not None and filename.endswith('.gz') else {}
+        self._fileobj = nib.openers.Opener(self._tmpfile, 'wb', **kwargs)
+        hdr.write_to(self._fileobj)
+        offset = hdr.get_data_offset()
+        if self._fileobj.tell() < offset:
+            self._fileobj.write(b'\x00'*(offset-self._fileobj.tell()))
+
+    def write(self, volume):
+        if self._count >= self._nvol:
+            raise Exception('All volumes have been written.')
+        if volume.shape != self._shape[:3]:
+            raise Exception('volume shape mismatched with image shape.')
+        outdata = _lossless_cast(volume, self._dtype)
+        self._fileobj.write(outdata.tobytes('F'))
+        self._count += 1
+
+    def close(self):
+        self._fileobj.close()
+        if self._count != self._nvol:
+            os.remove(self._tmpfile)
+            raise Exception('Only {0} of {1} volumes have been written.'.format(self._count, self._nvol))
+        os.replace(self._tmpfile, self._filename)
+
+    def abort(self):
+        """
+        Close and remove the unfinished file
+        """
+        self._fileobj.close()
+        os.remove(self._tmpfile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
 class _CIFTI(object):
 
     def __init__(self, _comp_file):
         self._comp_file = _comp_file
     
-    def load(self,contrast=None):
+    def load(self,contrast=None, structure=None, vertexmap=False):
         """
         Read cifti data. If your cifti data contains multiple contrast, you can input your contrast number and get value of this contrast.
+        Only the row of pointed contrast (and columns of pointed structure) is read from file.
  
         Parameters:
         --------------
-        contrast: the number of your contrasts
+        contrast: the number of your contrasts, by default is None (the first one).
+                  'lazy' returns a LazyImage proxy of the whole file
+        structure: brain model structure to read, e.g. 'L', 'R', 'CIFTI_STRUCTURE_CORTEX_LEFT', 'thalamus_left'.
+                   By default is None, read all grayordinates
+        vertexmap: map surface structure into all surface vertices (e.g. 32492 vertices of fs_LR 32k), medial wall is nan.
+                   By default is False
 
         """
-        img = nib.load(self._comp_file)
-        data = img.get_data()
-
-        # when reading data with old version of nibabel, data may have 5 or 6 dimensions. Use command below to downsize dimension to 2
-        while data.ndim >2:
-            data = data[0]
-
+        lazyimg = LazyImage(self._comp_file)
+        if contrast == 'lazy':
+            return lazyimg
         if contrast is None:
-            data = data[0]
+            row = 0
         elif type(contrast) == int:
-            data = data[contrast-1]
+            row = contrast-1
         else:
             raise Exception('contrast should be an int or None')
+        if structure is None:
+            data = lazyimg.rows(row)
+        else:
+            data = lazyimg.structure(structure, row, vertexmap)
         return data
-   
-    def save(self):
-        pass
- 
+
+    def save(self, data, template, names = None, label_table = None, dtype = np.float32):
+        """
+        Save cifti data, the brain model axis is reused from template.
+        Map type follows the filename: .dscalar.nii (maps), .dlabel.nii (label maps, e.g. mpm) or .dtseries.nii (series)
+
+        Parameters:
+        --------------
+        data: ngrayordinate or nmap x ngrayordinate array
+        template: cifti filename, LazyImage, Cifti2Image, CiftiBrainModels or BrainModelAxis with the same grayordinates
+        names: map names, by default is '#1', '#2', ...
+        label_table: label table of .dlabel.nii, {key: (name, (r, g, b, a))}.
+                     By default label table of a dlabel template is reused, labels not in label table are named by their keys
+        dtype: data type, by default is float32
+
+        Example:
+        --------
+        >>> iofiles.make_ioinstance('mpm.dlabel.nii').save(mpm, 'template.dscalar.nii', 'mpm', {1: ('FFA', (1,0,0,1))})
+        """
+        template = _resolve_template(template)
+        if template.models is None:
+            raise Exception('A cifti template is needed.')
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[None,:]
+        if data.ndim != 2 or data.shape[1] != len(template.models):
+            raise Exception('data should have {} grayordinates in the last dimension.'.format(len(template.models)))
+        nmap = data.shape[0]
+        if self._comp_file.endswith('dscalar.nii'):
+            names = _map_names(names, nmap)
+            key = ('ConnDenseScalar', tuple(names))
+            make_axis = lambda: nib.cifti2.ScalarAxis(names)
+        elif self._comp_file.endswith('dlabel.nii'):
+            if label_table is None and isinstance(template.rowaxis, nib.cifti2.LabelAxis):
+                label_table = template.rowaxis.label[0]
+            names = _map_names(names, nmap)
+            table = _label_table(data, label_table)
+            key = ('ConnDenseLabel', tuple(names), tuple(sorted(table.items())))
+            make_axis = lambda: nib.cifti2.LabelAxis(names, [table]*nmap)
+        elif self._comp_file.endswith('dtseries.nii'):
+            if isinstance(template.rowaxis, nib.cifti2.SeriesAxis):
+                series = (template.rowaxis.start, template.rowaxis.step, nmap, template.rowaxis.unit)
+            else:
+                series = (0, 1, nmap, 'SECOND')
+            key = ('ConnDenseSeries',) + series
+            make_axis = lambda: nib.cifti2.SeriesAxis(*series)
+        else:
+            raise Exception('Only dscalar, dlabel and dtseries are supported to save.')
+        key = key + (np.dtype(dtype).str,)
+        if key not in template.headers:
+            img = nib.Cifti2Image(np.zeros(data.shape, dtype = dtype), header = (make_axis(), template.models.axis))
+            img.nifti_header.set_intent(key[0])
+            template.headers[key] = _cifti_header_bytes(img)
+        header, hdrdtype = template.headers[key]
+        outdata = _lossless_cast(data, hdrdtype)
+        def _write(tmpfile):
+            with open(tmpfile, 'wb') as f:
+                f.write(header)
+                f.write(outdata.tobytes('F'))
+        _atomic_write(self._comp_file, _write)
+
+class _C4D(object):
+    def __init__(self, _comp_file):
+        self._comp_file = _comp_file
+
+    def save(self, data, affine = None, chunks = None, compresslevel = 1, n_jobs = 1):
+        """
+        Save 4D data into chunked store (.c4d)
+        ---------------------------------------
+        Parameters:
+            data: 4D array
+            affine: affine matrix
+            chunks: chunk shape, see chunkstore.ChunkStore.create
+            compresslevel: zlib compress level
+            n_jobs: threads for compressing
+        """
+        store = chunkstore.ChunkStore.create(self._comp_file, data.shape, data.dtype, chunks, compresslevel, affine)
+        for t in range(0, data.shape[3], store.chunks[3]):
+            store.write_block(data[..., t:t+store.chunks[3]], t, n_jobs)
+        return store
+
+    def load(self):
+        """
+        Open chunked store, data will be read when sliced or iterated
+        """
+        return chunkstore.ChunkStore(self._comp_file)
+
 class _GIFTI(object):
     def __init__(self, _comp_file):
         self._comp_file = _comp_file
@@ -276,6 +1112,68 @@ class _GIFTI(object):
                 data.append(img.darrays[i].data)
         return data
 
-    def save(self):
-        pass
+    def save(self, data, template = None, structure = None, names = None, label_table = None):
+        """
+        Save gifti data of a single hemisphere.
+        Map type follows the filename: .label.gii for label maps (e.g. mpm), others (.func.gii, .shape.gii) for maps
+
+        Parameters:
+        --------------
+        data: nvertex or nmap x nvertex array.
+              If template is a cifti, data could also be grayordinates of structure, they're mapped into all vertices
+              (medial wall is nan for maps and 0 for labels)
+        template: gifti filename or GiftiImage (its metadata is reused),
+                  or cifti filename, LazyImage, Cifti2Image, CiftiBrainModels with structure
+        structure: hemisphere of data, e.g. 'L' or 'R', needed for a cifti template
+        names: map names, by default is '#1', '#2', ...
+        label_table: label table of .label.gii, {key: (name, (r, g, b, a))}.
+                     By default labels are named by their keys
+
+        Example:
+        --------
+        >>> iofiles.make_ioinstance('lh.pm.func.gii').save(pm, 'template.dscalar.nii', 'L')
+        """
+        template = _resolve_template(template)
+        islabel = self._comp_file.endswith('label.gii')
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[None,:]
+        if data.ndim != 2:
+            raise Exception('data should be nvertex or nmap x nvertex array.')
+        meta = nib.gifti.GiftiMetaData()
+        if template.gifti is not None:
+            meta.update(template.gifti.meta)
+        if structure is not None:
+            meta['AnatomicalStructurePrimary'] = _gifti_structure_name(structure)
+        if template.models is not None:
+            if structure is None:
+                raise Exception('structure is needed for a cifti template.')
+            if data.shape[1] == template.models.slice(structure).stop-template.models.slice(structure).start:
+                data = template.models.to_vertices(data, structure, 0 if islabel else np.nan)
+            elif data.shape[1] != template.models.nvertices(structure):
+                raise Exception('data mismatched with vertices of structure {}.'.format(structure))
+        names = _map_names(names, data.shape[0])
+        if islabel:
+            labeltable = nib.gifti.GiftiLabelTable()
+            for key, (name, rgba) in sorted(_label_table(data, label_table).items()):
+                label = nib.gifti.GiftiLabel(key, *rgba)
+                label.label = name
+                labeltable.labels.append(label)
+            darrays = [nib.gifti.GiftiDataArray(d.astype(np.int32), intent = 'NIFTI_INTENT_LABEL', datatype = 'NIFTI_TYPE_INT32', meta = {'Name': n}) for d, n in zip(data, names)]
+            img = nib.GiftiImage(meta = meta, labeltable = labeltable, darrays = darrays)
+        else:
+            darrays = [nib.gifti.GiftiDataArray(d.astype(np.float32), intent = 'NIFTI_INTENT_NONE', datatype = 'NIFTI_TYPE_FLOAT32', meta = {'Name': n}) for d, n in zip(data, names)]
+            img = nib.GiftiImage(meta = meta, darrays = darrays)
+        _atomic_save(img, self._comp_file)
 
+class _SURFGII(object):
+    def __init__(self, _comp_file):
+        self._comp_file = _comp_file
+
+    def load(self, cache = True):
+        """
+        Read gifti surface as a surfgeometry.SurfaceGeometry (coordinates in float32, faces in int32).
+        Derived products (adjacency, edge lengths, vertex areas, normals) are computed when used,
+        and kept in a sidecar cache next to the surface file if cache is True.
+        """
+        return surfgeometry.SurfaceGeometry.from_file(self._comp_file, cache)
@@ -0,0 +1,237 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import numpy as np
+import nibabel as nib
+from scipy import sparse
+
+_POINTSET = nib.nifti1.intent_codes.code['NIFTI_INTENT_POINTSET']
+_TRIANGLE = nib.nifti1.intent_codes.code['NIFTI_INTENT_TRIANGLE']
+
+# products saved into sidecar cache, adjacency is saved as its csr arrays
+_CACHED = ('edges', 'edge_lengths', 'face_areas', 'face_normals', 'vertex_areas', 'vertex_normals', 'indptr', 'indices')
+
+def cache_filename(filename):
+    """
+    Sidecar cache of a surface file, lies next to it
+    """
+    return filename + '.geom.npz'
+
+class SurfaceGeometry(object):
+    """
+    Surface mesh with lazily computed derived products.
+    Products are computed once when first used, and kept in a sidecar cache (.geom.npz next to the surface file)
+    if the geometry is loaded from file, so later runs read them instead of computing from faces again.
+    ---------------------------------------------
+    Parameters:
+        coords: vertex coordinates, nvertex x 3 (float32)
+        faces: triangles, nface x 3 (int32)
+        filename: surface filename, by default is None (no cache)
+        cache: use sidecar cache or not, by default is True
+    Example:
+        >>> geometry = SurfaceGeometry.from_file('lh.midthickness.surf.gii')
+        >>> tfcemap = permutation_tools.tfce(tmap, geometry.adjacency)
+        >>> dist = surf_tools.surf_dist(vtx_src, vtx_dst, geometry.one_ring_neighbour)
+    """
+    def __init__(self, coords, faces, filename = None, cache = True):
+        self.coords = np.ascontiguousarray(coords, dtype = np.float32)
+        self.faces = np.ascontiguousarray(faces, dtype = np.int32)
+        if self.coords.ndim != 2 or self.coords.shape[1] != 3:
+            raise Exception('coords should be an array of nvertex x 3')
+        if self.faces.ndim != 2 or self.faces.shape[1] != 3:
+            raise Exception('faces should be an array of nface x 3')
+        self.filename = filename
+        self._cachefile = cache_filename(filename) if (filename is not None and cache) else None
+        self._cache = {}
+        # sidecar cache is written once after a batch of products (see precompute)
+        self._deferred = False
+        if self._cachefile is not None:
+            self._read_cache()
+
+    @classmethod
+    def from_file(cls, filename, cache = True):
+        """
+        Load geometry from a gifti surface (.surf.gii)
+        """
+        img = nib.load(filename)
+        coords = None
+        faces = None
+        for darray in img.darrays:
+            if darray.intent == _POINTSET:
+                coords = darray.data
+            elif darray.intent == _TRIANGLE:
+                faces = darray.data
+        if coords is None or faces is None:
+            # intents are not set by some softwares, judge by data type instead
+            for darray in img.darrays:
+                if np.issubdtype(darray.data.dtype, np.floating) and coords is None:
+                    coords = darray.data
+                elif np.issubdtype(darray.data.dtype, np.integer) and faces is None:
+                    faces = darray.data
+        if coords is None or faces is None:
+            raise Exception('{} is not a surface file.'.format(filename))
+        return cls(coords, faces, os.path.abspath(filename), cache)
+
+    def __repr__(self):
+        return 'SurfaceGeometry({0} vertices, {1} faces)'.format(self.nvertex, self.nface)
+
+    @property
+    def nvertex(self):
+        return self.coords.shape[0]
+
+    @property
+    def nface(self):
+        return self.faces.shape[0]
+
+    def _key(self):
+        stat = os.stat(self.filename)
+        return np.array([stat.st_size, stat.st_mtime_ns, self.nvertex, self.nface], dtype = np.int64)
+
+    def _read_cache(self):
+        if not os.path.exists(self._cachefile):
+            return
+        try:
+            with np.load(self._cachefile, allow_pickle = False) as f:
+                if '_key' not in f.files or not np.array_equal(f['_key'], self._key()):
+                    return
+                for name in f.files:
+                    if name in _CACHED:
+                        self._cache[name] = f[name]
+        except (IOError, OSError, ValueError):
+            self._cache = {}
+
+    def _write_cache(self):
+        try:
+            tmpfile = self._cachefile + '.tmp.npz'
+            products = dict((name, value) for name, value in self._cache.items() if name in _CACHED)
+            np.savez(tmpfile, _key = self._key(), **products)
+            os.replace(tmpfile, self._cachefile)
+        except (IOError, OSError):
+            # cache is optional, a read-only data directory should not break loading
+            pass
+
+    def _get(self, name, func):
+        if name not in self._cache:
+            products = func()
+            if isinstance(products, dict):
+                self._cache.update(products)
+            else:
+                self._cache[name] = products
+            if self._cachefile is not None and not self._deferred:
+                self._write_cache()
+        return self._cache[name]
+
+    def precompute(self):
+        """
+        Compute all products (and write them into the sidecar cache)
+        """
+        missing = [name for name in _CACHED if name not in self._cache]
+        self._deferred = True
+        try:
+            for name in ('adjacency', 'edge_lengths', 'vertex_areas', 'vertex_normals'):
+                getattr(self, name)
+        finally:
+            self._deferred = False
+        if self._cachefile is not None and missing:
+            self._write_cache()
+        return self
+
+    @property
+    def edges(self):
+        """
+        Unique edges (i<j), nedge x 2
+        """
+        return self._get('edges', self._compute_edges)
+
+    def _compute_edges(self):
+        pairs = np.concatenate((self.faces[:,[0,1]], self.faces[:,[1,2]], self.faces[:,[2,0]]))
+        pairs.sort(axis = 1)
+        codes = np.unique(pairs[:,0].astype(np.int64)*self.nvertex + pairs[:,1])
+        return np.stack(np.divmod(codes, self.nvertex), axis = 1).astype(np.int32)
+
+    @property
+    def adjacency(self):
+        """
+        Binary symmetric adjacency matrix (scipy CSR), nvertex x nvertex
+        """
+        if 'adjacency' not in self._cache:
+            indptr = self._get('indptr', self._compute_csr)
+            indices = self._cache['indices']
+            self._cache['adjacency'] = sparse.csr_matrix((np.ones(indices.size), indices, indptr), shape = (self.nvertex, self.nvertex))
+        return self._cache['adjacency']
+
+    def _compute_csr(self):
+        edges = self.edges
+        rows = np.concatenate((edges[:,0], edges[:,1]))
+        cols = np.concatenate((edges[:,1], edges[:,0]))
+        adjacency = sparse.csr_matrix((np.ones(rows.size), (rows, cols)), shape = (self.nvertex, self.nvertex))
+        adjacency.sort_indices()
+        return {'indptr': adjacency.indptr.astype(np.int64), 'indices': adjacency.indices.astype(np.int32)}
+
+    @property
+    def one_ring_neighbour(self):
+        """
+        One ring neighbours of each vertex, list of arrays (views of the adjacency)
+        """
+        adjacency = self.adjacency
+        return np.split(adjacency.indices, adjacency.indptr[1:-1])
+
+    @property
+    def edge_lengths(self):
+        """
+        Euclidean length of each edge (same order as edges)
+        """
+        return self._get('edge_lengths', self._compute_edge_lengths)
+
+    def _compute_edge_lengths(self):
+        edges = self.edges
+        return np.linalg.norm(self.coords[edges[:,0]] - self.coords[edges[:,1]], axis = 1).astype(np.float32)
+
+    def weighted_adjacency(self):
+        """
+        Symmetric adjacency matrix (scipy CSR) weighted by edge lengths, for geodesic distance (scipy.sparse.csgraph)
+        """
+        edges = self.edges
+        lengths = self.edge_lengths.astype(np.float64)
+        return sparse.csr_matrix((np.concatenate((lengths, lengths)), (np.concatenate((edges[:,0], edges[:,1])), np.concatenate((edges[:,1], edges[:,0])))), shape = (self.nvertex, self.nvertex))
+
+    def _compute_faces(self):
+        v0, v1, v2 = (self.coords[self.faces[:,i]].astype(np.float64) for i in range(3))
+        cross = np.cross(v1 - v0, v2 - v0)
+        norm = np.linalg.norm(cross, axis = 1)
+        normals = np.zeros_like(cross)
+        np.divide(cross, norm[:,None], out = normals, where = norm[:,None] != 0)
+        # vertex normals are weighted by face areas, cross product is twice the area
+        vertex_normals = np.stack([np.bincount(self.faces.ravel(), weights = np.repeat(cross[:,i], 3), minlength = self.nvertex) for i in range(3)], axis = 1)
+        vnorm = np.linalg.norm(vertex_normals, axis = 1)
+        np.divide(vertex_normals, vnorm[:,None], out = vertex_normals, where = vnorm[:,None] != 0)
+        return {'face_areas': (0.5*norm).astype(np.float32),
+                'face_normals': normals.astype(np.float32),
+                'vertex_areas': np.bincount(self.faces.ravel(), weights = np.repeat(norm/6.0, 3), minlength = self.nvertex).astype(np.float32),
+                'vertex_normals': vertex_normals.astype(np.float32)}
+
+    @property
+    def face_areas(self):
+        return self._get('face_areas', self._compute_faces)
+
+    @property
+    def face_normals(self):
+        """
+        Unit normal of each face, orientation follows vertex order of faces
+        """
+        return self._get('face_normals', self._compute_faces)
+
+    @property
+    def vertex_areas(self):
+        """
+        Area of each vertex, one third of areas of faces around it
+        """
+        return self._get('vertex_areas', self._compute_faces)
+
+    @property
+    def vertex_normals(self):
+        """
+        Unit normal of each vertex, average of normals of faces around it weighted by face areas
+        """
+        return self._get('vertex_normals', self._compute_faces)
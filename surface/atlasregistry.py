@@ -0,0 +1,237 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 et:
+
+import os
+import zipfile
+import hashlib
+import numpy as np
+import nibabel as nib
+
+from ATT.iofunc import iofiles
+from ATT.util import decorators
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+# parsed atlases are cached next to cached results (environment variable ATT_RESULT_CACHE)
+CACHE_PATH = os.path.join(decorators.CACHE_PATH, 'atlas')
+
+_REGISTRY = {}
+
+def list_atlases():
+    """
+    List atlases (dlabel files) shipped in data directory
+
+    Return:
+    -------
+    atlases: list of atlas filenames
+    """
+    return sorted(f for f in os.listdir(DATA_PATH) if f.endswith('.dlabel.nii'))
+
+def file_hash(filename, blocksize = 1<<20):
+    """
+    blake2b digest of file content
+    """
+    h = hashlib.blake2b(digest_size = 16)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def load_atlas(atlas, map_index = 0, use_cache = True):
+    """
+    Load a dlabel atlas, it's parsed only once.
+    Parsed atlas is kept in memory and in a binary sidecar cache (CACHE_PATH, keyed by file hash),
+    so later loads (even in other processes) don't parse the cifti again.
+
+    Parameters:
+    -----------
+    atlas: atlas filename in data directory (see list_atlases), or path of a dlabel file
+    map_index: index of label map in dlabel file, by default is 0
+    use_cache: use sidecar cache or not, by default is True
+
+    Return:
+    -------
+    atlas: Atlas instance
+
+    Example:
+    --------
+    >>> atlas = load_atlas('Q1-Q6_RelatedParcellation210.CorticalAreas_dil_Colors.32k_fs_LR.dlabel.nii')
+    >>> signals = atlas.extract(data, 'mean')
+    """
+    filename = atlas if os.path.exists(atlas) else os.path.join(DATA_PATH, atlas)
+    if not os.path.exists(filename):
+        raise Exception('Atlas {} not found.'.format(atlas))
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, stat.st_size, map_index)
+    if key in _REGISTRY:
+        return _REGISTRY[key]
+    digest = file_hash(filename)
+    cachefile = os.path.join(CACHE_PATH, '{0}_{1}.npz'.format(digest, map_index))
+    parsed = None
+    if use_cache and os.path.exists(cachefile):
+        try:
+            parsed = iofiles.make_ioinstance(cachefile).load(mmap = False)
+        except (IOError, ValueError, zipfile.BadZipFile):
+            parsed = None
+    if parsed is None:
+        parsed = _parse_dlabel(filename, map_index)
+        if use_cache:
+            _save_cache(cachefile, parsed)
+    _REGISTRY[key] = Atlas(filename, parsed)
+    return _REGISTRY[key]
+
+def _parse_dlabel(filename, map_index):
+    """
+    Parse dlabel file into plain arrays
+    """
+    lazyimg = iofiles.load_lazy(filename)
+    labelaxis = lazyimg.header.get_axis(0)
+    if not isinstance(labelaxis, nib.cifti2.LabelAxis):
+        raise Exception('{} is not a dlabel file.'.format(filename))
+    models = lazyimg.brain_model_axis()
+    data = lazyimg.rows(map_index)
+    table = labelaxis.label[map_index]
+    keys = np.array(sorted(table.keys()), dtype = np.int32)
+    structures, starts, stops, vertices, nvertices = [], [], [], [], []
+    for name, slc in sorted(models.structures.items(), key = lambda item: item[1].start):
+        structures.append(name)
+        starts.append(slc.start)
+        stops.append(slc.stop)
+        if models.is_surface(name):
+            vertices.append(models.vertices(name).astype(np.int32))
+            nvertices.append(models.nvertices(name))
+        else:
+            vertices.append(np.full(slc.stop-slc.start, -1, dtype = np.int32))
+            nvertices.append(0)
+    return {'data': np.round(data).astype(np.int32),
+            'keys': keys,
+            'names': np.array([table[k][0] for k in keys]),
+            'colors': np.array([table[k][1] for k in keys], dtype = float),
+            'structures': np.array(structures),
+            'starts': np.array(starts, dtype = np.int64),
+            'stops': np.array(stops, dtype = np.int64),
+            'vertices': np.concatenate(vertices) if vertices else np.zeros(0, dtype = np.int32),
+            'nvertices': np.array(nvertices, dtype = np.int64)}
+
+def _save_cache(cachefile, parsed):
+    try:
+        if not os.path.isdir(CACHE_PATH):
+            os.makedirs(CACHE_PATH)
+        iofiles.make_ioinstance(cachefile).save(parsed)
+    except (IOError, OSError):
+        # cache is optional, a read-only home directory should not break loading
+        pass
+
+class Atlas(object):
+    """
+    Parsed dlabel atlas, created by load_atlas
+    -------------------------------------------
+    Attributes:
+        filename: atlas filename
+        data: label of each grayordinate
+        labels: non-zero labels in label table
+        names: name of each label
+        colors: rgba of each label
+        structures: brain model structures, name -> slice of grayordinates
+    """
+    def __init__(self, filename, parsed):
+        self.filename = filename
+        self.data = parsed['data']
+        keys = parsed['keys']
+        nonzero = keys != 0
+        self.labels = keys[nonzero]
+        self.names = [str(n) for n in parsed['names'][nonzero]]
+        self.colors = parsed['colors'][nonzero]
+        self.structures = dict((str(name), slice(int(start), int(stop))) for name, start, stop in zip(parsed['structures'], parsed['starts'], parsed['stops']))
+        self._vertices = parsed['vertices']
+        self._nvertices = dict((str(name), int(n)) for name, n in zip(parsed['structures'], parsed['nvertices']))
+        # grayordinates sorted by label, label_index are segments of it
+        self._order = np.argsort(self.data, kind = 'stable')
+        sortedlabel = self.data[self._order]
+        self._bounds = dict((int(lbl), (int(start), int(stop))) for lbl, start, stop in zip(self.labels, np.searchsorted(sortedlabel, self.labels, 'left'), np.searchsorted(sortedlabel, self.labels, 'right')))
+
+    def __repr__(self):
+        return 'Atlas({0}, {1} labels)'.format(os.path.basename(self.filename), self.labels.size)
+
+    def name2label(self, name):
+        """
+        Label of a region name
+        """
+        if name not in self.names:
+            raise Exception('Region {} not in atlas.'.format(name))
+        return int(self.labels[self.names.index(name)])
+
+    def label_index(self, label):
+        """
+        Grayordinate indices of a label (or a region name), precomputed
+        """
+        if isinstance(label, str):
+            label = self.name2label(label)
+        start, stop = self._bounds.get(int(label), (0, 0))
+        return self._order[start:stop]
+
+    def label_indexes(self, labelnum = None):
+        """
+        Grayordinate indices of labels 1...labelnum (by default the maximum label), empty for missing labels
+        """
+        if labelnum is None:
+            labelnum = int(self.labels.max()) if self.labels.size else 0
+        return [self.label_index(i+1) for i in range(labelnum)]
+
+    def hemi_vertices(self, hemi):
+        """
+        Surface vertex number of each grayordinate of a hemisphere
+
+        Parameters:
+        -----------
+        hemi: 'L' or 'R', or a structure name
+        """
+        structure = _hemi_structure(hemi)
+        if structure not in self.structures:
+            raise Exception('Structure {} not in atlas.'.format(structure))
+        return self._vertices[self.structures[structure]]
+
+    def hemi_map(self, hemi, fill = 0):
+        """
+        Label map on all surface vertices of a hemisphere (e.g. 32492 vertices of fs_LR 32k),
+        vertices without grayordinates (medial wall) are filled by fill
+        """
+        structure = _hemi_structure(hemi)
+        vertices = self.hemi_vertices(hemi)
+        hemimap = np.full(self._nvertices[structure], fill, dtype = np.result_type(self.data.dtype, np.min_scalar_type(fill)))
+        hemimap[vertices] = self.data[self.structures[structure]]
+        return hemimap
+
+    def extract(self, data, method = 'mean', labels = None):
+        """
+        Extract roi signals from grayordinate data with precomputed label indexes
+
+        Parameters:
+        -----------
+        data: grayordinate data, (..., ngrayordinate)
+        method: 'mean', 'std', 'max', 'min', 'sum' (nan ignored), or 'vertex' (list of roi values)
+        labels: labels (or region names) to extract, by default all labels of atlas
+
+        Return:
+        -------
+        signals: (..., nlabel) array, nan for empty labels. A list if method is 'vertex'
+        """
+        data = np.asarray(data)
+        if data.shape[-1] != self.data.size:
+            raise Exception('data should have {} grayordinates in the last dimension'.format(self.data.size))
+        if labels is None:
+            labels = self.labels
+        indexes = [self.label_index(lbl) for lbl in labels]
+        if method == 'vertex':
+            return [data[..., idx] for idx in indexes]
+        funcs = {'mean': np.nanmean, 'std': np.nanstd, 'max': np.nanmax, 'min': np.nanmin, 'sum': np.nansum}
+        if method not in funcs:
+            raise Exception("method should be 'mean', 'std', 'max', 'min', 'sum' or 'vertex'")
+        signals = np.full(data.shape[:-1] + (len(indexes),), np.nan)
+        for i, idx in enumerate(indexes):
+            if idx.size:
+                signals[..., i] = funcs[method](data[..., idx], axis = -1)
+        return signals
+
+def _hemi_structure(hemi):
+    return iofiles._cifti_structure_name(hemi)
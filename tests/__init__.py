@@ -0,0 +1,11 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+"""
+Regression tests of vectorized engines, each compared with a brute-force loop on small synthetic data
+
+Usage (from the parent directory of ATT):
+    $ python -m pytest ATT/tests
+"""
+
+__all__ = []
@@ -0,0 +1,92 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+from ATT.volume import atlasbase
+from ATT.iofunc import iofiles
+
+def _images(path, dtypes):
+    rng = np.random.RandomState(0)
+    affine = np.diag([2., 2., 2., 1.])
+    filenames = []
+    for i, dtype in enumerate(dtypes):
+        data = (rng.standard_normal((5, 6, 4))*10).astype(dtype)
+        filename = str(path / 'img{}.nii.gz'.format(i))
+        nib.Nifti1Image(data, affine).to_filename(filename)
+        filenames.append(filename)
+    return filenames
+
+def test_merge4D_matches_nibabel(tmp_path):
+    filenames = _images(tmp_path, ['int16']*4)
+    expected = np.stack([nib.load(f).get_fdata() for f in filenames], axis = 3)
+    imccls = atlasbase.ImageCalculator()
+    for n_jobs in (1, 3):
+        outfile = str(tmp_path / 'merged{}.nii.gz'.format(n_jobs))
+        outdata = imccls.merge4D(filenames, outfile, None, n_jobs = n_jobs)
+        assert outdata.dtype == np.int16
+        np.testing.assert_array_equal(outdata, expected)
+        img = nib.load(outfile)
+        assert img.get_data_dtype() == np.int16
+        np.testing.assert_array_equal(img.get_fdata(), expected)
+    assert imccls.merge4D(filenames, str(tmp_path / 'noreturn.nii.gz'), None, returndata = False) is None
+    np.testing.assert_array_equal(nib.load(str(tmp_path / 'noreturn.nii.gz')).get_fdata(), expected)
+
+def test_merge4D_dtype_and_store(tmp_path):
+    filenames = _images(tmp_path, ['int16', 'float32'])
+    expected = np.stack([nib.load(f).get_fdata() for f in filenames], axis = 3)
+    imccls = atlasbase.ImageCalculator()
+    outdata = imccls.merge4D(filenames, None, None, issave = False)
+    assert outdata.dtype == np.float32
+    np.testing.assert_allclose(outdata, expected)
+    store = imccls.merge4D(filenames, str(tmp_path / 'merged.c4d'), None, chunks = (3, 3, 3, 1), n_jobs = 2)
+    np.testing.assert_allclose(store[...], expected)
+    np.testing.assert_array_equal(store.affine, nib.load(filenames[0]).affine)
+
+def test_decompose_img_round_trip(tmp_path):
+    filenames = _images(tmp_path, ['int16']*3)
+    imccls = atlasbase.ImageCalculator()
+    merged = str(tmp_path / 'merged.nii')
+    expected = imccls.merge4D(filenames, merged, None)
+    for n_jobs, compresslevel in ((1, None), (3, 0)):
+        outpath = tmp_path / 'out{}'.format(n_jobs)
+        os.mkdir(str(outpath))
+        imccls.decompose_img(merged, None, str(outpath), ['a', 'b', 'c'], compresslevel = compresslevel, n_jobs = n_jobs)
+        suffix = '.nii' if compresslevel == 0 else '.nii.gz'
+        # no temporary file left
+        assert sorted(os.listdir(str(outpath))) == sorted(name + suffix for name in 'abc')
+        for i, name in enumerate('abc'):
+            img = nib.load(str(outpath / (name + suffix)))
+            assert img.get_data_dtype() == np.int16
+            np.testing.assert_array_equal(img.get_fdata(), expected[...,i])
+
+def test_decompose_img_dtype(tmp_path):
+    header = nib.Nifti1Image(np.zeros((5, 6, 4), dtype = np.uint8), np.eye(4)).header
+    data = np.random.RandomState(1).standard_normal((5, 6, 4, 2))
+    imccls = atlasbase.ImageCalculator()
+    # float data could not be saved as uint8 of the header without loss
+    imccls.decompose_img(data, header, str(tmp_path))
+    for i in range(2):
+        img = nib.load(str(tmp_path / '{}.nii.gz'.format(i+1)))
+        assert img.get_data_dtype() == np.float32
+        np.testing.assert_allclose(img.get_fdata(), data[...,i], rtol = 1e-6)
+    labels = np.random.RandomState(2).randint(0, 5, (5, 6, 4, 2)).astype(np.uint8)
+    imccls.decompose_img(labels, header, str(tmp_path), ['l1', 'l2'])
+    img = nib.load(str(tmp_path / 'l2.nii.gz'))
+    assert img.get_data_dtype() == np.uint8
+    np.testing.assert_array_equal(img.get_fdata(), labels[...,1])
+
+def test_nifti_writer_lossless(tmp_path):
+    header = nib.Nifti1Image(np.zeros((5, 6, 4), dtype = np.int16), np.eye(4)).header
+    filename = str(tmp_path / 'lossy.nii.gz')
+    with pytest.raises(Exception):
+        with iofiles._NIFTI(filename).open_writer(header, (5, 6, 4), np.int16) as writer:
+            writer.write(np.full((5, 6, 4), 0.5))
+    assert os.listdir(str(tmp_path)) == []
+    # integer valued floats could be saved as int
+    with iofiles._NIFTI(filename).open_writer(header, (5, 6, 4), np.int16) as writer:
+        writer.write(np.full((5, 6, 4), 3.0))
+    np.testing.assert_array_equal(nib.load(filename).get_fdata(), 3)
@@ -0,0 +1,48 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import numpy as np
+import nibabel as nib
+
+from ATT.iofunc import iofiles
+from ATT.surface import atlasregistry
+
+def _dlabel(filename):
+    left = nib.cifti2.BrainModelAxis.from_mask(np.arange(12) % 4 != 0, name = 'CortexLeft')
+    right = nib.cifti2.BrainModelAxis.from_mask(np.arange(10) % 3 != 0, name = 'CortexRight')
+    models = left + right
+    data = (np.arange(len(models)) % 3).astype(np.float32)[None]
+    table = {0: ('???', (0., 0., 0., 0.)), 1: ('A', (1., 0., 0., 1.)), 2: ('B', (0., 1., 0., 1.))}
+    img = nib.Cifti2Image(data, header = (nib.cifti2.LabelAxis(['parc'], table), models))
+    img.nifti_header.set_intent('ConnDenseLabel')
+    img.to_filename(filename)
+    return data[0]
+
+def test_load_atlas_npz_cache(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'parc.dlabel.nii')
+    data = _dlabel(filename)
+    cachedir = str(tmp_path / 'cache')
+    monkeypatch.setattr(atlasregistry, 'CACHE_PATH', cachedir)
+    monkeypatch.setattr(atlasregistry, '_REGISTRY', {})
+    atlas = atlasregistry.load_atlas(filename)
+    np.testing.assert_array_equal(atlas.data, data)
+    assert atlas.names == ['A', 'B']
+    assert atlas.hemi_map('L').shape == (12,)
+    assert atlasregistry.load_atlas(filename) is atlas
+    cachefiles = os.listdir(cachedir)
+    assert cachefiles == ['{}_0.npz'.format(atlasregistry.file_hash(filename))]
+    cached = iofiles.make_ioinstance(os.path.join(cachedir, cachefiles[0])).load()
+    np.testing.assert_array_equal(cached['data'], data)
+    # another process reads the sidecar cache without parsing the cifti
+    def _parse_dlabel(filename, map_index):
+        raise AssertionError('cached atlas should not be parsed again')
+    monkeypatch.setattr(atlasregistry, '_REGISTRY', {})
+    monkeypatch.setattr(atlasregistry, '_parse_dlabel', _parse_dlabel)
+    cachedatlas = atlasregistry.load_atlas(filename)
+    np.testing.assert_array_equal(cachedatlas.data, data)
+    np.testing.assert_array_equal(cachedatlas.label_index('B'), np.flatnonzero(data == 2))
+
+def test_cache_path_from_environment():
+    from ATT.util import decorators
+    assert atlasregistry.CACHE_PATH == os.path.join(decorators.CACHE_PATH, 'atlas')
@@ -0,0 +1,36 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+
+from ATT.benchmarks import run, suite
+
+def _record(times):
+    return {'results': dict((key, {'time_min': t, 'time_median': t, 'times': [t], 'peak_memory': None}) for key, t in times.items())}
+
+def test_compare_status():
+    baseline = _record({'a[1]': 1.0, 'b[1]': 1.0, 'c[1]': 1.0})
+    record = _record({'a[1]': 1.5, 'b[1]': 0.5, 'c[1]': 1.1, 'd[1]': 2.0})
+    rows = dict((row[0], row) for row in run.compare(record, baseline, threshold = 1.2))
+    assert rows['a[1]'][4] == 'regression' and rows['a[1]'][3] == 1.5
+    assert rows['b[1]'][4] == 'improvement'
+    assert rows['c[1]'][4] == 'same'
+    assert rows['d[1]'][4] == 'new' and rows['d[1]'][1] is None
+    assert 'regression' in run.report(record, list(rows.values()))
+
+def test_measure_peak_memory():
+    case = suite.Case('ones', lambda n: (n,), lambda n: np.ones(n).sum(), [2**20])
+    result = run.measure(case, 2**20, repeat = 2)
+    assert len(result['times']) == 2 and result['time_min'] <= result['time_median']
+    assert result['peak_memory'] >= 8*2**20
+
+def test_main_history_and_baseline(tmp_path):
+    history = str(tmp_path / 'history.json')
+    baseline = str(tmp_path / 'baseline.json')
+    args = ['-k', 'tools.pearsonr', '--quick', '--history', history, '--baseline', baseline]
+    assert run.main(args + ['--save-baseline']) == 0
+    assert run.main(args + ['--compare', '--threshold', '1e9', '--fail-on-regression']) == 0
+    records = run.load_json(history)
+    assert len(records) == 2
+    assert list(records[0]['results']) == ['tools.pearsonr[1000]']
+    assert run.load_json(baseline)['results'].keys() == records[0]['results'].keys()
@@ -0,0 +1,90 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+import pytest
+
+from ATT.iofunc import chunkstore
+from ATT.algorithm import vol_roimethod
+
+def _store(path, data, n_jobs = 1, compresslevel = 1):
+    store = chunkstore.ChunkStore.create(str(path), data.shape, data.dtype, chunks = (4, 3, 5, 3), compresslevel = compresslevel)
+    with store.appender(n_jobs) as app:
+        for i in range(data.shape[3]):
+            app.append(data[...,i])
+    return store
+
+def test_appender_and_slicing(tmp_path):
+    data = np.random.RandomState(0).standard_normal((9, 7, 5, 8)).astype(np.float32)
+    store = _store(tmp_path / 'a.c4d', data, n_jobs = 2)
+    store = chunkstore.ChunkStore(str(tmp_path / 'a.c4d'))
+    np.testing.assert_array_equal(store[...], data)
+    np.testing.assert_array_equal(np.asarray(store), data)
+    for key in ((slice(2, 7), slice(None), 3, slice(1, 6)),
+                (0, 1, 2, slice(None)),
+                (slice(None), slice(5, 7), slice(0, 1), 7),
+                (slice(8, 9),)):
+        np.testing.assert_array_equal(store[key], data[key])
+
+def test_iter_chunks_cover_data(tmp_path):
+    data = np.random.RandomState(1).randint(0, 100, (9, 7, 5, 8)).astype(np.int16)
+    store = _store(tmp_path / 'b.c4d', data, compresslevel = 0)
+    for n_jobs in (1, 3):
+        rebuilt = np.zeros_like(data)
+        for tslice, block in store.iter_chunks('subject', n_jobs):
+            rebuilt[...,tslice] = block
+        np.testing.assert_array_equal(rebuilt, data)
+        rebuilt = np.zeros_like(data)
+        count = np.zeros(data.shape[:3], dtype = int)
+        for slices, block in store.iter_chunks('space', n_jobs):
+            rebuilt[slices] = block
+            count[slices] += 1
+        np.testing.assert_array_equal(rebuilt, data)
+        assert np.all(count == 1)
+
+def test_write_block_n_jobs(tmp_path):
+    data = np.random.RandomState(2).standard_normal((6, 6, 6, 6))
+    stores = []
+    for n_jobs in (1, 4):
+        store = chunkstore.ChunkStore.create(str(tmp_path / '{}.c4d'.format(n_jobs)), data.shape, data.dtype, chunks = (4, 4, 4, 3))
+        store.write_block(data, 0, n_jobs)
+        stores.append(store[...])
+    np.testing.assert_array_equal(stores[0], data)
+    np.testing.assert_array_equal(stores[1], data)
+
+def test_write_block_partial_chunk_raises(tmp_path):
+    data = np.random.RandomState(3).standard_normal((4, 4, 4, 8))
+    store = chunkstore.ChunkStore.create(str(tmp_path / 'c.c4d'), data.shape, data.dtype, chunks = (4, 4, 4, 3))
+    store.write_block(data[...,:6], 0)
+    with pytest.raises(Exception):
+        store.write_block(data[...,6:7], 6)
+    store.write_block(data[...,6:], 6)
+    np.testing.assert_array_equal(store[...], data)
+
+def test_appender_partial_and_failure(tmp_path):
+    data = np.random.RandomState(4).standard_normal((4, 4, 4, 8))
+    store = chunkstore.ChunkStore.create(str(tmp_path / 'd.c4d'), data.shape, data.dtype, chunks = (4, 4, 4, 3))
+    with store.appender() as app:
+        for i in range(5):
+            app.append(data[...,i])
+    expected = data.copy()
+    expected[...,5:] = 0
+    np.testing.assert_array_equal(store[...], expected)
+    # a failed appending does not flush its buffer
+    store = chunkstore.ChunkStore.create(str(tmp_path / 'e.c4d'), data.shape, data.dtype, chunks = (4, 4, 4, 3))
+    with pytest.raises(Exception):
+        with store.appender() as app:
+            app.append(data[...,0])
+            app.append(data[:3,...,1])
+    assert np.all(store[...] == 0)
+
+def test_make_pm_chunked(tmp_path):
+    rng = np.random.RandomState(5)
+    labels = rng.randint(0, 3, (4, 4, 4, 6))
+    # the first subject block has no background voxel
+    labels[...,:3] = rng.randint(1, 3, (4, 4, 4, 3))
+    store = chunkstore.ChunkStore.create(str(tmp_path / 'f.c4d'), labels.shape, 'int16', chunks = (4, 4, 4, 3))
+    store.write_block(labels, 0)
+    for meth in ('all', 'part'):
+        np.testing.assert_allclose(vol_roimethod.make_pm(store, meth), vol_roimethod.make_pm(labels, meth))
+    np.testing.assert_allclose(vol_roimethod.make_pm(store)[...,0], np.mean(labels == 1, axis = 3))
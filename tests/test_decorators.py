@@ -0,0 +1,76 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import warnings
+import numpy as np
+import nibabel as nib
+import pytest
+
+from ATT.util import decorators
+from ATT.iofunc import iofiles, chunkstore
+
+def _counted(tmp_path):
+    calls = []
+    @decorators.cache(cachedir = str(tmp_path))
+    def total(data, axis = 0):
+        calls.append(1)
+        return np.sum(np.asarray(data), axis = axis)
+    return total, calls
+
+def test_cache_keys_and_invalidate(tmp_path):
+    total, calls = _counted(tmp_path)
+    data = np.arange(12.0).reshape(3, 4)
+    np.testing.assert_array_equal(total(data), data.sum(axis = 0))
+    np.testing.assert_array_equal(total(data.copy(), axis = 0), data.sum(axis = 0))
+    assert len(calls) == 1
+    total(data, 1)
+    data[0,0] = 100
+    np.testing.assert_array_equal(total(data), data.sum(axis = 0))
+    assert len(calls) == 3
+    total.invalidate(data)
+    total(data)
+    assert len(calls) == 4
+    total.cache_clear()
+    total(data, 1)
+    assert len(calls) == 5
+
+def test_cache_file_backed_inputs(tmp_path):
+    total, calls = _counted(tmp_path / 'cache')
+    filename = str(tmp_path / 'data.nii')
+    nib.Nifti1Image(np.ones((2, 3, 4), dtype = np.float32), np.eye(4)).to_filename(filename)
+    np.testing.assert_array_equal(total(iofiles.load_lazy(filename)), 2)
+    total(iofiles.load_lazy(filename))
+    assert len(calls) == 1
+    # same path and header, new content
+    nib.Nifti1Image(np.full((2, 3, 4), 3, dtype = np.float32), np.eye(4)).to_filename(filename)
+    os.utime(filename, ns = (1, 1))
+    np.testing.assert_array_equal(total(iofiles.load_lazy(filename)), 6)
+    assert len(calls) == 2
+
+    path = str(tmp_path / 'data.c4d')
+    store = chunkstore.ChunkStore.create(path, (2, 2, 2, 2), 'float32', chunks = (2, 2, 2, 1))
+    store.write_block(np.ones((2, 2, 2, 2)), 0)
+    np.testing.assert_array_equal(total(store), 2)
+    total(chunkstore.ChunkStore(path))
+    assert len(calls) == 3
+    store.write_block(np.full((2, 2, 2, 1), 5), 1)
+    np.testing.assert_array_equal(total(store)[...,1], 10)
+    assert len(calls) == 4
+
+def test_cache_unhashable_arguments(tmp_path):
+    total, calls = _counted(tmp_path)
+    # arguments which can not be pickled are run uncached
+    with pytest.warns(RuntimeWarning):
+        assert total(np.ones(3), axis = _Unpicklable()) == 3
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        total(np.ones(3), axis = _Unpicklable())
+    assert len(calls) == 2
+
+class _Unpicklable(object):
+    def __index__(self):
+        return 0
+
+    def __reduce__(self):
+        raise TypeError('can not pickle _Unpicklable')
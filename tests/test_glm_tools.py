@@ -0,0 +1,79 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+from scipy import stats
+
+from ATT.algorithm import glm_tools, tools
+
+def _data(seed = 0):
+    rng = np.random.RandomState(seed)
+    X = rng.standard_normal((40, 3))
+    Y = np.dot(X, rng.standard_normal((3, 25))) + 2*rng.standard_normal((40, 25)) + 5.0
+    return X, Y
+
+def _column_ols(X, y, c):
+    """
+    Ordinary least squares of one column by lstsq
+    """
+    beta = np.linalg.lstsq(X, y, rcond = None)[0]
+    residue = y - np.dot(X, beta)
+    df = X.shape[0] - np.linalg.matrix_rank(X)
+    sigma2 = np.dot(residue, residue)/df
+    var_c = np.dot(np.dot(c, np.linalg.inv(np.dot(X.T, X))), c)
+    return beta, np.dot(c, beta)/np.sqrt(sigma2*var_c), 1.0 - np.dot(residue, residue)/np.sum((y - y.mean())**2)
+
+def test_glm_matches_column_loop():
+    X, Y = _data()
+    design = np.hstack((X, np.ones((X.shape[0], 1))))
+    c = np.array([[1, -1, 0, 0], [0, 0, 1, 0]], dtype = float)
+    glm = glm_tools.MassUnivariateGLM(design).fit(Y, chunk_size = 7)
+    t, tpval = glm.tcontrast(c)
+    for j in range(Y.shape[1]):
+        for i in range(c.shape[0]):
+            beta, tval, r2 = _column_ols(design, Y[:,j], c[i])
+            np.testing.assert_allclose(glm.beta[:,j], beta)
+            np.testing.assert_allclose(t[i,j], tval)
+            np.testing.assert_allclose(glm.r2[j], r2)
+    np.testing.assert_allclose(tpval, 2*stats.t.sf(np.abs(t), X.shape[0] - design.shape[1]))
+
+def test_glm_chunks_and_memmap(tmp_path):
+    X, Y = _data(1)
+    design = np.hstack((X, np.ones((X.shape[0], 1))))
+    whole = glm_tools.MassUnivariateGLM(design).fit(Y)
+    memmap = np.lib.format.open_memmap(str(tmp_path / 'Y.npy'), 'w+', Y.dtype, Y.shape)
+    memmap[:] = Y
+    chunked = glm_tools.MassUnivariateGLM(design).fit(memmap, chunk_size = 4)
+    for name in ('beta', 'sse', 'sst', 'r2'):
+        np.testing.assert_allclose(getattr(chunked, name), getattr(whole, name))
+    np.testing.assert_allclose(chunked.fcontrast()[0], whole.fcontrast()[0])
+
+def test_mass_betafit_matches_lin_betafit():
+    from sklearn.linear_model import LinearRegression
+    X, Y = _data(2)
+    Y[:, 3] = 1.0
+    r2, beta, t, tpval, f, fpval = glm_tools.mass_betafit(X, Y, chunk_size = 6)
+    for j in range(Y.shape[1]):
+        if j == 3:
+            # constant column can not be standardized
+            assert np.all(np.isnan(beta[:,j])) and np.isnan(r2[j]) and np.all(np.isnan(t[:,j]))
+            continue
+        r2_loop, beta_loop = tools.lin_betafit(LinearRegression(), X, Y[:,j], np.eye(3)[0])[:2]
+        np.testing.assert_allclose(r2[j], r2_loop)
+        np.testing.assert_allclose(beta[:,j], beta_loop)
+        # t values account for the intercept in degrees of freedom
+        Xs = np.hstack((stats.zscore(X, axis = 0), np.ones((X.shape[0], 1))))
+        for i in range(3):
+            np.testing.assert_allclose(t[i,j], _column_ols(Xs, stats.zscore(Y[:,j]), np.eye(4)[i])[1])
+
+def test_mass_betafit_list_input_and_f_pvalues():
+    X, Y = _data(3)
+    r2, beta, t, tpval, f, fpval = glm_tools.mass_betafit(X.tolist(), Y[:,0].tolist())
+    r2_arr, beta_arr = glm_tools.mass_betafit(X, Y[:,:1])[:2]
+    np.testing.assert_allclose(beta, beta_arr)
+    np.testing.assert_allclose(r2, r2_arr)
+    # F test is one-sided whatever the tail of t tests
+    for tail in ('both', 'single'):
+        f, fpval = glm_tools.mass_betafit(X, Y, tail = tail)[4:]
+        np.testing.assert_allclose(fpval, stats.f.sf(f, X.shape[1], X.shape[0] - X.shape[1] - 1))
+        assert np.all(fpval <= 1)
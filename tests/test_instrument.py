@@ -0,0 +1,71 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import json
+import numpy as np
+import pytest
+
+from ATT.util import instrument
+
+@pytest.fixture
+def sink():
+    sinks = instrument.get_sinks()
+    verbosity = instrument.get_verbosity()
+    sink = instrument.MemorySink()
+    instrument.set_sinks([sink])
+    instrument.reset()
+    yield sink
+    instrument.set_sinks(sinks)
+    instrument.set_verbosity(verbosity)
+    instrument.reset()
+
+def test_nested_stages_and_counters(sink):
+    instrument.set_verbosity(2)
+    with instrument.stage('outer', nsubj = 3):
+        for _ in range(3):
+            with instrument.stage('inner'):
+                instrument.count('subjects')
+                instrument.progress('subject done')
+    assert [r['event'] for r in sink.records] == ['progress', 'stage']*3 + ['stage']
+    assert sink.records[0]['stage'] == 'outer/inner'
+    outer = sink.records[-1]
+    assert outer['name'] == 'outer' and outer['tags'] == {'nsubj': 3} and not outer['failed']
+    assert sink.records[1]['counters'] == {'subjects': 1}
+    stats, counters = instrument.summary()
+    assert stats['outer/inner']['calls'] == 3 and stats['outer']['calls'] == 1
+    assert stats['outer']['time'] >= stats['outer/inner']['time']
+    assert counters == {'subjects': 3}
+
+def test_verbosity_and_failed_stage(sink):
+    instrument.set_verbosity(1)
+    with pytest.raises(ValueError):
+        with instrument.stage('broken'):
+            instrument.progress('starting')
+            raise ValueError
+    # stage reports (level 2) are filtered out
+    assert [r['message'] for r in sink.records] == ['starting']
+    instrument.set_verbosity(0)
+    instrument.progress('hidden')
+    assert len(sink.records) == 1
+    instrument.set_verbosity(2)
+    with pytest.raises(ValueError):
+        with instrument.stage('broken'):
+            raise ValueError
+    assert sink.records[-1]['failed']
+
+def test_peak_memory_and_json_sink(sink, tmp_path):
+    filename = str(tmp_path / 'log.jsonl')
+    instrument.add_sink(instrument.JSONLinesSink(filename, level = 2))
+    instrument.track_memory(True)
+    try:
+        @instrument.stage('alloc')
+        def alloc():
+            return np.ones(2**20).sum()
+        alloc()
+    finally:
+        instrument.track_memory(False)
+    with open(filename) as f:
+        record = json.loads(f.readline())
+    assert record['name'] == 'alloc'
+    assert record['peak_memory'] >= 8*2**20
+    assert instrument.format_record(record).startswith('[alloc]')
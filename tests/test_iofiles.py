@@ -0,0 +1,169 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+from ATT.iofunc import iofiles
+
+def test_ftab_save_append_load(tmp_path):
+    rng = np.random.RandomState(0)
+    data1 = rng.standard_normal((4, 3))
+    data2 = rng.standard_normal((2, 3))
+    ftab = iofiles.make_ioinstance(str(tmp_path / 'table.ftab'))
+    ftab.save(data1, labels = ['a', 'b', 'c'], rowlabels = ['s1', 's2', 's3', 's4'], metadata = {'region': ['V1']})
+    ftab.append(data2, rowlabels = ['s5', 's6'])
+    meta = ftab.load_meta()
+    assert meta['nrows'] == 6 and meta['nchunks'] == 2
+    assert meta['columns'] == ['a', 'b', 'c'] and meta['metadata'] == {'region': ['V1']}
+    outdata, rowlabels = ftab.load(rowlabels = True)
+    np.testing.assert_array_equal(np.column_stack([outdata[key] for key in 'abc']), np.concatenate((data1, data2)))
+    np.testing.assert_array_equal(rowlabels, ['s1', 's2', 's3', 's4', 's5', 's6'])
+    np.testing.assert_array_equal(ftab.load('b')['b'], np.concatenate((data1[:,1], data2[:,1])))
+    with pytest.raises(Exception):
+        ftab.append(data2[:,:2], rowlabels = ['s7', 's8'])
+
+def test_ftab_zero_columns(tmp_path):
+    ftab = iofiles.make_ioinstance(str(tmp_path / 'empty.ftab'))
+    ftab.save(np.zeros((3, 0)))
+    ftab.append(np.zeros((2, 0)))
+    meta = ftab.load_meta()
+    assert meta['columns'] == [] and meta['nrows'] == 5 and meta['nchunks'] == 2
+    assert ftab.load() == {}
+
+    ftab = iofiles.make_ioinstance(str(tmp_path / 'labelled.ftab'))
+    ftab.save({}, rowlabels = ['s1', 's2'])
+    ftab.append({}, rowlabels = ['s3'])
+    assert ftab.load_meta()['nrows'] == 3
+    outdata, rowlabels = ftab.load(rowlabels = True)
+    assert outdata == {}
+    np.testing.assert_array_equal(rowlabels, ['s1', 's2', 's3'])
+
+def test_cifti_structure_loading(tmp_path):
+    left = nib.cifti2.BrainModelAxis.from_mask(np.arange(12) % 4 != 0, name = 'CortexLeft')
+    right = nib.cifti2.BrainModelAxis.from_mask(np.arange(10) % 3 != 0, name = 'CortexRight')
+    volmask = np.zeros((3, 3, 3), dtype = bool)
+    volmask[1, :, 2] = True
+    thalamus = nib.cifti2.BrainModelAxis.from_mask(volmask, name = 'ThalamusLeft', affine = np.eye(4))
+    models = left + right + thalamus
+    data = np.random.RandomState(3).standard_normal((2, len(models))).astype(np.float32)
+    filename = str(tmp_path / 'data.dscalar.nii')
+    nib.Cifti2Image(data, header = (nib.cifti2.ScalarAxis(['a', 'b']), models)).to_filename(filename)
+    lazyimg = iofiles.load_lazy(filename)
+    structures = lazyimg.brain_models()
+    assert structures == {'CIFTI_STRUCTURE_CORTEX_LEFT': slice(0, 9),
+                          'CIFTI_STRUCTURE_CORTEX_RIGHT': slice(9, 15),
+                          'CIFTI_STRUCTURE_THALAMUS_LEFT': slice(15, 18)}
+    bm = lazyimg.brain_model_axis()
+    np.testing.assert_array_equal(lazyimg.structure('R'), data[:, 9:15])
+    np.testing.assert_array_equal(lazyimg.structure('cortex_left', rows = 1), data[1, :9])
+    lh = lazyimg.structure('L', vertexmap = True)
+    assert lh.shape == (2, 12) and bm.nvertices('L') == 12
+    np.testing.assert_array_equal(lh[:, bm.vertices('L')], data[:, :9])
+    assert np.all(np.isnan(lh[:, ::4]))
+    assert not bm.is_surface('thalamus_left')
+    np.testing.assert_array_equal(bm.voxels('thalamus_left'), np.argwhere(volmask))
+    with pytest.raises(Exception):
+        bm.vertices('thalamus_left')
+
+def _template():
+    left = nib.cifti2.BrainModelAxis.from_mask(np.arange(12) % 4 != 0, name = 'CortexLeft')
+    right = nib.cifti2.BrainModelAxis.from_mask(np.arange(10) % 3 != 0, name = 'CortexRight')
+    return left + right
+
+def _nibabel_bytes(filename, data, rowaxis, models, intent):
+    img = nib.Cifti2Image(data, header = (rowaxis, models))
+    img.nifti_header.set_intent(intent)
+    img.to_filename(filename)
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def test_cifti_header_cache_matches_nibabel(tmp_path):
+    models = _template()
+    template = iofiles._resolve_template(models)
+    rng = np.random.RandomState(1)
+    maps = rng.standard_normal((3, 2, len(models))).astype(np.float32)
+    filenames = [str(tmp_path / 'map{}.dscalar.nii'.format(i)) for i in range(3)]
+    iofiles.save_maps(maps, filenames, template, n_jobs = 2, names = ['x', 'y'])
+    # one header serialized for the layout, shared by all files
+    assert len(template.headers) == 1
+    for data, filename in zip(maps, filenames):
+        with open(filename, 'rb') as f:
+            saved = f.read()
+        expected = _nibabel_bytes(str(tmp_path / 'ref.dscalar.nii'), data, nib.cifti2.ScalarAxis(['x', 'y']), models, 'ConnDenseScalar')
+        assert saved == expected
+        np.testing.assert_array_equal(iofiles.make_ioinstance(filename).load(), data[0])
+
+def test_cifti_dlabel_header_cache(tmp_path):
+    models = _template()
+    template = iofiles._resolve_template(models)
+    labels = np.random.RandomState(2).randint(0, 4, (2, len(models))).astype(np.float32)
+    table = {1: ('A', (1.0, 0.0, 0.0, 1.0))}
+    for i in range(2):
+        filename = str(tmp_path / 'label{}.dlabel.nii'.format(i))
+        iofiles.make_ioinstance(filename).save(labels[i], template, 'mpm', table)
+        img = nib.load(filename)
+        labeltable = img.header.get_axis(0).label[0]
+        assert labeltable[1][0] == 'A'
+        assert set(labeltable) == set(np.unique(labels[i]).astype(int)) | {0}
+        np.testing.assert_array_equal(img.get_fdata()[0], labels[i])
+
+def test_cifti_save_lossless(tmp_path):
+    models = _template()
+    filename = str(tmp_path / 'label.dscalar.nii')
+    cifti = iofiles.make_ioinstance(filename)
+    with pytest.raises(Exception):
+        cifti.save(np.full(len(models), 1.5), models, dtype = np.int16)
+    assert not os.path.exists(filename)
+    # integer valued floats could be saved as int
+    cifti.save(np.arange(len(models), dtype = float), models, dtype = np.int16)
+    img = nib.load(filename)
+    assert img.get_data_dtype() == np.int16
+    np.testing.assert_array_equal(img.get_fdata()[0], np.arange(len(models)))
+
+def _arrays():
+    rng = np.random.RandomState(0)
+    return {'a': rng.standard_normal((5, 4)),
+            'fortran': np.asfortranarray(rng.randint(0, 9, (3, 7)).astype(np.int16)),
+            'bigendian': np.arange(6, dtype = '>f4').reshape(2, 3),
+            'a_long_key_' + 'x'*200: np.arange(10, dtype = np.uint8),
+            'empty': np.zeros((0, 3)),
+            'scalar': np.array(3.5),
+            'labels': np.array(['lh', 'rh'])}
+
+def test_npz_memmap_matches_np_load(tmp_path):
+    filename = str(tmp_path / 'data.npz')
+    arrays = _arrays()
+    npzio = iofiles.make_ioinstance(filename)
+    npzio.save(arrays, {'subjects': ['s1', 's2']})
+    assert npzio.load_meta() == {'subjects': ['s1', 's2']}
+    loaded = npzio.load()
+    assert sorted(loaded) == sorted(arrays)
+    assert isinstance(loaded['a'], np.memmap)
+    with np.load(filename) as f:
+        for key, value in arrays.items():
+            np.testing.assert_array_equal(loaded[key], value)
+            np.testing.assert_array_equal(f[key], value)
+            assert loaded[key].dtype == value.dtype and loaded[key].shape == value.shape
+        assert bytes(f['__metadata__']) == b'{"subjects": ["s1", "s2"]}'
+    np.testing.assert_array_equal(npzio.load(['fortran'])['fortran'], arrays['fortran'])
+
+def test_npz_compressed(tmp_path):
+    arrays = _arrays()
+    for compression in ('deflate', 'bzip2', 'lzma'):
+        npzio = iofiles.make_ioinstance(str(tmp_path / '{}.npz'.format(compression)))
+        npzio.save(arrays, compression = compression)
+        loaded = npzio.load()
+        for key, value in arrays.items():
+            assert not isinstance(loaded[key], np.memmap)
+            np.testing.assert_array_equal(loaded[key], value)
+
+def test_npz_rejects_pickle(tmp_path):
+    npzio = iofiles.make_ioinstance(str(tmp_path / 'object.npz'))
+    with pytest.raises(Exception):
+        npzio.save({'obj': np.array([{'a': 1}], dtype = object)})
+    with pytest.raises(Exception):
+        npzio.save({'__metadata__': np.zeros(3)})
+    assert not os.path.exists(str(tmp_path / 'object.npz'))
@@ -0,0 +1,63 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+
+from ATT.algorithm import label_tools
+
+_OPERATORS = {'and': lambda a, b: a & b,
+              'or': lambda a, b: a | b,
+              'xor': lambda a, b: a ^ b,
+              'diff': lambda a, b: a & ~b}
+
+def _images(labels, shape = (6, 6, 6), seed = 0):
+    rng = np.random.RandomState(seed)
+    return rng.choice(labels, shape), rng.choice(labels, shape)
+
+def test_combine_labels_matches_label_loop():
+    # dense lookup table (few labels) and lookup table of existed codes (many labels)
+    for labels in ([0, 1, 2, 5], [0] + list(range(3, 90, 3)) + [1000]):
+        image1, image2 = _images(labels)
+        for method, operator in _OPERATORS.items():
+            outdata, outlabels = label_tools.combine_labels(image1, image2, method)
+            expected_labels = np.setdiff1d(np.union1d(image1, image2), [0])
+            np.testing.assert_array_equal(outlabels, expected_labels)
+            assert outdata.dtype == label_tools.compact_dtype(expected_labels.max())
+            for i, label in enumerate(expected_labels):
+                np.testing.assert_array_equal(outdata[...,i], operator(image1 == label, image2 == label)*label)
+
+def test_relabel():
+    image = np.array([[0, 7, 7], [3, 0, 100]])
+    relabelimg, rawlabel = label_tools.relabel(image)
+    np.testing.assert_array_equal(relabelimg, [[0, 2, 2], [1, 0, 3]])
+    np.testing.assert_array_equal(rawlabel, [3, 7, 100])
+
+def test_contingency_matches_label_loop():
+    image1, image2 = _images([0, 1, 2, 4, 6], seed = 1)
+    ct = label_tools.LabelContingency(image1, image2, labels2 = [1, 2, 4, 9])
+    labels1 = [1, 2, 4, 6]
+    labels2 = [1, 2, 4, 9]
+    for i, l1 in enumerate(labels1):
+        assert ct.size1[i] == np.sum(image1 == l1)
+        for j, l2 in enumerate(labels2):
+            a = image1 == l1
+            b = image2 == l2
+            assert ct.table[i,j] == np.sum(a & b)
+            np.testing.assert_allclose(ct.dice()[i,j], 2.0*np.sum(a & b)/(a.sum() + b.sum()))
+            np.testing.assert_allclose(ct.jaccard()[i,j], np.sum(a & b)/np.sum(a | b))
+            np.testing.assert_allclose(ct.percent(1)[i,j], np.sum(a & b)/a.sum())
+            if b.sum():
+                np.testing.assert_allclose(ct.percent(2)[i,j], np.sum(a & b)/b.sum())
+            else:
+                assert np.isnan(ct.percent(2)[i,j])
+
+def test_contingency_batch():
+    rng = np.random.RandomState(2)
+    stack = rng.randint(0, 4, (5, 5, 5, 3))
+    template = rng.randint(0, 3, (5, 5, 5))
+    ct = label_tools.LabelContingency(stack, template, labels1 = [1, 2, 3], batch = True)
+    assert ct.table.shape == (3, 3, 2)
+    for s in range(stack.shape[-1]):
+        single = label_tools.LabelContingency(stack[...,s], template, labels1 = [1, 2, 3])
+        np.testing.assert_array_equal(ct.table[s], single.table)
+        np.testing.assert_array_equal(ct.dice()[s], single.dice())
@@ -0,0 +1,81 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+from scipy import sparse
+
+from ATT.graph import ncut_lib
+from ATT.benchmarks import generators
+
+def _block_affinity(sizes = (10, 12, 8), seed = 0):
+    """
+    Sparse affinity of dense blocks weakly linked in a chain
+    """
+    rng = np.random.RandomState(seed)
+    n = sum(sizes)
+    w = np.zeros((n, n))
+    start = 0
+    for size in sizes:
+        w[start:start+size, start:start+size] = 0.5 + 0.5*rng.rand(size, size)
+        if start + size < n:
+            w[start+size-1, start+size] = 0.05
+        start += size
+    w = np.triu(w, 1)
+    return sparse.csr_matrix(w + w.T)
+
+
+def test_ncut_eigenvalues_match_dense_eigh():
+    w = _block_affinity()
+    p, _ = ncut_lib._normalized_affinity(w)
+    expected = np.sort(np.linalg.eigvalsh(p.toarray()))[::-1][:4]
+    for method in ('eigsh', 'lobpcg'):
+        eigen_val, eigen_vec = ncut_lib.ncut(w, 4, method = method, seed = 0, tol = 1e-10)
+        np.testing.assert_allclose(eigen_val, expected, atol = 1e-6)
+        assert eigen_vec.shape == (w.shape[0], 4)
+
+
+def test_parcellation_recovers_blocks_and_n_jobs():
+    w = _block_affinity()
+    truth = np.repeat([1, 2, 3], (10, 12, 8))
+    labelimg, _ = ncut_lib.ncut_parcellation(w, 3, n_init = 4, seed = 0)
+    labelimg2, _ = ncut_lib.ncut_parcellation(w, 3, n_init = 4, seed = 0, n_jobs = 2)
+    np.testing.assert_array_equal(labelimg, labelimg2)
+    # labels are arbitrary, compare partitions
+    assert np.all((labelimg[:,None] == labelimg[None,:]) == (truth[:,None] == truth[None,:]))
+
+def test_ncut_value_matches_loop():
+    w = _block_affinity()
+    labelimg = np.random.RandomState(1).randint(1, 4, w.shape[0])
+    dense = w.toarray()
+    expected = 0.0
+    for label in np.unique(labelimg):
+        inside = labelimg == label
+        expected += dense[inside][:, ~inside].sum()/dense[inside].sum()
+    np.testing.assert_allclose(ncut_lib.ncut_value(w, labelimg), expected)
+
+
+def test_multik_n_jobs():
+    w = _block_affinity((8, 8, 8, 8))
+    result = ncut_lib.ncut_multik(w, [2, 4], n_init = 3, seed = 0)
+    result2 = ncut_lib.ncut_multik(w, [2, 4], n_init = 3, seed = 0, n_jobs = 2)
+    for value, value2 in zip(result, result2):
+        np.testing.assert_array_equal(value, value2)
+    for i, k in enumerate([2, 4]):
+        assert np.unique(result[0][:,i]).size == k
+        np.testing.assert_allclose(result[1][i], ncut_lib.ncut_value(w, result[0][:,i]))
+
+def test_mesh_affinity_matches_edge_loop():
+    coords, faces = generators.icosphere(1)
+    rng = np.random.RandomState(2)
+    subjects = [rng.standard_normal((coords.shape[0], 20)) for _ in range(3)]
+    for fisherz in (False, True):
+        w = ncut_lib.mesh_affinity(iter(subjects), faces, fisherz = fisherz, edge_chunk = 7).toarray()
+        nvertex, rows, cols = ncut_lib._mesh_edge_index(faces)
+        expected = np.zeros((nvertex, nvertex))
+        for i, j in zip(rows, cols):
+            r = np.array([np.corrcoef(data[i], data[j])[0,1] for data in subjects])
+            expected[i, j] = expected[j, i] = np.tanh(np.mean(np.arctanh(r))) if fisherz else np.mean(r)
+        np.testing.assert_allclose(w, expected, atol = 1e-6)
+        # chunks sized from a memory budget (a few edges per chunk) give the same affinity
+        w_budget = ncut_lib.mesh_affinity(iter(subjects), faces, fisherz = fisherz, chunk_bytes = 5*2*20*8).toarray()
+        np.testing.assert_allclose(w_budget, w)
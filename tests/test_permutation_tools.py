@@ -0,0 +1,100 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import itertools
+import numpy as np
+from scipy import stats
+
+from ATT.algorithm import permutation_tools
+
+def _chain_adjacency(n):
+    from scipy import sparse
+    rows = np.arange(n-1)
+    adjacency = sparse.coo_matrix((np.ones(n-1), (rows, rows+1)), shape = (n, n))
+    return (adjacency + adjacency.T).tocsr()
+
+def _brute_tfce(statmap, adjacency, E = 0.5, H = 2.0, dh = 0.1):
+    """
+    Positive tfce by flood fill at each threshold
+    """
+    adjacency = adjacency.toarray() != 0
+    tfcemap = np.zeros(statmap.size)
+    for h in np.arange(dh, statmap.max()+dh/2.0, dh):
+        visited = np.zeros(statmap.size, dtype = bool)
+        for node in range(statmap.size):
+            if visited[node] or statmap[node] < h:
+                continue
+            cluster = [node]
+            visited[node] = True
+            for current in cluster:
+                for neighbour in np.flatnonzero(adjacency[current]):
+                    if not visited[neighbour] and statmap[neighbour] >= h:
+                        visited[neighbour] = True
+                        cluster.append(neighbour)
+            tfcemap[cluster] += len(cluster)**E * h**H * dh
+    return tfcemap
+
+def test_onesample_tstat_matches_ttest():
+    rng = np.random.RandomState(0)
+    data = rng.standard_normal((12, 30)) + 0.3
+    signs = np.where(rng.rand(5, 12) > 0.5, 1.0, -1.0)
+    t = permutation_tools.onesample_tstat(data, signs)
+    for i in range(signs.shape[0]):
+        np.testing.assert_allclose(t[i], stats.ttest_1samp(signs[i][:,None]*data, 0).statistic)
+    np.testing.assert_allclose(permutation_tools.onesample_tstat(data), stats.ttest_1samp(data, 0).statistic)
+
+def test_twosample_tstat_matches_ttest():
+    rng = np.random.RandomState(1)
+    data = rng.standard_normal((14, 25))
+    groups = np.array([rng.permutation(14) < 6 for _ in range(4)])
+    t = permutation_tools.twosample_tstat(data, groups)
+    for i in range(groups.shape[0]):
+        np.testing.assert_allclose(t[i], stats.ttest_ind(data[groups[i]], data[~groups[i]]).statistic)
+
+def test_grid_adjacency_matches_neighbour_loop():
+    rng = np.random.RandomState(2)
+    mask = rng.rand(4, 5, 3) > 0.3
+    voxels = np.argwhere(mask)
+    for connectivity, maxdist in ((6, 1), (18, 2), (26, 3)):
+        adjacency = permutation_tools.grid_adjacency(mask, connectivity).toarray()
+        expected = np.zeros_like(adjacency)
+        for i, j in itertools.product(range(len(voxels)), repeat = 2):
+            diff = np.abs(voxels[i] - voxels[j])
+            if i != j and diff.max() == 1 and diff.sum() <= maxdist:
+                expected[i, j] = 1
+        np.testing.assert_array_equal(adjacency != 0, expected != 0)
+
+def test_tfce_matches_flood_fill():
+    rng = np.random.RandomState(3)
+    adjacency = _chain_adjacency(40)
+    statmap = 3*rng.standard_normal(40)
+    tfcemap = permutation_tools.tfce(statmap, adjacency)
+    expected = _brute_tfce(statmap, adjacency) - _brute_tfce(-statmap, adjacency)
+    np.testing.assert_allclose(tfcemap, expected)
+    # a batch of maps gives the same values as one by one
+    batch = permutation_tools.tfce(np.stack((statmap, -statmap)), adjacency)
+    np.testing.assert_allclose(batch, np.stack((tfcemap, -tfcemap)))
+
+def test_permutation_fwe_pvalues_and_n_jobs():
+    rng = np.random.RandomState(4)
+    data = rng.standard_normal((30, 10))
+    data[:5] += 1.5
+    adjacency = _chain_adjacency(30)
+    statmap, pfwe, null_max = permutation_tools.permutation_fwe(data, adjacency, 'tfce', n_perm = 200, batch_size = 30, seed = 0)
+    _, pfwe2, null_max2 = permutation_tools.permutation_fwe(data, adjacency, 'tfce', n_perm = 200, batch_size = 30, seed = 0, n_jobs = 2)
+    np.testing.assert_array_equal(null_max, null_max2)
+    np.testing.assert_array_equal(pfwe, pfwe2)
+    expected = np.array([(np.sum(null_max >= abs(s)) + 1.0)/(null_max.size + 1.0) for s in statmap])
+    np.testing.assert_allclose(pfwe, expected)
+    assert null_max.size == 200
+    assert pfwe[:5].max() < pfwe[5:].min()
+
+def test_permutation_fwe_maxstat_volume():
+    rng = np.random.RandomState(5)
+    mask = np.zeros((4, 4, 4), dtype = bool)
+    mask[1:3, 1:4, 0:3] = True
+    data = rng.standard_normal((4, 4, 4, 12))
+    groups = np.arange(12) < 6
+    statmap, pfwe, null_max = permutation_tools.permutation_fwe(data, method = 'maxstat', test = 'twosample', groups = groups, mask = mask, n_perm = 50, seed = 1)
+    np.testing.assert_allclose(statmap[mask], stats.ttest_ind(data[mask][:, groups], data[mask][:, ~groups], axis = 1).statistic)
+    assert np.all(statmap[~mask] == 0) and np.all(pfwe[~mask] == 1)
@@ -0,0 +1,50 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import os
+import numpy as np
+import nibabel as nib
+
+from ATT.iofunc import surfgeometry
+from ATT.benchmarks import generators
+
+def _surface(filename):
+    coords, faces = generators.icosphere(1)
+    img = nib.gifti.GiftiImage()
+    img.add_gifti_data_array(nib.gifti.GiftiDataArray(coords.astype(np.float32), intent = 'NIFTI_INTENT_POINTSET'))
+    img.add_gifti_data_array(nib.gifti.GiftiDataArray(faces.astype(np.int32), intent = 'NIFTI_INTENT_TRIANGLE'))
+    img.to_filename(filename)
+    return coords.astype(np.float32), faces
+
+def test_products_match_face_loop(tmp_path):
+    coords, faces = _surface(str(tmp_path / 'lh.surf.gii'))
+    geometry = surfgeometry.SurfaceGeometry(coords, faces)
+    edges = set()
+    areas = np.zeros(coords.shape[0])
+    for face in faces:
+        for i in range(3):
+            edges.add(tuple(sorted((int(face[i]), int(face[i-1])))))
+        area = 0.5*np.linalg.norm(np.cross(coords[face[1]] - coords[face[0]], coords[face[2]] - coords[face[0]]))
+        areas[face] += area/3.0
+    assert set(map(tuple, geometry.edges.tolist())) == edges and geometry.edges.shape[0] == len(edges)
+    for i, neighbours in enumerate(geometry.one_ring_neighbour):
+        assert set(neighbours.tolist()) == set(j for e in edges for j in e if i in e and j != i)
+    np.testing.assert_allclose(geometry.edge_lengths, [np.linalg.norm(coords[i] - coords[j]) for i, j in geometry.edges], rtol = 1e-5)
+    np.testing.assert_allclose(geometry.vertex_areas, areas, rtol = 1e-5)
+    # normals of a sphere point outwards
+    assert np.all(np.sum(geometry.vertex_normals*coords, axis = 1) > 0)
+
+def test_sidecar_cache(tmp_path):
+    filename = str(tmp_path / 'lh.surf.gii')
+    _surface(filename)
+    geometry = surfgeometry.SurfaceGeometry.from_file(filename).precompute()
+    cachefile = surfgeometry.cache_filename(filename)
+    assert os.path.exists(cachefile)
+    cached = surfgeometry.SurfaceGeometry.from_file(filename)
+    assert sorted(cached._cache) == sorted(surfgeometry._CACHED)
+    assert (cached.adjacency != geometry.adjacency).nnz == 0
+    np.testing.assert_array_equal(cached.vertex_normals, geometry.vertex_normals)
+    # a modified surface invalidates its cache
+    os.utime(filename, ns = (0, 0))
+    assert surfgeometry.SurfaceGeometry.from_file(filename)._cache == {}
+    assert surfgeometry.SurfaceGeometry.from_file(filename, cache = False)._cachefile is None
@@ -0,0 +1,111 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import pytest
+import numpy as np
+
+from ATT.algorithm import tools
+
+def test_permutation_cross_validation_matches_sklearn():
+    from sklearn import linear_model, model_selection, preprocessing
+    rng = np.random.RandomState(0)
+    X = rng.standard_normal((40, 3))
+    y = np.dot(X, [1.0, -0.5, 0.0]) + rng.standard_normal(40)
+    Xs = preprocessing.scale(X)
+    ys = preprocessing.scale(y)
+    kfold = model_selection.KFold(4, shuffle = True, random_state = 3)
+    shufflesplit = model_selection.ShuffleSplit(n_splits = 100, test_size = 0.25, random_state = 0)
+    cases = [(linear_model.LinearRegression(), 'r2', 'kfold', kfold),
+             (linear_model.Ridge(alpha = 2.0), 'neg_mean_squared_error', 'kfold', kfold),
+             (linear_model.Ridge(alpha = 2.0), 'r2', 'shufflesplit', shufflesplit)]
+    for estimator, score_type, cvmeth, cv in cases:
+        score, perm_scores, pvalue = tools.permutation_cross_validation(estimator, X, y, 4, cvmeth = cvmeth, score_type = score_type, n_perm = 10, random_state = 3)
+        expected = model_selection.permutation_test_score(estimator, Xs, ys, scoring = score_type, cv = cv, n_permutations = 10, random_state = 3)
+        np.testing.assert_allclose(score, expected[0], rtol = 1e-10)
+        np.testing.assert_allclose(perm_scores, expected[1], rtol = 1e-10, atol = 1e-12)
+        np.testing.assert_allclose(pvalue, expected[2])
+
+def _removeoutlier_column(data, meth, thr):
+    """
+    Outlier removal of one column without nan, as the old implementation
+    """
+    residue_data = np.array(data, dtype = float)
+    if meth == 'abs':
+        outlier_bool = (data<thr[0])|(data>thr[1])
+    elif meth == 'iqr':
+        perc_thr = np.percentile(data, [25,75])
+        f_iqr = perc_thr[1] - perc_thr[0]
+        outlier_bool = (data < perc_thr[0] + thr[0]*f_iqr)|(data >= perc_thr[1] + thr[1]*f_iqr)
+    else:
+        f_std = np.std(data)
+        f_mean = np.mean(data)
+        outlier_bool = (data<(f_mean+thr[0]*f_std))|(data>(f_mean+thr[1]*f_std))
+    residue_data[outlier_bool] = np.nan
+    return np.sum(outlier_bool), residue_data
+
+def test_removeoutlier_matches_column_loop():
+    rng = np.random.RandomState(1)
+    data = rng.standard_normal((50, 6))
+    data[rng.rand(50, 6) > 0.9] *= 6
+    for meth, thr in (('iqr', [-1.5, 1.5]), ('std', [-2, 2]), ('abs', [-1, 1])):
+        n_removed, residue_data = tools.removeoutlier(data, meth, thr, axis = 0)
+        for j in range(data.shape[1]):
+            n, residue = _removeoutlier_column(data[:,j], meth, thr)
+            assert n_removed[j] == n
+            np.testing.assert_array_equal(residue_data[:,j], residue)
+        n, residue = _removeoutlier_column(data.ravel(), meth, thr)
+        n_removed, residue_data = tools.removeoutlier(data, meth, thr)
+        assert n_removed == n
+        np.testing.assert_array_equal(residue_data.ravel(), residue)
+
+def test_removeoutlier_nan_and_inplace():
+    rng = np.random.RandomState(2)
+    data = rng.standard_normal((30, 3))
+    data[0, 0] = 10.0
+    data[5, 0] = np.nan
+    # thresholds are computed on non-nan values
+    n_removed, residue_data = tools.removeoutlier(data, 'iqr', [-1.5, 1.5], axis = 0)
+    n, residue = _removeoutlier_column(np.delete(data[:,0], 5), 'iqr', [-1.5, 1.5])
+    assert n_removed[0] == n
+    np.testing.assert_array_equal(np.delete(residue_data[:,0], 5), residue)
+    assert np.isnan(residue_data[0, 0]) and not np.isnan(data[0, 0])
+    n_inplace, inplace = tools.removeoutlier(data, 'iqr', [-1.5, 1.5], axis = 0, copy = False)
+    assert inplace is data
+    np.testing.assert_array_equal(n_inplace, n_removed)
+    np.testing.assert_array_equal(data, residue_data)
+    for wrong in (np.arange(10), [1.0, 2.0]):
+        with pytest.raises(Exception):
+            tools.removeoutlier(wrong, 'iqr', copy = False)
+
+def test_batch_patternmap_matches_subject_loop():
+    from scipy.spatial import distance
+    rng = np.random.RandomState(3)
+    data = rng.standard_normal((5, 30, 6))
+    data[1, 4, 2] = np.nan
+    data[3, [0, 7], :] = np.nan
+    for meth in ('correlation', 'euclidean', 'sqeuclidean', 'cosine', 'cityblock'):
+        corr, dist = tools.batch_patternmap(data, meth, chunk_size = 2, dtype = np.float64)
+        corr32, dist32 = tools.batch_patternmap(data, meth, chunk_size = 2)
+        assert corr32.dtype == np.float32 and corr.dtype == np.float64
+        for s in range(data.shape[0]):
+            clean = tools.listwise_clean(data[s])
+            np.testing.assert_allclose(corr[s], distance.squareform(np.corrcoef(clean.T), checks = False), rtol = 1e-12)
+            np.testing.assert_allclose(dist[s], distance.pdist(clean.T, meth), rtol = 1e-10, atol = 1e-12)
+            np.testing.assert_allclose(dist32[s], dist[s], rtol = 1e-5, atol = 1e-6)
+
+def test_batch_cdist_matches_cdist():
+    from scipy.spatial import distance
+    rng = np.random.RandomState(5)
+    XA = rng.standard_normal((3, 4, 3))
+    XB = rng.standard_normal((6, 3))
+    for metric in ('euclidean', 'sqeuclidean', 'cityblock', 'chebyshev', 'minkowski', 'cosine'):
+        dist = tools.batch_cdist(XA, XB, metric, p = 3)
+        assert dist.shape == (3, 4, 6)
+        for i in range(XA.shape[0]):
+            if metric == 'minkowski':
+                expected = distance.cdist(XA[i], XB, metric, p = 3)
+            else:
+                expected = distance.cdist(XA[i], XB, metric)
+            np.testing.assert_allclose(dist[i], expected)
+    XA[0,1] = np.nan
+    assert np.all(np.isnan(tools.batch_cdist(XA, XB)[0,1]))
@@ -0,0 +1,64 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+
+import numpy as np
+
+from ATT.algorithm import vol_tools
+
+def _masks(seed = 0):
+    rng = np.random.RandomState(seed)
+    mask = rng.randint(0, 4, (6, 5, 4, 3))
+    # label 3 is missing in the second subject
+    mask[...,1][mask[...,1] == 3] = 0
+    atlas = rng.standard_normal(mask.shape) - 5.0
+    return mask, atlas
+
+def test_masksize_and_centroids_match_label_loop():
+    mask, atlas = _masks()
+    masksize = vol_tools.get_masksize(mask, 4)
+    centroids = vol_tools.get_centroids(mask, 4)
+    weighted = vol_tools.get_centroids(mask, 4, weights = np.abs(atlas))
+    assert masksize.shape == (3, 4) and centroids.shape == (3, 4, 3)
+    for s in range(mask.shape[3]):
+        for l in range(1, 5):
+            voxloc = np.argwhere(mask[...,s] == l)
+            if voxloc.size == 0:
+                assert np.isnan(masksize[s,l-1])
+                assert np.all(np.isnan(centroids[s,l-1]))
+                continue
+            assert masksize[s,l-1] == voxloc.shape[0]
+            np.testing.assert_allclose(centroids[s,l-1], voxloc.mean(axis = 0))
+            w = np.abs(atlas[...,s])[mask[...,s] == l]
+            np.testing.assert_allclose(weighted[s,l-1], np.sum(voxloc*w[:,None], axis = 0)/w.sum())
+    np.testing.assert_array_equal(vol_tools.get_masksize(mask[...,0]), masksize[:1,:3])
+
+def test_peaks_match_label_loop():
+    mask, atlas = _masks(1)
+    # ties are resolved to the first voxel, as np.argmax
+    atlas[0,0,0,0] = atlas[1,0,0,0] = 10
+    mask[0,0,0,0] = mask[1,0,0,0] = 1
+    peaks, peakvalues = vol_tools.get_peaks(atlas, mask, 3)
+    for s in range(mask.shape[3]):
+        for l in range(1, 4):
+            inroi = mask[...,s] == l
+            if not inroi.any():
+                assert np.isnan(peakvalues[s,l-1])
+                continue
+            values = np.where(inroi, atlas[...,s], -np.inf)
+            # all values are negative, peaks are still found inside the roi
+            np.testing.assert_array_equal(peaks[s,l-1], np.unravel_index(np.argmax(values), values.shape))
+            assert peakvalues[s,l-1] == values.max()
+    peaks3d, _ = vol_tools.get_peaks(atlas[...,2], mask, 3)
+    np.testing.assert_array_equal(peaks3d[2], peaks[2])
+
+def test_affine_transforms():
+    affine = np.array([[-2., 0., 0., 90.], [0., 2., 0., -126.], [0., 0., 2., -72.], [0., 0., 0., 1.]])
+    vox = np.random.RandomState(2).randint(0, 90, (2, 7, 3))
+    mni = vol_tools.vox2MNI(vox, affine)
+    assert mni.shape == vox.shape
+    for index in np.ndindex(*vox.shape[:2]):
+        np.testing.assert_allclose(mni[index], np.dot(affine, np.append(vox[index], 1))[:3])
+    np.testing.assert_allclose(vol_tools.MNI2vox(mni, affine), vox)
+    np.testing.assert_allclose(vol_tools.vox2MNI([45, 63, 36], affine), [0, 0, 0])
+    np.testing.assert_allclose(vol_tools.MNI2vox([0, 0, 0], affine), [45, 63, 36])
+    assert vol_tools.inverse_affine(affine) is vol_tools.inverse_affine(affine.copy())
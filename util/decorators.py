@@ -1,8 +1,17 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
 # vi: set ft=python sts=4 sw=4 et:
 
-import functools
+import os
 import time
+import pickle
+import hashlib
+import inspect
+import warnings
+import functools
+import numpy as np
+from scipy import sparse
+
+from ATT.util import instrument
 
 def timer(func):
     """
@@ -19,7 +28,255 @@ def timer(func):
         runtime = end - start
 
         msg = "run time for {func} took {time} seconds to finish"
-        print(msg.format(func = func.__name__, time = runtime))
+        instrument.progress(msg.format(func = func.__name__, time = runtime))
 
         return value
     return function_timer
+
+CACHE_PATH = os.environ.get('ATT_RESULT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ATT', 'results'))
+
+def _hasher():
+    try:
+        import xxhash
+        return xxhash.xxh3_128()
+    except ImportError:
+        return hashlib.blake2b(digest_size = 16)
+
+def _file_state(path):
+    """
+    Path, size and modification time of a file, or of all files in a directory
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        return [path] + [_file_state(os.path.join(path, name)) for name in sorted(os.listdir(path))]
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+def _update_hash(h, obj, sample):
+    """
+    Feed obj into hash h. Arrays are hashed by shape, dtype and content,
+    arrays larger than sample bytes are hashed by evenly sampled elements and both ends.
+    File-backed arrays (ChunkStore, LazyImage) are hashed by size and modification time of their files
+    """
+    from ATT.iofunc import iofiles, chunkstore
+    if isinstance(obj, chunkstore.ChunkStore):
+        h.update('ChunkStore'.encode())
+        _update_hash(h, _file_state(obj.path), sample)
+    elif isinstance(obj, iofiles.LazyImage):
+        h.update('LazyImage'.encode())
+        _update_hash(h, _file_state(obj.filename), sample)
+    elif isinstance(obj, np.ndarray):
+        h.update('ndarray{0}{1}'.format(obj.shape, obj.dtype.str).encode())
+        if obj.dtype == object:
+            h.update(pickle.dumps(obj.tolist(), protocol = 4))
+        elif sample is not None and obj.nbytes > sample:
+            nsample = 1 << 16
+            index = np.linspace(0, obj.size-1, nsample).astype(np.int64)
+            h.update(np.ascontiguousarray(obj.flat[index]).data)
+            h.update(np.ascontiguousarray(obj.flat[:nsample]).data)
+            h.update(np.ascontiguousarray(obj.flat[max(obj.size-nsample, 0):]).data)
+        else:
+            # memmap (and contiguous arrays) are hashed from their buffer without copy
+            h.update(np.ascontiguousarray(obj).data)
+    elif sparse.issparse(obj):
+        obj = obj.tocsr()
+        h.update('sparse{0}'.format(obj.shape).encode())
+        for value in (obj.data, obj.indices, obj.indptr):
+            _update_hash(h, value, sample)
+    elif isinstance(obj, (list, tuple)):
+        h.update('{0}{1}'.format(type(obj).__name__, len(obj)).encode())
+        for value in obj:
+            _update_hash(h, value, sample)
+    elif isinstance(obj, dict):
+        h.update('dict{0}'.format(len(obj)).encode())
+        for key in sorted(obj, key = repr):
+            _update_hash(h, key, sample)
+            _update_hash(h, obj[key], sample)
+    elif isinstance(obj, (set, frozenset)):
+        _update_hash(h, sorted(obj, key = repr), sample)
+    elif obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+        h.update('{0}{1!r}'.format(type(obj).__name__, obj).encode())
+    else:
+        # other objects are hashed by their pickled state
+        h.update(type(obj).__name__.encode())
+        h.update(pickle.dumps(obj, protocol = 4))
+
+def _func_version(func):
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = func.__code__.co_code if hasattr(func, '__code__') else ''
+    h = hashlib.blake2b(digest_size = 8)
+    h.update(source.encode() if isinstance(source, str) else source)
+    return h.hexdigest()
+
+def _is_arrays(value):
+    if isinstance(value, tuple):
+        return all(isinstance(v, np.ndarray) and v.dtype != object for v in value)
+    return isinstance(value, np.ndarray) and value.dtype != object
+
+class _ResultCache(object):
+    """
+    On-disk LRU store of function results, one file each key.
+    Arrays (and tuples of arrays) are saved as .npz, other results as pickles.
+    Last access time is kept as file mtime, least recently used files are removed when size exceeds maxsize.
+    """
+    def __init__(self, cachedir, maxsize):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+
+    def _files(self, key):
+        return [os.path.join(self.cachedir, key + ext) for ext in ('.npz', '.pkl')]
+
+    def get(self, key, mmap):
+        from ATT.iofunc import iofiles
+        npzfile, pklfile = self._files(key)
+        try:
+            if os.path.exists(npzfile):
+                io = iofiles.make_ioinstance(npzfile)
+                meta = io.load_meta()
+                data = io.load(mmap = mmap)
+                value = tuple(data[str(i)] for i in range(meta['n']))
+                if not meta['tuple']:
+                    value = value[0]
+                os.utime(npzfile)
+                return True, value
+            if os.path.exists(pklfile):
+                with open(pklfile, 'rb') as f:
+                    value = pickle.load(f)
+                os.utime(pklfile)
+                return True, value
+        except (IOError, OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError):
+            # broken entry (e.g. removed by another process), recompute it
+            pass
+        return False, None
+
+    def set(self, key, value):
+        from ATT.iofunc import iofiles
+        npzfile, pklfile = self._files(key)
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            if _is_arrays(value):
+                values = value if isinstance(value, tuple) else (value,)
+                iofiles.make_ioinstance(npzfile).save(dict((str(i), v) for i, v in enumerate(values)), {'n': len(values), 'tuple': isinstance(value, tuple)})
+            else:
+                tmpfile = os.path.join(self.cachedir, '.tmp-' + os.path.basename(pklfile))
+                try:
+                    with open(tmpfile, 'wb') as f:
+                        pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    os.remove(tmpfile)
+                    raise
+                os.replace(tmpfile, pklfile)
+            self.evict()
+        except (IOError, OSError, pickle.PicklingError, TypeError, AttributeError):
+            # cache is optional, results are still returned
+            pass
+
+    def remove(self, key):
+        for filename in self._files(key):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def entries(self):
+        if not os.path.isdir(self.cachedir):
+            return []
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if name.startswith('.tmp-'):
+                continue
+            filename = os.path.join(self.cachedir, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, filename in self.entries():
+            os.remove(filename)
+
+def cache(func = None, cachedir = None, maxsize = 2**31, sample = None, mmap = False):
+    """
+    Cache results of a deterministic function on disk, keyed on content of its inputs.
+    Array inputs (including memmaps and sparse matrices) are hashed by shape, dtype and content
+    (xxhash if installed, otherwise blake2b), file-backed inputs (ChunkStore, LazyImage) by size and
+    modification time of their files; source code of the function is part of the key,
+    so editing the function invalidates its results.
+    Results of each function are kept in cachedir/<module>.<function>/, an LRU with total size cap.
+    Calls with arguments which can not be hashed (e.g. lambda, open file) are run uncached with a warning.
+    --------------------------------------------
+    Parameters:
+        func: decorated function
+        cachedir: cache directory, by default is CACHE_PATH (environment variable ATT_RESULT_CACHE or ~/.cache/ATT/results)
+        maxsize: size cap (bytes) of results of this function, by default is 2GB
+        sample: arrays larger than sample bytes are hashed by sampled elements instead of all bytes, faster but weaker.
+                By default is None (hash all bytes)
+        mmap: load array results as read-only memmaps, by default is False
+    Return:
+        wrapped function, with cache_clear() to remove all results and invalidate(*args, **kwargs) to remove one result
+    Example:
+        >>> make_pm = decorators.cache(vol_roimethod.make_pm)
+        >>> pm = make_pm(mask, 'all')
+        >>> @decorators.cache(maxsize = 2**30, sample = 2**26)
+        >>> def sweep(data, thresholds):
+        >>>     ...
+        >>> sweep.invalidate(data, thresholds)
+    """
+    if func is None:
+        return functools.partial(cache, cachedir = cachedir, maxsize = maxsize, sample = sample, mmap = mmap)
+    name = '{0}.{1}'.format(func.__module__, getattr(func, '__qualname__', func.__name__))
+    store = _ResultCache(os.path.join(cachedir if cachedir is not None else CACHE_PATH, name), maxsize)
+    signature = inspect.signature(func)
+    version = _func_version(func)
+
+    def _key(args, kwargs):
+        """
+        Hash key of arguments, None if an argument can not be hashed (e.g. lambda, open file)
+        """
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        h = _hasher()
+        h.update(version.encode())
+        try:
+            _update_hash(h, list(bound.arguments.items()), sample)
+        except (pickle.PicklingError, TypeError, AttributeError) as err:
+            warnings.warn('Arguments of {0} can not be hashed ({1}), result is not cached.'.format(name, err), RuntimeWarning)
+            return None
+        return h.hexdigest()
+
+    @functools.wraps(func)
+    def cached_func(*args, **kwargs):
+        key = _key(args, kwargs)
+        if key is None:
+            return func(*args, **kwargs)
+        found, value = store.get(key, mmap)
+        if found:
+            return value
+        value = func(*args, **kwargs)
+        store.set(key, value)
+        return value
+
+    def invalidate(*args, **kwargs):
+        key = _key(args, kwargs)
+        if key is not None:
+            store.remove(key)
+
+    cached_func.cache_clear = store.clear
+    cached_func.invalidate = invalidate
+    cached_func.cache_dir = store.cachedir
+    return cached_func
@@ -0,0 +1,249 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
+# vi: set ft=python sts=4 sw=4 et:
+
+"""
+Instrumentation of pipelines: nested stages with time and memory, counters, progress messages.
+Records are sent to sinks (stdout, logging, json lines or memory), filtered by verbosity.
+
+Verbosity levels:
+    0, silent
+    1, progress messages (default)
+    2, progress messages and stage reports
+
+Example:
+    >>> from ATT.util import instrument
+    >>> instrument.set_verbosity(2)
+    >>> with instrument.stage('make_pm', nsubj = 100):
+    >>>     pm = vol_roimethod.make_pm(mask)
+    >>> instrument.summary()
+"""
+
+import sys
+import json
+import time
+import logging
+import functools
+import threading
+import tracemalloc
+
+_state = {'verbosity': 1, 'sinks': None}
+_local = threading.local()
+_lock = threading.Lock()
+_stats = {}
+_counters = {}
+
+class StreamSink(object):
+    """
+    Write messages to a stream, by default sys.stdout
+    """
+    def __init__(self, stream = None, level = None):
+        self.stream = stream
+        self.level = level
+
+    def emit(self, record):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(format_record(record) + '\n')
+        stream.flush()
+
+class LoggingSink(object):
+    """
+    Send messages to a logger, by default logger 'ATT'
+    """
+    def __init__(self, logger = None, loglevel = logging.INFO, level = None):
+        self.logger = logger if logger is not None else logging.getLogger('ATT')
+        self.loglevel = loglevel
+        self.level = level
+
+    def emit(self, record):
+        self.logger.log(self.loglevel, format_record(record))
+
+class JSONLinesSink(object):
+    """
+    Append records into a json lines file, one record each line
+    """
+    def __init__(self, filename, level = None):
+        self.filename = filename
+        self.level = level
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, default = str)
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(line + '\n')
+
+class MemorySink(object):
+    """
+    Keep records in memory (records attribute), e.g. for tests and notebooks
+    """
+    def __init__(self, level = None):
+        self.level = level
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+def format_record(record):
+    if record['event'] == 'stage':
+        msg = '[{0}] {1:.3f}s'.format(record['name'], record['time'])
+        if record.get('peak_memory') is not None:
+            msg += ', peak memory {0:.1f}MB'.format(record['peak_memory']/1048576.0)
+        if record.get('counters'):
+            msg += ', ' + ', '.join('{0}={1}'.format(k, v) for k, v in sorted(record['counters'].items()))
+        return msg
+    return record['message']
+
+def set_verbosity(level):
+    """
+    Set verbosity, 0 (silent), 1 (progress messages) or 2 (progress messages and stage reports)
+    """
+    _state['verbosity'] = int(level)
+
+def get_verbosity():
+    return _state['verbosity']
+
+def set_sinks(sinks):
+    """
+    Replace sinks, by default records are written to stdout
+    """
+    _state['sinks'] = list(sinks)
+
+def add_sink(sink):
+    _state['sinks'] = get_sinks() + [sink]
+
+def remove_sink(sink):
+    _state['sinks'] = [s for s in get_sinks() if s is not sink]
+
+def get_sinks():
+    if _state['sinks'] is None:
+        _state['sinks'] = [StreamSink()]
+    return list(_state['sinks'])
+
+def track_memory(enable = True):
+    """
+    Track peak memory of stages by tracemalloc (numpy allocations included).
+    It slows down allocation heavy code, so it's disabled by default
+    """
+    if enable and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not enable and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def _emit(record, level):
+    for sink in get_sinks():
+        threshold = sink.level if sink.level is not None else _state['verbosity']
+        if level <= threshold:
+            sink.emit(record)
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def progress(message, level = 1):
+    """
+    Progress message, shown if verbosity >= level
+    """
+    stack = _stack()
+    _emit({'event': 'progress', 'stage': stack[-1].path if stack else None, 'message': message, 'timestamp': time.time()}, level)
+
+def count(name, n = 1):
+    """
+    Increase a named counter, in the current stage and globally
+    """
+    stack = _stack()
+    if stack:
+        stack[-1].counters[name] = stack[-1].counters.get(name, 0) + n
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+class stage(object):
+    """
+    Context manager (or decorator) of a pipeline stage.
+    Wall time, cpu time, counters and peak memory (if track_memory) are reported when stage exits.
+    Stages are nested, the name of a stage is its path as 'outer/inner'
+    ---------------------------------------
+    Parameters:
+        name: stage name
+        level: verbosity level of the report, by default is 2
+        tags: other information in the report, e.g. nsubj = 100
+    Example:
+        >>> with stage('pm'):
+        >>>     with stage('load'):
+        >>>         ...
+        >>> @stage('searchlight')
+        >>> def searchlight(...):
+        >>>     ...
+    """
+    def __init__(self, name, level = 2, **tags):
+        self.name = name
+        self.level = level
+        self.tags = tags
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def staged_func(*args, **kwargs):
+            with stage(self.name, self.level, **self.tags):
+                return func(*args, **kwargs)
+        return staged_func
+
+    def __enter__(self):
+        stack = _stack()
+        self.path = stack[-1].path + '/' + self.name if stack else self.name
+        self.counters = {}
+        self._peak = 0
+        if tracemalloc.is_tracing():
+            self._memstart = tracemalloc.get_traced_memory()[0]
+            if stack:
+                # keep the peak of parent before reset
+                stack[-1]._peak = max(stack[-1]._peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        else:
+            self._memstart = None
+        stack.append(self)
+        self._start = time.perf_counter()
+        self._cpustart = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self._start
+        cputime = time.process_time() - self._cpustart
+        stack = _stack()
+        stack.pop()
+        peak = None
+        if self._memstart is not None and tracemalloc.is_tracing():
+            self._peak = max(self._peak, tracemalloc.get_traced_memory()[1])
+            peak = self._peak - self._memstart
+            if stack:
+                stack[-1]._peak = max(stack[-1]._peak, self._peak)
+        with _lock:
+            stats = _stats.setdefault(self.path, {'calls': 0, 'time': 0.0, 'cpu': 0.0, 'peak_memory': None})
+            stats['calls'] += 1
+            stats['time'] += elapsed
+            stats['cpu'] += cputime
+            if peak is not None:
+                stats['peak_memory'] = max(stats['peak_memory'] or 0, peak)
+        record = {'event': 'stage', 'name': self.path, 'time': elapsed, 'cpu': cputime,
+                  'peak_memory': peak, 'counters': self.counters, 'tags': self.tags,
+                  'failed': exc_type is not None, 'timestamp': time.time()}
+        _emit(record, self.level)
+        return False
+
+def summary():
+    """
+    Accumulated stage statistics and counters
+
+    Return:
+        stats: {stage path: {'calls', 'time', 'cpu', 'peak_memory'}}
+        counters: {counter name: value}
+    """
+    with _lock:
+        return dict((k, dict(v)) for k, v in _stats.items()), dict(_counters)
+
+def reset():
+    """
+    Clear accumulated statistics and counters
+    """
+    with _lock:
+        _stats.clear()
+        _counters.clear()
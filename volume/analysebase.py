@@ -4,11 +4,10 @@
 import os
 import numpy as np
 from scipy import stats
-import nibabel as nib
-from scipy.spatial.distance import pdist
+from scipy.spatial.distance import squareform
 
-from ATT.algorithm import vol_tools, tools, vol_roimethod
-from ATT.util import plotfig
+from ATT.algorithm import vol_tools, tools, vol_roimethod, glm_tools, label_tools
+from ATT.util import plotfig, instrument
 from ATT.iofunc import iofiles
 
 pjoin = os.path.join
@@ -21,15 +20,17 @@ _plot_hist = _figfactory.createfactory('hist')
 _plot_hierarchy = _figfactory.createfactory('hierarchy')
 
 
-def data_preprocess(data, outlier_method = None, outlier_range = [-3,3], mergehemi = None):
+def data_preprocess(data, outlier_method = None, outlier_range = [-3,3], mergehemi = None, copy = True):
     """
     Pipline to merge hemisphere and do outlier removed.
+    The whole data array is processed at once, outliers are computed along the first axis.
     ---------------------------------------------------------
     Parameters:
         data: raw data. Notes that when the dimension is 1, data means regions. When the dimension is 2, data is the form of nsubj*regions. When the dimension is 3, data is the form of timeseries*regions*nsubj.
         outlier_method: 'iqr' or 'std' or 'abs'. By default is None
         outlier_range: outlier standard threshold
         mergehemi: merge hemisphere or not. By default is False. Input bool expression to indicate left or right factor. True means left hemisphere, False means right hemisphere
+        copy: by default is True. If False and hemispheres are not merged, outliers are set as nan in place of (float) data, without copying it.
     Output:
         n_removed: outlier_numbers
         residue_data: output data
@@ -40,6 +41,7 @@ def data_preprocess(data, outlier_method = None, outlier_range = [-3,3], mergehe
         >>> n_removed, residue_data = dataprocess(a,mergehemi = b)
     """
     if mergehemi is not None:
+        mergehemi = np.asarray(mergehemi).astype('bool')
         if not len(mergehemi[mergehemi]) == len(mergehemi[~mergehemi]):
             raise Exception("length of left data should equal to right data")
 
@@ -51,23 +53,11 @@ def data_preprocess(data, outlier_method = None, outlier_range = [-3,3], mergehe
         raise Exception('data dimensions should be 2 or 3!')
     if mergehemi is None:
         data_comb = data
-        n_removed = np.empty((data.shape[1], data.shape[2]))
-        data_removed = np.zeros_like(data)
-        for i in range(data.shape[1]):
-            for j in range(data.shape[2]):
-                n_removed[i,j], data_removed[:,i,j] = tools.removeoutlier(data_comb[:,i,j], meth = outlier_method, thr = outlier_range)
     else:
-        if not mergehemi.dtype == np.bool:
-            mergehemi = mergehemi.astype('bool')
-        n_removed = np.empty((data.shape[1]/2, data.shape[2]))
-        data_comb = np.empty((data.shape[0], data.shape[1]/2, data.shape[2]))
-        data_removed = np.empty((data.shape[0], data.shape[1]/2, data.shape[2]))
-        for i in range(data.shape[0]):
-            for j in range(data.shape[2]):
-                data_comb[i,:,j] = tools.hemi_merge(data[i,mergehemi,j], data[i,~mergehemi,j])
-        for i in range(data.shape[1]/2):
-            for j in range(data.shape[2]):
-                n_removed[i,j], data_removed[:,i,j] = tools.removeoutlier(data_comb[:,i,j], meth = outlier_method, thr = outlier_range)
+        data_comb = tools.hemi_merge(data[:,mergehemi,:], data[:,~mergehemi,:])
+        # merged data is a new array, mask it in place
+        copy = False
+    n_removed, data_removed = tools.removeoutlier(data_comb, meth = outlier_method, thr = outlier_range, axis = 0, copy = copy)
     if n_removed.shape[-1] == 1:
         n_removed = n_removed[...,0]
     if data_removed.shape[-1] == 1:
@@ -178,14 +168,15 @@ class FeatureRelation(object):
                 _plot_mat(corr, self.regions, self.regions)
         return corr, pval
 
-    def feature_prediction2(self, estimator):
+    def feature_prediction2(self, estimator = None):
         """
         Estimate prediction relationship using linear model
-        Please install sklearn when using it
         Note that the first/two data is the DV (Dependent variable) 
         ---------------------------------------------------
         Parameters:
-            estimator: linear model estimator
+            estimator: linear model estimator, by default is None.
+                       If None, ordinary least squares of all contrasts are fitted at once by glm_tools.mass_betafit.
+                       Otherwise fit each contrast by tools.lin_betafit (please install sklearn when using it)
         Return:
             r2: determined values
             beta: scaled beta
@@ -195,14 +186,18 @@ class FeatureRelation(object):
             fpval: p values of f
         Note that if there're two hemispheres, output measurement should be xx*2 array. That follows order of raw data.
         """
-        if self.mergehemi:
+        if self.mergehemi is not None:
             measdata = tools.listwise_clean(self.data_removed)
-            tval = np.empty((measdata.shape[1]-1,1))
-            tpval = np.empty((measdata.shape[1]-1,1))
-            for i in range(measdata.shape[1]-1):
-                c = np.zeros(measdata.shape[1]-1)
-                c[i] = 1
-                r2, betaval, tval[i], tpval[i], f, fpval = tools.lin_betafit(estimator, measdata[:,1:], measdata[:,0], c)
+            if estimator is None:
+                r2, betaval, tval, tpval, f, fpval = glm_tools.mass_betafit(measdata[:,1:], measdata[:,0])
+                r2, betaval, f, fpval = r2[0], betaval[:,0], f[0], fpval[0]
+            else:
+                tval = np.empty((measdata.shape[1]-1,1))
+                tpval = np.empty((measdata.shape[1]-1,1))
+                for i in range(measdata.shape[1]-1):
+                    c = np.zeros(measdata.shape[1]-1)
+                    c[i] = 1
+                    r2, betaval, tval[i], tpval[i], f, fpval = tools.lin_betafit(estimator, measdata[:,1:], measdata[:,0], c)
         else:
             measdata1 = tools.listwise_clean(self.data_removed[:,0::2])
             measdata2 = tools.listwise_clean(self.data_removed[:,1::2])
@@ -213,23 +208,28 @@ class FeatureRelation(object):
             tpval = np.empty((measdata1.shape[1]-1, 2))
             f = np.empty(2)
             fpval = np.empty(2)
-            for i in range(measdata1.shape[1]-1):
-                c = np.zeros(measdata1.shape[1]-1) 
-                c[i] = 1
-                r2[0], betaval[:,0], tval[i,0], tpval[i,0], f[0], fpval[0] = tools.lin_betafit(estimator, measdata1[:,1:], measdata1[:,0], c)
-                r2[1], betaval[:,1], tval[i,1], tpval[i,1], f[1], fpval[1] = tools.lin_betafit(estimator, measdata2[:,1:], measdata2[:,0], c)
+            if estimator is None:
+                for j, measdata in enumerate([measdata1, measdata2]):
+                    r2_j, beta_j, t_j, tpval_j, f_j, fpval_j = glm_tools.mass_betafit(measdata[:,1:], measdata[:,0])
+                    r2[j], betaval[:,j], tval[:,j], tpval[:,j], f[j], fpval[j] = r2_j[0], beta_j[:,0], t_j[:,0], tpval_j[:,0], f_j[0], fpval_j[0]
+            else:
+                for i in range(measdata1.shape[1]-1):
+                    c = np.zeros(measdata1.shape[1]-1) 
+                    c[i] = 1
+                    r2[0], betaval[:,0], tval[i,0], tpval[i,0], f[0], fpval[0] = tools.lin_betafit(estimator, measdata1[:,1:], measdata1[:,0], c)
+                    r2[1], betaval[:,1], tval[i,1], tpval[i,1], f[1], fpval[1] = tools.lin_betafit(estimator, measdata2[:,1:], measdata2[:,0], c)
         if self.figure:
-            if self.mergehemi:
+            if self.mergehemi is not None:
                 xlbl = self.regions[1:]
                 _plot_bar(betaval, 'Scaled beta', xlbl, 'beta values', ['beta values'])
             else:
                 xlbl1 = self.regions[2::2]
                 xlbl2 = self.regions[3::2]
                 _plot_bar(betaval[:,0], 'Scaled beta', xlbl1, 'beta values', ['beta values'])
-                _plot_bar(beta[:,1], 'Scaled beta', xlbl2, 'beta values', ['beta values'])
-        return r2, beta, tval, tpval, f, fpval
+                _plot_bar(betaval[:,1], 'Scaled beta', xlbl2, 'beta values', ['beta values'])
+        return r2, betaval, tval, tpval, f, fpval
 
-    def feature_prediction3(self, estimator, n_fold=3, isshuffle=True, cvmeth = 'shufflesplit', score_type = 'r2', n_perm = 1000): 
+    def feature_prediction3(self, estimator, n_fold=3, isshuffle=True, cvmeth = 'shufflesplit', score_type = 'r2', n_perm = 1000, n_jobs = 1): 
         """
         Test if linear regression r2 is significative by using permutation cross validation
         Note that the first/two data is the DV (Dependent variable)
@@ -242,25 +242,32 @@ class FeatureRelation(object):
                       'kfold' or 'shufflesplit' is affordable
             score_type: scoring type
             n_perm: permutation number
+            n_jobs: number of parallel jobs, workers are shared by both hemispheres
         Return:
             scores: model scores
             permutation_scores: model scores in permutation
             pvalues: p values of permutation test            
             Note that if there're two hemispheres, output measurement should be xx*2 array. That follows order of raw data.
         """
-        if self.mergehemi:
-            measdata = tools.listwise_clean(self.data_removed)
-            scores, n_scores, pvalues = tools.permutation_cross_validation(estimator, measdata[:,1:], measdata[:,0], n_fold, isshuffle, cvmeth, score_type, n_perm)
-        else:
-            scores = np.empty(2)
-            n_scores = np.empty((n_perm, 2))
-            pvalues = np.empty(2)
-            measdata1 = tools.listwise_clean(self.data_removed[:,0::2])
-            measdata2 = tools.listwise_clean(self.data_removed[:,1::2])
-            scores[0], n_scores[:,0], pvalues[0] = tools.permutation_cross_validation(estimator, measdata1[:,1:], measdata1[:,0], n_fold, isshuffle, cvmeth, score_type, n_perm)
-            scores[1], n_scores[:,1], pvalues[1] = tools.permutation_cross_validation(estimator, measdata2[:, 1:], measdata2[:,0], n_fold, isshuffle, cvmeth, score_type, n_perm)
+        try:
+            from joblib import parallel_backend
+        except ImportError:
+            raise Exception('To call this function, please install sklearn')
+        # one reusable worker pool serves all calls in this context
+        with parallel_backend('loky', n_jobs = n_jobs):
+            if self.mergehemi is not None:
+                measdata = tools.listwise_clean(self.data_removed)
+                scores, n_scores, pvalues = tools.permutation_cross_validation(estimator, measdata[:,1:], measdata[:,0], n_fold, isshuffle, cvmeth, score_type, n_perm)
+            else:
+                scores = np.empty(2)
+                n_scores = np.empty((n_perm, 2))
+                pvalues = np.empty(2)
+                measdata1 = tools.listwise_clean(self.data_removed[:,0::2])
+                measdata2 = tools.listwise_clean(self.data_removed[:,1::2])
+                scores[0], n_scores[:,0], pvalues[0] = tools.permutation_cross_validation(estimator, measdata1[:,1:], measdata1[:,0], n_fold, isshuffle, cvmeth, score_type, n_perm)
+                scores[1], n_scores[:,1], pvalues[1] = tools.permutation_cross_validation(estimator, measdata2[:, 1:], measdata2[:,0], n_fold, isshuffle, cvmeth, score_type, n_perm)
         if self.figure:
-            if self.mergehemi:
+            if self.mergehemi is not None:
                 xlbl = self.regions
                 _plot_hist(n_scores, xlbl, scores, pvalues)
             else:
@@ -294,36 +301,53 @@ class ComPatternMap(object):
         self.mergehemi = mergehemi
         self.figure = figure
 
-    def patternmap(self, meth = 'correlation'):
+    def patternmap(self, meth = 'correlation', condensed = False, chunk_size = 64):
+        """
+        Compute pattern maps (correlation and distance between regions) of each subject
+        All subjects are computed in batches by tools.batch_patternmap
+        ----------------------------------------------------------
+        Parameters:
+            meth: distance metric, see scipy.spatial.distance.pdist
+            condensed: by default is False.
+                       If True, return condensed float32 correlation and distance (nsubj x npair) instead of a full float64 matrix
+            chunk_size: number of subjects computed in one batch
+        Output:
+            corrmatrix: correlation matrix, nregion x nregion x nsubj (nsubj x npair if condensed)
+            distance: condensed distance, nsubj x npair
+        """
         if self.data_removed.ndim == 2:
             self.data_removed = np.expand_dims(self.data_removed, axis = 2)
-        distance = []
-        corrmatrix = np.empty((self.data_removed.shape[1], self.data_removed.shape[1], self.data_removed.shape[2]))
-        corrpval = np.empty((self.data_removed.shape[1], self.data_removed.shape[1], self.data_removed.shape[2]))
-        for i in range(self.data_removed.shape[2]):
-            cleandata = tools.listwise_clean(self.data_removed[...,i])
-            corrmatrix[...,i], corrpval[...,i] = tools.pearsonr(cleandata.T, cleandata.T)
-            distance.append(pdist(cleandata.T, meth))
-            print('subject {} finished'.format(i+1))
-        distance = np.array(distance)
+        subjdata = np.moveaxis(self.data_removed, 2, 0)
+        corr, distance = tools.batch_patternmap(subjdata, meth, chunk_size, np.float32 if condensed else np.float64)
+        nregion = self.data_removed.shape[1]
+        if condensed:
+            corrmatrix = corr
+        else:
+            iu = np.triu_indices(nregion, 1)
+            corrmatrix = np.empty((nregion, nregion, corr.shape[0]))
+            corrmatrix[iu[0], iu[1], :] = corr.T
+            corrmatrix[iu[1], iu[0], :] = corr.T
+            corrmatrix[np.arange(nregion), np.arange(nregion), :] = 1.0
         if self.figure is True:
+            meancorr = squareform(np.mean(corr, axis = 0))
+            np.fill_diagonal(meancorr, 1.0)
             _plot_hierarchy(np.mean(distance, axis = 0), self.regions)
-            _plot_mat(np.mean(corrmatrix, axis = 2), self.regions, self.regions)
+            _plot_mat(meancorr, self.regions, self.regions)
         return corrmatrix, distance
 
 class EvaluateMap(object):
     def __init__(self, issave = False, savepath= '.'):
         self.issave = issave
         self.savepath = savepath
-    def dice_evaluate(self, data1, data2, filename = 'dice.pkl'):
+    def dice_evaluate(self, data1, data2, filename = 'dice.npz'):
         """
         Evaluate drawing accuracy by dice coefficient
         -------------------------------------------
         Parameters:
             data1, data2: raw data
-            filename: if save, output file name. By default is dice.pkl 
+            filename: if save, output file name. By default is dice.npz (.pkl is also supported)
         Output:
-            dice: dice coefficient
+            dice: dice coefficient, nsubj x nlabel
         """
         if data1.ndim != data2.ndim:
             raise Exception('Two raw data need have the same dimensions')
@@ -334,17 +358,16 @@ class EvaluateMap(object):
             data1 = np.expand_dims(data1, axis = 3)
         if data2.ndim == 3:
             data2 = np.expand_dims(data2, axis = 3)
-        dice = []
-        for i in range(data1.shape[3]):
-            dice.append(vol_tools.caldice(data1[...,i], data2[...,i], label))
-        dice = np.array(dice)
+        # dice of the same label in both data, all subjects are counted in one pass
+        dice = np.diagonal(label_tools.LabelContingency(data1, data2, label, label, batch = True).dice(), axis1 = 1, axis2 = 2)
         if self.issave:
-            iofactory = iofiles.IOFactory()
-            factory = iofactory.createfactory(self.savepath, filename)
-            if filename.endswith('pkl'):
-                factory.save_pkl(dice)
+            factory = iofiles.make_ioinstance(filename, self.savepath)
+            if filename.endswith('npz'):
+                factory.save({'dice': dice, 'label': label})
+            elif filename.endswith('pkl'):
+                factory.save(dice)
             else:
-                raise Exception('Please save .pkl') 
+                raise Exception('Please save .npz or .pkl')
         return dice
 
 class PositionRelationship(object):
@@ -361,7 +384,7 @@ class PositionRelationship(object):
         try:
             roimask.shape
         except AttributeError:
-            roimask = nib.load(roimask).get_data()
+            roimask = iofiles.load_lazy(roimask)[...]
         finally:
             self._roimask = roimask
         self._masklabel = np.unique(roimask)[1:]
@@ -380,46 +403,43 @@ class PositionRelationship(object):
                   'percent', overlap #voxels/target region #voxels
                   'amount', overlap #voxels
                   'dice', 2*(intersection)/union
+                  'jaccard', intersection/union
             tempnumber: template label number, set in case miss label in specific subjects
         Output:
-            overlaparray, overlap array(matrix) in two images(target & template)
+            overlaparray, overlap array(matrix) in two images(target & template), ntemplabel x nroi.
+                          If target data is 4D (subjects stacked in the 4th dimension) and template is 3D,
+                          nsubj x ntemplabel x nroi, computed at once
+            Note that overlaps of all labels are counted in one pass by label_tools.LabelContingency
             uni_tempextlbl, overlap label within template(Note that label not within target) 
         """
         try:
             template.shape
         except AttributeError:
-            template = nib.load(template).get_data()
+            template = iofiles.load_lazy(template)[...]
             print('Template should be an array')
-        if template.shape != self._roimask.shape:
+        batch = self._roimask.ndim == template.ndim + 1
+        if template.shape != self._roimask.shape[:template.ndim]:
             raise Exception('template should have the same shape with target data')
         templabel = np.unique(template)[1:]
         if tempnumber is not None:
             templabel = np.array(range(1,tempnumber+1))
-        overlaparray = np.empty((templabel.size, self._roinumber))
-        
-        roiloc = np.transpose(np.nonzero(self._roimask))
-        tup_roiloc = map(tuple, roiloc)
-        tempextlabel_all = np.array([template[i] for i in tup_roiloc])
-        roiextlabel_all = np.array([self._roimask[i] for i in tup_roiloc])
-        tempextlabel = np.delete(tempextlabel_all, np.where(tempextlabel_all==0))
-        roiextlabel = np.delete(roiextlabel_all, np.where(tempextlabel_all==0))
-        uni_tempextlbl = np.unique(tempextlabel)
-        for i, vali in enumerate(templabel):
-            for j, valj in enumerate(range(1, 1+self._roinumber)):
-                if para == 'percent':
-                    try:
-                        overlaparray[i,j] = 1.0*tempextlabel[(tempextlabel == vali)*(roiextlabel == valj)].size/self._roimask[self._roimask == valj].size
-                    except ZeroDivisionError:
-                        overlaparray[i,j] = np.nan
-                elif para == 'amount':
-                    overlaparray[i,j] = tempextlabel[(tempextlabel == vali)*(roiextlabel == valj)].size
-                elif para == 'dice':
-                    try:
-                        overlaparray[i,j] = 2.0*tempextlabel[(tempextlabel == vali)*(roiextlabel == valj)].size/(template[template == vali].size + self._roimask[self._roimask == valj].size)
-                    except ZeroDivisionError:
-                        overlaparray[i,j] = np.nan
-                else:
-                    raise Exception("para should be 'percent', 'amount' or 'dice', please retype")
+        contingency = label_tools.LabelContingency(template, self._roimask, templabel, np.arange(1, 1+self._roinumber), batch = batch)
+        if para == 'percent':
+            overlaparray = contingency.percent(base = 2)
+        elif para == 'amount':
+            overlaparray = contingency.amount().astype(float)
+        elif para == 'dice':
+            overlaparray = contingency.dice()
+        elif para == 'jaccard':
+            overlaparray = contingency.jaccard()
+        else:
+            raise Exception("para should be 'percent', 'amount', 'dice' or 'jaccard', please retype")
+        if batch:
+            roiextlabel = self._roimask != 0
+            tempextlabel = np.broadcast_to(template[...,None], self._roimask.shape)[roiextlabel]
+        else:
+            tempextlabel = template[self._roimask != 0]
+        uni_tempextlbl = np.unique(tempextlabel[tempextlabel != 0])
         return overlaparray, uni_tempextlbl
 
     def roidistance(self, targdata, extloc = 'peak', metric = 'euclidean'):
@@ -427,23 +447,23 @@ class PositionRelationship(object):
         Compute distance between ROIs which contains in a mask
         ---------------------------------------------
         Input:
-            targdata: target nifti data, pay attention that this data is not labelled data
+            targdata: target nifti data, pay attention that this data is not labelled data.
+                      If targdata is 4D (subjects stacked in the 4th dimension), distances of all subjects are computed at once
             extloc: 'peak' or 'center' in extraction of coordinate
             metric: methods for calculating distance
+        Output:
+            dist_array: distance matrix, nroi x nroi (nsubj x nroi x nroi for 4D targdata)
         """
         try:
             targdata.shape
         except AttributeError:
-            targdata = nib.load(targdata).get_data()
+            targdata = iofiles.load_lazy(targdata)[...]
             print('targdata should be an array')
-        if self._roimask.shape != targdata.shape:
+        if self._roimask.shape != targdata.shape[:3]:
             raise Exception('targdata shape should have the save shape as target data')
 
         peakcoord = vol_tools.get_coordinate(targdata, self._roimask, method = extloc, labelnum = self._roinumber)
-        dist_array = np.empty((peakcoord.shape[0], peakcoord.shape[0]))
-        for i in range(peakcoord.shape[0]):
-            for j in range(peakcoord.shape[0]):
-                dist_array[i,j] = tools.calcdist(peakcoord[i,:], peakcoord[j,:], metric = metric)
+        dist_array = tools.batch_cdist(peakcoord, peakcoord, metric = metric)
         return dist_array
 
 class PatternSimilarity(object):
@@ -456,7 +476,8 @@ class PatternSimilarity(object):
     In roi2roi, do pearson connectivity between rois (average signals of rois)
     ------------------------------------------------------------------------
     Parameters:
-        imgdata: image data with time/task series. Note that it's a 4D data
+        imgdata: image data with time/task series. Note that it's a 4D data.
+                 Could be a chunked store (iofunc.chunkstore.ChunkStore), voxel blocks are read one by one
         transform_z: By default is False, if the output corrmatrix be z matrix, please flag it as True
     Example:
         >>> m = PatternSimilarity(imgdata, transform_z = True)
@@ -481,14 +502,9 @@ class PatternSimilarity(object):
         Example:
             >>> corrmap, pmap = m.vox2vox(vxloc)
         """
-        rmap = np.zeros(self._imgdata.shape[:3])
-        pmap = np.zeros_like(rmap)
         vxseries = self._imgdata[vxloc[0], vxloc[1], vxloc[2], :]
         vxseries = np.expand_dims(vxseries, axis=1).T
-        for i in range(self._imgdata.shape[0]):
-            for j in range(self._imgdata.shape[1]):
-                rmap[i,j,:], pmap[i,j,:] = tools.pearsonr(vxseries, self._imgdata[i, j, :, :])
-            print('{}% finished'.format(100.0*i/self._imgdata.shape[0]))
+        rmap, pmap = self._seedcorr(vxseries)
         # solve problems as output of nifti data
         # won't affect fdr corrected result
         rmap[np.isnan(rmap)] = 0
@@ -496,7 +512,7 @@ class PatternSimilarity(object):
         if self._transform_z is False:
             corrmap = rmap
         else:
-            print('Perform the Fisher r-to-z transformation')
+            instrument.progress('Perform the Fisher r-to-z transformation')
             corrmap = tools.r2z(rmap)
         return corrmap, pmap
 
@@ -514,20 +530,15 @@ class PatternSimilarity(object):
         """
         roilabel = np.unique(roimask)[1:]
         assert len(roilabel) == 1
-        rmap = np.zeros(self._imgdata.shape[:3])
-        pmap = np.zeros_like(rmap)
-        roiseries, roiloc = _avgseries(self._imgdata, roimask, roilabel[0])
+        roiseries = _avgseries(self._imgdata, roimask, roilabel[0])[0]
         roiseries = np.expand_dims(roiseries, axis=1).T
-        for i in range(self._imgdata.shape[0]):
-            for j in range(self._imgdata.shape[1]):
-                rmap[i, j, :], pmap[i, j, :] = tools.pearsonr(roiseries, self._imgdata[i, j, :, :])
-            print('{}% finished'.format(100.0*i/self._imgdata.shape[0]))
+        rmap, pmap = self._seedcorr(roiseries)
         rmap[np.isnan(rmap)] = 0
         pmap[pmap == 1] = 0
         if self._transform_z is False:
             corrmap = rmap
         else:
-            print('Perform the Fisher r-to-z transformation')
+            instrument.progress('Perform the Fisher r-to-z transformation')
             corrmap = tools.r2z(rmap)
         return corrmap, pmap
 
@@ -548,7 +559,7 @@ class PatternSimilarity(object):
         if self._transform_z is False:
             corrmap = rmap
         else: 
-            print('Perform the Fisher r-to-z transformation')
+            instrument.progress('Perform the Fisher r-to-z transformation')
             corrmap = tools.r2z(rmap)
         return corrmap, pmap
 
@@ -564,18 +575,57 @@ class PatternSimilarity(object):
             >>> avgsignal = m.roiavgsignal(roimask)
         """
         roimxlb = np.sort(np.unique(roimask)[1:])[-1]
-        avgsignal = np.empty((roimxlb, self._imgdata.shape[3]))
-        for i in range(int(roimxlb)):
-            avgsignal[i, :], roiloc = _avgseries(self._imgdata, roimask, i+1)
+        avgsignal = _avgseries(self._imgdata, roimask, np.arange(1, int(roimxlb)+1))
         return avgsignal
 
+    def _seedcorr(self, seedseries):
+        """
+        Correlation between seed series and series of each voxel, block by block
+        """
+        rmap = np.zeros(self._imgdata.shape[:3])
+        pmap = np.zeros_like(rmap)
+        # blocks may be slices or chunks, progress is counted by voxels
+        done = 0
+        with instrument.stage('seedcorr'):
+            for slices, block in _spaceblocks(self._imgdata):
+                r, p = tools.pearsonr(seedseries, block.reshape(-1, block.shape[3]))
+                rmap[slices] = r.reshape(block.shape[:3])
+                pmap[slices] = p.reshape(block.shape[:3])
+                instrument.count('voxels', r.size)
+                done += r.size
+                instrument.progress('{}% finished'.format(100.0*done/rmap.size))
+        return rmap, pmap
+
+def _spaceblocks(imgdata):
+    """
+    Iterate voxel blocks of 4D image data, slice by slice along the first axis for arrays, chunk by chunk for chunked store
+    """
+    if hasattr(imgdata, 'iter_chunks'):
+        for slices, block in imgdata.iter_chunks('space'):
+            yield slices, block
+    else:
+        for i in range(imgdata.shape[0]):
+            yield (slice(i, i+1), slice(None), slice(None)), imgdata[i:i+1]
+
 def _avgseries(imgdata, roimask, label):
     """
-    Extract average series from 4D image data of a specific label
+    Extract average series from 4D image data of specific labels, nan values are ignored
+    label could be a label or an array of labels, return an array of nlabel x ntime
     """
-    roii, roij, roik = np.where(roimask == label)
-    roiloc = zip(roii, roij, roik)
-    return np.nanmean([imgdata[i] for i in roiloc], axis=0), roiloc
+    label = np.atleast_1d(label)
+    sumseries = np.zeros((label.size, imgdata.shape[3]))
+    nvoxel = np.zeros((label.size, imgdata.shape[3]))
+    for slices, block in _spaceblocks(imgdata):
+        maskblock = roimask[slices]
+        for i, lbl in enumerate(label):
+            roiseries = block[maskblock == lbl]
+            if roiseries.shape[0] == 0:
+                continue
+            valid = ~np.isnan(roiseries)
+            sumseries[i] += np.where(valid, roiseries, 0).sum(axis=0)
+            nvoxel[i] += valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sumseries/nvoxel
 
 class MVPA(object):
     """
@@ -666,7 +716,7 @@ class MVPA(object):
                             continue
                         signal_dest = vol_tools.get_signals(self._imgdata, sphere_dest, 'voxel')[0]
                         rdata[i,j,k], pdata[i,j,k] = stats.pearsonr(signal_org, signal_dest)
-            print('{}% finished'.format(100.0*i/91))
+            instrument.progress('{}% finished'.format(100.0*i/91))
         return rdata, pdata
                         
 
@@ -3,104 +3,152 @@
 
 import numpy as np
 import os
-import nibabel as nib
-import copy
-from ATT.algorithm import vol_roimethod, vol_tools, tools
-from ATT.iofunc import iofiles
+import collections
+from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor
+from ATT.algorithm import vol_roimethod, vol_tools, tools, label_tools
+from ATT.iofunc import iofiles, chunkstore
 
 class ImageCalculator(object):
     def __init__(self):
         pass
 
-    def merge4D(self, rawdatapath, outdatapath, outname, issave = True):    
+    def merge4D(self, rawdatapath, outdatapath, outname, issave = True, chunks = None, n_jobs = 1, dtype = None, returndata = True):    
         """
         Merge 3D images together
+        Headers are checked (shapes and affines) before reading data, images are read by a prefetching thread pool
+        and written into output file progressively.
         --------------------------------------
         Parameters:
             rawdatapath: raw data path. Need to be a list contains path of each image
             outdatapath: output path.
             outname: output data name.
+                     If outname (or outdatapath) ends with .c4d, images are streamed into a chunked store
+                     (see iofunc.chunkstore) one by one instead of merged in memory
             issave: save data or not, by default is True
+            chunks: chunk shape of .c4d store, by default is None
+            n_jobs: threads for reading images (and compressing chunks of .c4d store)
+            dtype: output data type, by default is None, the common data type of all images (scaled images are float).
+                   e.g. 'uint16' for label images, 'float32' for statistical images
+            returndata: return merged data or not, by default is True.
+                        If False, only a few volumes are held in memory
         Return:
-            outdata: merged file
+            outdata: merged file (None if returndata is False), or ChunkStore instance if saved into .c4d
         """
         if isinstance(rawdatapath, np.ndarray):
             rawdatapath = rawdatapath.tolist()
-        header = nib.load(rawdatapath[0]).get_header()
-        datashape = nib.load(rawdatapath[0]).get_data().shape
         nsubj = len(rawdatapath)
-        outdata = np.zeros((datashape[0], datashape[1], datashape[2], nsubj))
-        for i in range(nsubj):
-            if os.path.exists(rawdatapath[i]):
-                outdata[...,i] = nib.load(rawdatapath[i]).get_data()
-            else:
-                raise Exception('File may not exist of %s' % rawdatapath[i])
-        img = nib.Nifti1Image(outdata, None, header)
+        images = _check_images(rawdatapath, n_jobs)
+        firstimg = images[0]
+        datashape = firstimg.shape[:3]
+        if dtype is None:
+            dtype = np.result_type(*[img.dtype for img in images])
+        dtype = np.dtype(dtype)
+        volumes = _prefetch(lambda path: iofiles.load_lazy(path)[...], rawdatapath, n_jobs)
         if issave is True:
-            if outdatapath.split('/')[-1].endswith('.nii.gz'):
-                nib.save(img, outdatapath)
-            else:
-                outdatapath_new = os.path.join(outdatapath, outname)
-                nib.save(img, outdatapath_new)
+            if not (outdatapath.endswith('.c4d') or outdatapath.split('/')[-1].endswith('.nii.gz') or outdatapath.endswith('.nii')):
+                outdatapath = os.path.join(outdatapath, outname)
+            if outdatapath.endswith('.c4d'):
+                store = chunkstore.ChunkStore.create(outdatapath, datashape + (nsubj,), dtype, chunks, affine = firstimg.affine)
+                with store.appender(n_jobs) as app:
+                    for volume in volumes:
+                        app.append(volume)
+                return store
+        outdata = np.zeros(datashape + (nsubj,), dtype = dtype) if returndata else None
+        if issave is True:
+            writer = iofiles._NIFTI(outdatapath).open_writer(firstimg.header, datashape + (nsubj,), dtype)
+        else:
+            writer = None
+        try:
+            for i, volume in enumerate(volumes):
+                if outdata is not None:
+                    outdata[...,i] = volume
+                if writer is not None:
+                    writer.write(volume)
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            writer.close()
         return outdata
 
-    def decompose_img(self, imagedata, header, outpath, outname=None):
+    def decompose_img(self, imagedata, header, outpath, outname=None, compresslevel = None, n_jobs = 1):
         """
         Decompose 4D image into multiple 3D image to make it easy to show or analysis
+        Volumes are read and saved by a thread pool, each worker holds only one volume.
+        Each file is written into a temporary file first and renamed when complete.
         --------------------------------------------------------------------
         Parameters:
-            imagedata: 4D image, the 4th dimension is the axis to decompose
-            header: image header
+            imagedata: 4D image, the 4th dimension is the axis to decompose.
+                       Could be a lazy/memory-mapped image (iofiles.LazyImage, np.memmap, chunkstore.ChunkStore)
+                       or a filename (loaded lazily), so that only volumes being saved are read.
+                       Note that uncompressed file is recommended, slicing .nii.gz needs decompressing from the beginning
+            header: image header. By default is None, use header of imagedata if it's a file.
             outpath: outpath
             outname: outname, should be a list. By default is None, system will distribute name into multiple 3D images automatically. If you want to generate images with meaningful name, please assign a list.
+            compresslevel: gzip compress level, 0 means saving uncompressed .nii. By default is None (nibabel default level)
+            n_jobs: number of threads
         Output:
             save outdata into multiple files
         Example:
             >>> imccls = ImageCalculator() 
             >>> imccls.decompose_img(imagedata, header, outpath)
+            >>> imccls.decompose_img('merged.nii', None, outpath, compresslevel = 0, n_jobs = 8)
         """
-        assert np.ndim(imagedata) == 4, 'imagedata must be a 4D data'
+        if isinstance(imagedata, str):
+            imagedata = iofiles.load_lazy(imagedata)
+        if header is None:
+            if not hasattr(imagedata, 'header'):
+                raise Exception('header should be given for imagedata without header')
+            header = imagedata.header
+        assert imagedata.ndim == 4, 'imagedata must be a 4D data'
         filenumber = imagedata.shape[3]
         if outname is None:
             digitname = range(1,filenumber+1,1)
             outname = [str(i) for i in digitname]
         else:
             assert len(outname) == filenumber, 'length of outname unequal to length of imagedata'
-        for i,e in enumerate(outname):
+        suffix = '.nii' if compresslevel == 0 else '.nii.gz'
+        # keep data type of header only if data could be saved without loss (writer does not scale data)
+        dtype = header.get_data_dtype()
+        if not np.can_cast(imagedata.dtype, dtype, 'safe'):
+            dtype = np.dtype(np.float32)
+
+        def _save_volume(i):
             outdata = imagedata[...,i]
-            img = nib.Nifti1Image(outdata, None, header)
-            nib.save(img, os.path.join(outpath, e+'.nii.gz'))
+            niftiio = iofiles._NIFTI(os.path.join(outpath, outname[i]+suffix))
+            with niftiio.open_writer(header, outdata.shape, dtype, compresslevel) as writer:
+                writer.write(outdata)
+
+        if n_jobs == 1:
+            for i in range(filenumber):
+                _save_volume(i)
+        else:
+            pool = ThreadPool(n_jobs)
+            try:
+                for _ in pool.imap_unordered(_save_volume, range(filenumber)):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
 
     def combine_data(self, image1, image2, method = 'and'):
         """
-        Combined data for 'and', 'or'
+        Combined data for 'and', 'or', 'xor', 'diff'
+        All labels are combined in one pass, see label_tools.combine_labels
         ------------------------------------------
         Parameters:
             image1: dataset of the first image
             image2: dataset of the second image
-            method: 'and' or 'or'
+            method: 'and', 'or', 'xor' or 'diff' (in image1 but not in image2)
+        Return:
+            outdata: combined data, each label in one volume of the 4th dimension, with compact integer dtype
         """
         if (isinstance(image1, str) & isinstance(image2, str)):
-            image1 = nib.load(image1).get_data()
-            image2 = nib.load(image2).get_data()
-        labels = np.unique(np.concatenate((np.unique(image1), np.unique(image2))))[1:]
-        outdata = np.empty((image1.shape[0], image1.shape[1], image2.shape[2], labels.size))
-        for i in range(labels.size):
-            tempimage1 = copy.copy(image1)
-            tempimage2 = copy.copy(image2)
-            tempimage1[tempimage1 != labels[i]] = 0
-            tempimage1[tempimage1 == labels[i]] = 1
-            tempimage2[tempimage2 != labels[i]] = 0
-            tempimage2[tempimage2 == labels[i]] = 1
-            tempimage1.astype('bool')
-            tempimage2.astype('bool')
-            if method == 'and':
-                tempimage = tempimage1 * tempimage2
-            elif method == 'or':
-                tempimage = tempimage1 + tempimage2
-            else:
-                raise Exception('Method support and, or now')
-            outdata[...,i] = labels[i]*tempimage
+            image1 = iofiles.load_lazy(image1)[...]
+            image2 = iofiles.load_lazy(image2)[...]
+        outdata, labels = label_tools.combine_labels(image1, image2, method)
         return outdata
 
     def relabel_roi(self, roiimg):
@@ -111,20 +159,62 @@ class ImageCalculator(object):
             roiimg: roi image
 
         Output:
-            relabelimg: relabeling image with continous label sequence
+            relabelimg: relabeling image with continous label sequence, with compact integer dtype
             corr_label: the correspond relationship between original label and new label
        
         Example:
             >>> relabelimg, corr_label = m.relabel_roi(roiimg)
         """
-        relabelimg = np.zeros_like(roiimg)
-        rawlabel = np.sort(np.unique(roiimg))[1:].astype('int')
-        newlabel = np.array(range(1, len(rawlabel)+1)).astype('int')
-        corr_label = zip(rawlabel, newlabel)
-        for i,e in enumerate(rawlabel):
-            relabelimg[roiimg==e] = newlabel[i]
+        relabelimg, rawlabel = label_tools.relabel(roiimg)
+        newlabel = np.arange(1, rawlabel.size+1)
+        corr_label = list(zip(rawlabel.astype('int').tolist(), newlabel.tolist()))
         return relabelimg, corr_label
 
+def _check_images(rawdatapath, n_jobs = 1):
+    """
+    Check existence, shapes and affines of images by reading headers only (in parallel).
+    Return lazy images.
+    """
+    for path in rawdatapath:
+        if not os.path.exists(path):
+            raise Exception('File may not exist of %s' % path)
+    pool = ThreadPool(n_jobs)
+    try:
+        images = pool.map(iofiles.load_lazy, rawdatapath)
+    finally:
+        pool.close()
+        pool.join()
+    firstimg = images[0]
+    for path, img in zip(rawdatapath, images):
+        if img.shape[:3] != firstimg.shape[:3] or img.ndim > 3 and np.prod(img.shape[3:]) != 1:
+            raise Exception('Shape of %s mismatched with the first image' % path)
+        if not np.allclose(img.affine, firstimg.affine, atol = 1e-4):
+            raise Exception('Affine of %s mismatched with the first image' % path)
+    return images
+
+def _prefetch(func, items, n_jobs = 1, depth = None):
+    """
+    Apply func on items in a thread pool, yield results in order.
+    At most depth (by default 2*n_jobs) results are prefetched.
+    """
+    if n_jobs == 1:
+        for item in items:
+            yield func(item)
+        return
+    if depth is None:
+        depth = 2*n_jobs
+    executor = ThreadPoolExecutor(n_jobs)
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures = True)
+
 class ExtractSignals(object):
     def __init__(self, atlas, regions = None):
         masksize = vol_tools.get_masksize(atlas)
@@ -144,21 +234,28 @@ class ExtractSignals(object):
         Get measurement signals from target image by mask atlas.
         -------------------------------------------
         Parameters:
-            targ: target image
+            targ: target image, could be a chunked store (iofunc.chunkstore.ChunkStore)
             method: 'mean' or 'std', 'ste'(standard error), 'max' or 'voxel'
                     roi signal extraction method
         Return:
             signals: extracted signals
         """
-        if targ.ndim == 3:
-            targ = np.expand_dims(targ, axis = 3)
+        if hasattr(targ, 'iter_chunks'):
+            # chunked store, read subject blocks one by one
+            blocks = targ.iter_chunks('subject')
+        else:
+            if targ.ndim == 3:
+                targ = np.expand_dims(targ, axis = 3)
+            blocks = [(slice(0, targ.shape[3]), targ)]
         signals = []
-        
-        for i in range(targ.shape[3]):
-            if self.atlas.ndim == 3:
-                signals.append(vol_tools.get_signals(targ[...,i], self.atlas, method, self.regions))
-            elif self.atlas.ndim == 4:
-                signals.append(vol_tools.get_signals(targ[...,i], self.atlas[...,i], method, self.regions))
+        for tslice, block in blocks:
+            if self.atlas.ndim == 4:
+                atlas_block = self.atlas[..., tslice]
+            for i in range(block.shape[3]):
+                if self.atlas.ndim == 3:
+                    signals.append(vol_tools.get_signals(block[...,i], self.atlas, method, self.regions))
+                elif self.atlas.ndim == 4:
+                    signals.append(vol_tools.get_signals(block[...,i], atlas_block[...,i], method, self.regions))
         self.signals = np.array(signals)
         return np.array(signals)
 
@@ -168,19 +265,14 @@ class ExtractSignals(object):
         -----------------------------------------------------------
         Parameters:
             targ: target image
-            size: voxel size
+            size: voxel size, or a 4x4 affine matrix to get MNI coordinates
             method: 'peak' or 'center'
                     coordinate extraction method
         """
         if targ.ndim == 3:
             targ = np.expand_dims(targ, axis = 3)
-        coordinate = np.empty((targ.shape[3], self.regions, 3))
-
-        for i in range(targ.shape[3]):
-            if self.atlas.ndim == 3:
-                coordinate[i, ...] = vol_tools.get_coordinate(targ[...,i], self.atlas, size, method, self.regions)
-            elif self.atlas.ndim == 4:
-                coordinate[i, ...] = vol_tools.get_coordinate(targ[...,i], self.atlas[...,i], size, method, self.regions)
+        # all subjects are computed at once
+        coordinate = vol_tools.get_coordinate(targ, self.atlas, size, method, self.regions)
         self.coordinate = coordinate
         return coordinate
 
@@ -197,16 +289,14 @@ class ExtractSignals(object):
             distmeth: distance method
         """
         if not hasattr(self, 'coordinate'):
-            self.coordinate = vol_tools.get_coordinate(targ, self.atlas, size, coordmeth)
-        dist_point = np.empty((self.coordinate.shape[0], self.coordinate.shape[1]))
-        pointloc = np.array(pointloc)
+            self.getcoordinate(targ, size, coordmeth)
+        pointloc = np.array(pointloc, dtype = float)
+        if pointloc.ndim != 2:
+            raise Exception('pointloc should be 2 dimension array or list')
         if pointloc.shape[0] == 1:
-            pointloc = np.tile(pointloc, [dist_point.shape[1],1])
-        for i in range(dist_point.shape[0]):
-            for j in range(dist_point.shape[1]):
-                if not isinstance(pointloc[j], np.ndarray):
-                    raise Exception('pointloc should be 2 dimension array or list')
-                dist_point[i,j] = tools.calcdist(self.coordinate[i,j,:], pointloc[j], distmeth)
+            pointloc = np.tile(pointloc, [self.coordinate.shape[1],1])
+        # distance between each coordinate and its paired point, all subjects at once
+        dist_point = tools.batch_cdist(self.coordinate[...,None,:], pointloc[:,None,:], distmeth)[...,0,0]
         self.dist_point = dist_point
         return dist_point
 
@@ -230,10 +320,9 @@ class MakeMasks(object):
         pm = vol_roimethod.make_pm(atlas, meth)
         self._pm = pm
         if self._issave is True:
-            iofactory = iofiles.IOFactory()
-            factory = iofactory.createfactory(self._savepath, maskname)
+            factory = iofiles.make_ioinstance(maskname, self._savepath)
             if maskname.endswith('gz') | maskname.endswith('nii'):
-                factory.save_nifti(pm, self._header)
+                factory.save(pm, self._header)
         return pm
 
     def makempm(self, threshold, pmfile = None, maskname = 'mpm.nii.gz'):
@@ -250,10 +339,9 @@ class MakeMasks(object):
             raise Exception('please execute makepm first or give pmfile in this method')
         mpm = vol_roimethod.make_mpm(self._pm, threshold)
         if self._issave is True:
-            iofactory = iofiles.IOFactory()
-            factory = iofactory.createfactory(self._savepath, maskname)
+            factory = iofiles.make_ioinstance(maskname, self._savepath)
             if maskname.endswith('gz') | maskname.endswith('nii'):
-                factory.save_nifti(mpm, self._header)
+                factory.save(mpm, self._header)
         return mpm       
     
     def makemask_sphere(self, voxloc, radius, atlasshape = (91,109,91), maskname = 'spheremask.nii.gz'):
@@ -271,10 +359,9 @@ class MakeMasks(object):
         for i, e in enumerate(voxloc):
             spheremask, loc = vol_roimethod.sphere_roi(e, radius, i+1, datashape = atlasshape, data = spheremask)
         if self._issave is True:
-            iofactory = iofiles.IOFactory()
-            factory = iofactory.createfactory(self._savepath, maskname)
+            factory = iofiles.make_ioinstance(maskname, self._savepath)
             if maskname.endswith('gz') | maskname.endswith('nii'):
-                factory.save_nifti(spheremask, self._header)
+                factory.save(spheremask, self._header)
         return spheremask, loc
 
     def makemask_rgrowth(self, valuemap, coordinate, voxnum, maskname = 'rgmask.nii.gz'):
@@ -309,10 +396,9 @@ class MakeMasks(object):
             else:
                 warnings.warn('coordinate {} has been overlapped! Label {} will missing'.format(e, i+1))
         if self._issave is True:
-            iofactory = iofiles.IOFactory()
-            factory = iofactory.createfactory(self._savepath, maskname)
+            factory = iofiles.make_ioinstance(maskname, self._savepath)
             if maskname.endswith('gz') | maskname.endswith('nii'):
-                factory.save_nifti(rgmask, self._header)
+                factory.save(rgmask, self._header)
         return rgmask
                 
 